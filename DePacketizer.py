@@ -21,20 +21,53 @@
 
 import struct, crc16, logging, sys
 import numpy as np
+from ModemUtils import STATE_VERSION, check_state
 
 
 class DePacketizer(object):
-    """ Message DePacketizer Class """
-    def __init__(self, sync_bytes = '\xAB\xCD', payload_length_cap = 32, callback = False):
+    """ Message DePacketizer Class
+
+    callback:           Function pointer. Payloads of packets which pass their CRC check are passed to this function.
+    failed_callback:    Function pointer. If set, the payloads of packets which have a valid header but fail their
+                        CRC check are passed to this function.
+    """
+    def __init__(self, sync_bytes = '\xAB\xCD', payload_length_cap = 32, callback = False, failed_callback = False):
         self.sync_bytes = sync_bytes
         self.sync_length = len(sync_bytes) * 8
         self.payload_length_cap = payload_length_cap
         self.callback = callback
+        self.failed_callback = failed_callback
 
         self.buffer_state = "APPEND" # "APPEND", while waiting for enough bits to attempt to extract a full packet, 
                                      # "SHIFT", for when we have reached our maximum buffer size, and can just clock through bits. 
         self.state = "NEED_MORE_DATA"
         self.buffer = np.array([]).astype(np.uint8)
+        self.packet_crc = None # CRC of the most recently found packet, for callbacks which want it.
+
+    def get_state(self):
+        """
+        Snapshot of the bit buffer and its state, as a dictionary of NumPy arrays which can be saved with
+        ModemUtils.save_state. Callbacks are not included.
+        """
+        return {"state_version": np.array(STATE_VERSION), "sync_bytes": np.fromstring(self.sync_bytes, dtype=np.uint8), "payload_length_cap": np.array(self.payload_length_cap),
+            "buffer": self.buffer.copy(), "buffer_state": np.array(self.buffer_state), "state": np.array(self.state),
+            "packet_crc": np.array(-1 if self.packet_crc == None else self.packet_crc)}
+
+    def set_state(self, state):
+        """
+        Restore a snapshot from get_state. Raises ValueError if it was taken with different sync bytes or payload
+        length cap.
+        """
+        if int(state["state_version"]) != STATE_VERSION:
+            raise ValueError("Unsupported state version %s." % state["state_version"])
+        check_state(state, {"payload_length_cap": self.payload_length_cap})
+        if state["sync_bytes"].tostring() != self.sync_bytes:
+            raise ValueError("State does not match this configuration (different sync bytes).")
+
+        self.buffer = np.array(state["buffer"], dtype=np.uint8)
+        self.buffer_state = str(state["buffer_state"])
+        self.state = str(state["state"])
+        self.packet_crc = None if int(state["packet_crc"]) < 0 else int(state["packet_crc"])
 
     # Test buffer for sync bytes. If found, check for the rest of the packet, if enough bits are available. 
     def test_buffer(self):
@@ -81,6 +114,7 @@ class DePacketizer(object):
                         payload = packet_string[len(self.sync_bytes)+2:-2]
 
                         logging.info("Found complete packet: " + payload)
+                        self.packet_crc = packet_crc
                         # Do somethign with the packet
                         if self.callback != False:
                             self.callback(payload)
@@ -90,6 +124,9 @@ class DePacketizer(object):
                     else:
                         # Packet failed CRC. Continue clocking through bits in case this was a false positive.
                         logging.debug("CRC Check failed. False positive on sync?")
+                        if self.failed_callback != False:
+                            self.packet_crc = packet_crc
+                            self.failed_callback(packet_string[len(self.sync_bytes)+2:-2])
                         self.buffer_state = "SHIFT"
                         return
                 else:
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Decimator.py - Streaming complex decimator.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from ModemUtils import complex_dtype
+
+
+class Decimator(object):
+    """ Streaming Decimator Class
+
+    Mixes a band of interest down to DC, low-pass filters it and reduces the sample rate by an integer factor.
+    Only the output samples which are kept are calculated (the polyphase approach), and the filter history,
+    mixer phase and decimation phase are all kept between calls, so the input can be fed in arbitrary chunks.
+
+    The output is complex, and is shifted up by half the output sample rate, so the band of interest sits in
+    the middle of the positive frequencies (as the MFSK Demodulator expects).
+
+    sample_rate:    Input sample rate (Hz)
+    decimation:     Integer decimation factor.
+    centre_freq:    Centre frequency of the band of interest (Hz)
+    bandwidth:      Width of the band of interest (Hz). Must be less than the output sample rate.
+    dtype:          Real dtype to work in (np.float64 or np.float32). The output is the matching complex type.
+
+    """
+    def __init__(self, sample_rate, decimation, centre_freq, bandwidth, dtype = np.float64):
+        self.fs = sample_rate
+        self.decimation = decimation
+        self.output_rate = sample_rate/float(decimation)
+        self.centre_freq = centre_freq
+        self.bandwidth = bandwidth
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = complex_dtype(self.dtype)
+
+        # Anything further than (output_rate - bandwidth/2) from the centre would alias back into the band.
+        transition = self.output_rate - self.bandwidth
+        cutoff = (self.bandwidth/2.0 + transition/2.0)/(self.fs/2.0)
+        num_taps = int(4*self.fs/transition) | 1
+        # Imported here, as scipy.signal is slow to import and only needed when decimating.
+        from scipy.signal import firwin
+        self.taps = firwin(num_taps, cutoff)[::-1].astype(self.dtype)
+
+        self.history = np.zeros(num_taps - 1, dtype=self.complex_dtype)
+        self.mixing_phase = 0.0 # Mixer phase (radians)
+        # Index into the next chunk of the next sample to output. Starting at the filter's group delay
+        # means output sample n lines up with input sample n*decimation.
+        self.offset = (num_taps - 1)//2
+        self.output_count = 0
+
+    def process(self, data):
+        """
+        Decimate a chunk of samples. Returns the (possibly empty) complex output.
+        """
+        # Mix the band of interest down to DC. The phase is calculated in double precision, then the mixing
+        # is done in the working precision.
+        phase = self.mixing_phase - 2*np.pi*(self.centre_freq/float(self.fs))*np.arange(len(data))
+        self.mixing_phase = (self.mixing_phase - 2*np.pi*(self.centre_freq/float(self.fs))*len(data)) % (2*np.pi)
+        mixer = np.exp(1j*phase.astype(self.dtype))
+        data = np.concatenate((self.history, np.asarray(data, dtype=self.complex_dtype)*mixer))
+
+        new_samples = len(data) - len(self.history)
+        if self.offset >= new_samples:
+            num_out = 0
+        else:
+            num_out = (new_samples - 1 - self.offset)//self.decimation + 1
+
+        # Filter windows which end on each output sample.
+        start = data[self.offset:]
+        windows = as_strided(start, shape=(num_out, len(self.taps)), strides=(start.strides[0]*self.decimation, start.strides[0]))
+        output = windows.dot(self.taps)
+
+        self.offset = self.offset + num_out*self.decimation - new_samples
+        self.history = data[len(data) - len(self.history):].copy()
+
+        # Shift up by half the output sample rate, by negating every second sample.
+        output[(self.output_count + np.arange(num_out)) % 2 == 1] *= -1
+        self.output_count = self.output_count + num_out
+
+        return output
+
+    def get_state(self):
+        """ Dictionary of the filter history, mixer phase and decimation phase, as NumPy arrays. """
+        return {"history": self.history.copy(), "mixing_phase": np.array(self.mixing_phase), "offset": np.array(self.offset),
+            "output_count": np.array(self.output_count)}
+
+    def set_state(self, state):
+        """ Restore state saved by get_state. """
+        if len(state["history"]) != len(self.history):
+            raise ValueError("Decimator state has a different filter length.")
+        self.history = np.array(state["history"], dtype=self.complex_dtype)
+        self.mixing_phase = float(state["mixing_phase"])
+        self.offset = int(state["offset"])
+        self.output_count = int(state["output_count"])
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# DiversityCombiner.py - Combine the tone bin magnitudes of several MFSK Demodulators listening to the same signal.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from ModemUtils import *
+
+
+class DiversityCombiner(object):
+    """ Diversity Combiner Class
+
+    Each receiver (antenna, radio) has its own MFSK Demodulator, with its tone_callback set to
+    input_callback(n). The per-symbol tone bin magnitudes from all of the demodulators are matched up by their
+    sample counts, so the receivers must be sampled from the same clock, starting together (or have their
+    sample counts offset to match). Symbols are matched to the nearest slot of a reference timeline, which follows
+    the strongest receiver, so small differences in timing between the receivers don't matter, and a receiver
+    whose timing has wandered off (e.g. flywheeling through a fade) contributes at most one symbol per slot.
+
+    The tone bin magnitudes of each symbol are normalised (receivers can have very different gains), and summed
+    across the receivers. The combined magnitudes then go through the same hard and soft decisions as a single
+    demodulator's, and are passed to block_callback in the same structured arrays (ModemUtils.symbol_dtype), so
+    the depacketizer doesn't know the difference.
+
+    num_inputs:     Number of receivers.
+    symbol_length:  Symbol length, in input samples (sample_rate/symbol_rate).
+    block_callback: Function pointer, as for MFSKDemodulator.
+    mode:           "mrc" (maximum ratio combining): each receiver is weighted by its SNR estimate.
+                    "egc" (equal gain combining): all receivers are weighted equally.
+    soft_bits:      If True, soft bit values are included in the output.
+    gray_coded:     Whether the mode is gray coded (affects the soft bits).
+    max_wait:       Symbols to wait for a receiver which has stopped producing symbols (e.g. it is squelched)
+                    before combining without it.
+
+    """
+    def __init__(self, num_inputs, symbol_length, block_callback = False, mode = "mrc", soft_bits = False, gray_coded = True, max_wait = 16):
+        if mode not in ["mrc", "egc"]:
+            raise ValueError("Unknown combining mode '%s'." % mode)
+
+        self.num_inputs = num_inputs
+        self.symbol_length = int(symbol_length)
+        self.block_callback = block_callback
+        self.mode = mode
+        self.soft_bits = soft_bits
+        self.gray_coded = gray_coded
+        self.max_wait = max_wait*self.symbol_length
+        self.tolerance = self.symbol_length//2
+
+        # Records which haven't been combined yet, and the last sample seen from each input.
+        self.buffers = [None]*num_inputs
+        self.latest = np.zeros(num_inputs, dtype=np.int64) - 1
+        # Sample of the next symbol on the reference timeline, once the first records have arrived.
+        self.next_symbol = None
+        # Symbols combined, the number of receiver symbols which went into them, and the number of receiver symbols
+        # dropped (a second symbol from the same receiver in one slot, or one which arrived too late).
+        self.symbol_count = 0
+        self.input_count = 0
+        self.dropped_count = 0
+
+    def input_callback(self, index):
+        """ tone_callback for the demodulator of receiver (index). """
+        return lambda records: self.process(index, records)
+
+    def process(self, index, records):
+        """ Add capture records (ModemUtils.capture_dtype) from receiver (index), and combine any complete symbols. """
+        if len(records) == 0:
+            return
+        self.buffers[index] = records if self.buffers[index] is None else np.concatenate((self.buffers[index], records))
+        self.latest[index] = max(self.latest[index], records["sample"][-1])
+
+        # Receivers only move forwards, so a symbol is complete once every receiver is past it. Any which are too
+        # far behind are ignored.
+        live = self.latest >= np.max(self.latest) - self.max_wait
+        self.combine(np.min(self.latest[live]))
+
+    def flush(self):
+        """ Combine all of the buffered symbols. Call at the end of the input. """
+        self.combine(None)
+
+    def combine(self, horizon):
+        """
+        Combine the buffered symbols which no receiver can add to any more (every receiver has passed sample
+        (horizon), or all of them if horizon is None), and pass them to block_callback.
+
+        Each record is assigned to the nearest slot on a reference timeline, one symbol apart, which is kept
+        aligned to the strongest receiver's symbols. Each receiver contributes at most one record (its strongest)
+        to a slot, so a receiver which has lost timing can't merge two symbols into one, or be counted twice.
+        """
+        length = self.symbol_length
+        buffered = [(index, x) for (index, x) in enumerate(self.buffers) if x is not None and len(x) > 0]
+        if len(buffered) == 0:
+            return
+        records = np.concatenate([x for (index, x) in buffered])
+        inputs = np.concatenate([np.zeros(len(x), dtype=int) + index for (index, x) in buffered])
+        samples = records["sample"]
+        snr = 10**(records["s2n"].astype(np.float64)/20)
+
+        if self.next_symbol == None:
+            # Start the timeline on the strongest receiver's symbols, far enough back to include the earliest record,
+            # once every receiver has had a chance to report them.
+            passed = samples <= horizon if horizon != None else np.ones(len(samples), dtype=bool)
+            if not np.any(passed):
+                return
+            reference = samples[passed][np.argmax(snr[passed])]
+            self.next_symbol = reference - length*((reference - np.min(samples) + self.tolerance)//length)
+
+        # Slot of each record. A slot is complete once a new record (after horizon) can't land in it.
+        slot = (samples - self.next_symbol + self.tolerance)//length
+        if horizon == None:
+            num_slots = np.max(slot) + 1
+        else:
+            num_slots = max(0, (horizon - (length - self.tolerance) - self.next_symbol)//length + 1)
+
+        ready = slot < num_slots
+        for (index, x) in buffered:
+            waiting = x[slot[inputs == index] >= num_slots]
+            self.buffers[index] = waiting if len(waiting) > 0 else None
+
+        # Records for slots which have already been output are too late.
+        use = ready & (slot >= 0)
+        self.dropped_count += np.sum(ready & (slot < 0))
+        records = records[use]
+        inputs = inputs[use]
+        slot = slot[use]
+        snr = snr[use]
+        if len(records) == 0:
+            self.next_symbol = self.next_symbol + num_slots*length
+            return
+
+        # The strongest record of each receiver in each slot.
+        order = np.lexsort((-snr, inputs, slot))
+        first = order[np.concatenate(([True], (np.diff(slot[order]) != 0) | (np.diff(inputs[order]) != 0)))]
+        self.dropped_count += len(records) - len(first)
+        records = records[first]
+        slot = slot[first]
+        snr = snr[first]
+
+        # Move the timeline onto the strongest receiver's symbols, for the next call.
+        best = np.argmax(snr)
+        self.next_symbol = int(records["sample"][best]) + (num_slots - slot[best])*length
+
+        (slots, group) = np.unique(slot, return_inverse = True)
+        num_symbols = len(slots)
+
+        # Normalise each receiver's magnitudes, then weight them.
+        tones = records["tones"].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tones = np.nan_to_num(tones/np.sum(tones, axis=1)[:,np.newaxis])
+        weights = snr if self.mode == "mrc" else np.ones(len(records))
+        combined = np.zeros((num_symbols, tones.shape[1]))
+        np.add.at(combined, group, tones*weights[:,np.newaxis])
+
+        # The strongest receiver in each symbol supplies its sample count and timing.
+        strongest = np.lexsort((-snr, group))
+        strongest = strongest[np.concatenate(([0], np.nonzero(np.diff(group[strongest]))[0] + 1))]
+
+        # MRC adds up the SNR (as power) of the receivers.
+        power = np.zeros(num_symbols)
+        np.add.at(power, group, snr**2)
+        power_instant = np.zeros(num_symbols)
+        np.add.at(power_instant, group, 10**(records["s2n_instant"].astype(np.float64)/10))
+
+        symbols = np.zeros(num_symbols, dtype=symbol_dtype(int(np.log2(tones.shape[1])) if self.soft_bits else 0))
+        symbols["symbol"] = hard_decode_tones(combined)
+        symbols["sample"] = records["sample"][strongest]
+        with np.errstate(divide='ignore'):
+            symbols["s2n"] = 10*np.log10(power)
+            symbols["s2n_instant"] = 10*np.log10(power_instant)
+        symbols["timing"] = records["timing"][strongest]
+        if self.soft_bits:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                symbols["soft"] = soft_decode_tones(combined, self.gray_coded)
+
+        self.symbol_count += num_symbols
+        self.input_count += len(records)
+
+        if self.block_callback != False:
+            self.block_callback(symbols)
+
+
+# Test script. Three receivers hear the test file, each with its own noise, and its own slow fading, so at any
+# time at least one of them is in a deep fade. Compare the packets decoded by each receiver alone, and combined.
+if __name__ == "__main__":
+    import MFSKDemodulator, DePacketizer, time
+    from FileSource import FileSource
+
+    source = FileSource('generated_MFSK16_packets.wav')
+    clean = source.read(source.num_samples)
+    sample_rate = source.sample_rate
+    num_inputs = 3
+
+    t = np.arange(len(clean))/float(sample_rate)
+    rng = np.random.RandomState(0)
+    received = []
+    for n in range(num_inputs):
+        fading = np.abs(np.cos(2*np.pi*0.1*t + n*np.pi/num_inputs))
+        received.append((0.5 + n)*(clean*fading + 0.12*rng.randn(len(clean))))
+
+    def run(mode):
+        """ Packets decoded by each receiver alone, and combined, and the time taken. """
+        payloads = [[] for n in range(num_inputs + 1)]
+        extract = [DePacketizer.DePacketizer(callback = payloads[n].append) for n in range(num_inputs + 1)]
+        def parse(n):
+            return lambda symbols: extract[n].process_data(tones_to_bits(symbols["symbol"], 16))
+
+        combiner = DiversityCombiner(num_inputs, int(sample_rate/15.625), block_callback = parse(num_inputs), mode = mode)
+        demods = [MFSKDemodulator.MFSKDemodulator(sample_rate = sample_rate, block_callback = parse(n),
+            tone_callback = combiner.input_callback(n)) for n in range(num_inputs)]
+
+        start = time.time()
+        for chunk_start in range(0, len(clean), 1024):
+            for n in range(num_inputs):
+                demods[n].consume(received[n][chunk_start:chunk_start + 1024])
+        combiner.flush()
+        return ([len(x) for x in payloads], time.time() - start, combiner)
+
+    for mode in ["mrc", "egc"]:
+        (counts, elapsed, combiner) = run(mode)
+        print "%s: receivers alone decoded %s packets, combined %d. %d symbols from %d receiver symbols, %.2f s." % (mode, counts[:-1],
+            counts[-1], combiner.symbol_count, combiner.input_count, elapsed)
+
+    # Alignment. Receiver 0 is locked on to the signal. Receivers 1 and 2 are in a fade, and are putting out noise:
+    # one half a symbol out from receiver 0, the other at irregular times. Every one of receiver 0's symbols must
+    # come out, once.
+    length = int(sample_rate/15.625)
+    num_symbols = 500
+    sent = rng.randint(0, 16, num_symbols)
+    def make_records(samples, s2n, symbols = None):
+        records = np.zeros(len(samples), dtype=capture_dtype(16))
+        records["sample"] = samples
+        records["s2n"] = s2n
+        records["timing"] = "F"
+        records["tones"] = rng.rand(len(samples), 16)
+        if symbols is not None:
+            records["tones"][np.arange(len(samples)), symbols] += 4.0
+        return records
+    grid = 1000 + length*np.arange(num_symbols)
+    irregular = 1000 + np.cumsum(rng.randint(length//3, 3*length//2, 2*num_symbols))
+    inputs = [make_records(grid, 20.0, sent), make_records(grid[:-1] + length//2, -10.0), make_records(irregular[irregular <= grid[-1]], -10.0)]
+    for mode in ["mrc", "egc"]:
+        output = []
+        combiner = DiversityCombiner(num_inputs, length, block_callback = output.append, mode = mode)
+        # The receivers are fed in step, as their demodulators would be, in a random order each time.
+        for end in range(0, grid[-1] + 4*length, 3000):
+            for n in rng.permutation(num_inputs):
+                samples = inputs[n]["sample"]
+                combiner.process(n, inputs[n][(samples >= end - 3000) & (samples < end)])
+        combiner.flush()
+        output = np.concatenate(output)
+        assert np.array_equal(output["symbol"], sent), mode
+        print "%s alignment: %d/%d symbols, %d noise symbols dropped." % (mode, len(output), num_symbols, combiner.dropped_count)
+
+    # The combiner's share of the time.
+    records = []
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate = sample_rate, tone_callback = records.append)
+    demod.consume(received[0])
+    records = np.concatenate(records)
+    combiner = DiversityCombiner(num_inputs, int(sample_rate/15.625))
+    start = time.time()
+    for n in range(num_inputs):
+        combiner.process(n, records)
+    combiner.flush()
+    print "Combining %d receivers' symbols took %.1f ms." % (num_inputs, (time.time() - start)*1e3)
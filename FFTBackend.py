@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# FFTBackend.py - FFT functions, using the fastest library available.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Drop-in replacements for numpy.fft.fft, ifft and rfft, used by the demodulators.
+
+Backends, in order of preference:
+pyfftw:     FFTW, via pyFFTW (if installed). A plan, with its own aligned input and output buffers, is built for
+            each new transform shape and kept for re-use, so the small same-size frames the demodulators work on
+            are only planned once. Plans are kept per thread.
+scipy:      scipy.fft (SciPy 1.4 and later).
+numpy:      numpy.fft. Always available.
+
+Transforms of more than one frame (i.e. batched transforms) are split across (workers) threads, which defaults
+to the number of CPUs. The pyfftw and scipy backends support this; numpy runs on one thread.
+
+The active backend is in FFTBackend.backend, and can be changed with set_backend(). Until the first transform
+(or set_backend() call) it is None, and the optional backends have not been imported.
+"""
+
+import numpy as np
+import multiprocessing, threading, logging
+
+# The optional backends are only imported when they are first looked for (by available_backends()), so
+# importing this module doesn't pull in pyFFTW or SciPy.
+pyfftw = None
+scipy_fft = None
+_probed = False
+
+# None until the first transform (or set_backend() call), which selects the most preferred available backend.
+backend = None
+workers = 1
+
+# Maximum number of pyFFTW plans kept per thread. The batched transforms change shape with the chunk size.
+max_plans = 64
+_local = threading.local()
+
+
+def _probe():
+    global pyfftw, scipy_fft, _probed
+    if _probed:
+        return
+    _probed = True
+
+    try:
+        import pyfftw
+        import pyfftw.builders
+    except ImportError:
+        pyfftw = None
+
+    try:
+        import scipy.fft as scipy_fft
+    except ImportError:
+        scipy_fft = None
+
+def available_backends():
+    """
+    List the backends which can be used, most preferred first.
+    """
+    _probe()
+    backends = []
+    if pyfftw != None:
+        backends.append("pyfftw")
+    if scipy_fft != None:
+        backends.append("scipy")
+    backends.append("numpy")
+    return backends
+
+def set_backend(name = None, num_workers = None):
+    """
+    Select the FFT backend ("pyfftw", "scipy" or "numpy"), or the most preferred available if name is None.
+    num_workers sets the number of threads used for batched transforms (defaults to the number of CPUs).
+    """
+    global backend, workers
+
+    if name == None:
+        name = available_backends()[0]
+    elif name not in available_backends():
+        raise ValueError("FFT backend '%s' is not available. Available backends: %s" % (name, ", ".join(available_backends())))
+
+    backend = name
+    if backend == "numpy":
+        workers = 1
+    else:
+        workers = num_workers if num_workers != None else multiprocessing.cpu_count()
+    _local.plans = {}
+    logging.debug("FFT backend: %s" % describe())
+
+def describe():
+    """
+    A short description of the active backend, e.g. 'scipy (4 workers)'.
+    """
+    if backend == None:
+        set_backend()
+    return "%s (%d worker%s)" % (backend, workers, "" if workers == 1 else "s")
+
+def _threads(a, axis):
+    # Only split batched transforms. A single small frame is quicker on one thread.
+    return workers if np.ndim(a) > 1 and np.size(a) > np.shape(a)[axis] else 1
+
+def _pyfftw_plan(kind, a, n, axis):
+    """
+    Get (or build) a pyFFTW plan for this transform. Each plan holds aligned input/output buffers which are
+    re-used on every call.
+    """
+    plans = getattr(_local, 'plans', None)
+    if plans == None:
+        plans = _local.plans = {}
+
+    key = (kind, a.shape, a.dtype.str, n, axis)
+    plan = plans.get(key)
+    if plan is None:
+        if len(plans) >= max_plans:
+            plans.clear()
+        plan = getattr(pyfftw.builders, kind)(pyfftw.empty_aligned(a.shape, dtype=a.dtype), n=n, axis=axis,
+            threads=_threads(a, axis), planner_effort='FFTW_MEASURE')
+        plans[key] = plan
+    return plan
+
+def _transform(kind, a, n, axis):
+    if backend == None:
+        set_backend()
+
+    if backend == "pyfftw":
+        a = np.asarray(a)
+        # The plan copies the input into its own buffer, and returns its output buffer, which the next call overwrites.
+        return _pyfftw_plan(kind, a, n, axis)(a).copy()
+    elif backend == "scipy":
+        return getattr(scipy_fft, kind)(a, n=n, axis=axis, workers=_threads(a, axis))
+    else:
+        return getattr(np.fft, kind)(a, n=n, axis=axis)
+
+def fft(a, n = None, axis = -1):
+    """ As numpy.fft.fft """
+    return _transform("fft", a, n, axis)
+
+def ifft(a, n = None, axis = -1):
+    """ As numpy.fft.ifft """
+    return _transform("ifft", a, n, axis)
+
+def rfft(a, n = None, axis = -1):
+    """ As numpy.fft.rfft """
+    return _transform("rfft", a, n, axis)
+
+
+# Test script.
+if __name__ == "__main__":
+    import time
+
+    print "Available backends: %s" % ", ".join(available_backends())
+
+    frames = np.random.randn(256, 512) + 1j*np.random.randn(256, 512)
+    reference = np.fft.fft(frames, axis=1)
+
+    for name in available_backends():
+        set_backend(name)
+        assert np.allclose(fft(frames, axis=1), reference)
+        assert np.allclose(ifft(fft(frames[0])), frames[0])
+        assert np.allclose(rfft(frames.real, n=1024, axis=1), np.fft.rfft(frames.real, n=1024, axis=1))
+
+        # Single frames, as in MFSKDemodulator.symbol_detect()
+        start = time.time()
+        for i in range(2000):
+            fft(frames[i % 256])
+        single_time = time.time() - start
+
+        # Batched frames, as in MFSKMultiDemodulator and MFSKChannelizer.
+        start = time.time()
+        for i in range(20):
+            fft(frames, axis=1)
+        batch_time = time.time() - start
+
+        print "%s: %.1f us per single 512 point FFT, %.2f ms per batch of 256." % (describe(), single_time/2000*1e6, batch_time/20*1e3)
+
+    set_backend()
+    print "Active backend: %s" % describe()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# FileSource.py - Streaming, memory-mapped WAV/raw PCM file source.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from ModemUtils import pcm_to_float
+
+
+class FileSource(object):
+    """ Memory-mapped File Source Class
+
+    Reads a WAV or raw PCM file in fixed size chunks, converted to floating point in the range +-1.0.
+    The file is memory-mapped rather than read in, so only the chunk being converted is ever held in memory,
+    however long the recording is. Iterating over a FileSource yields the chunks, e.g.
+
+        for chunk in FileSource('recording.wav'):
+            demod.consume(chunk)
+
+    filename:       WAV file, or raw (headerless) PCM file if raw_format is given.
+    chunk_size:     Number of samples (per channel) in each chunk.
+    channel:        Channel to read, for multi-channel (e.g. stereo) files.
+    dtype:          Floating point dtype of the output chunks (np.float64 or np.float32).
+    raw_format:     For raw PCM files, the sample format, e.g. np.int16, np.int32, np.float32, or '>i2' for
+                    big-endian. If None, the file is read as a WAV file.
+    sample_rate:    Sample rate (Hz) of a raw PCM file. WAV files use the rate in the file header.
+    num_channels:   Number of interleaved channels in a raw PCM file.
+
+    """
+    def __init__(self, filename, chunk_size = 4096, channel = 0, dtype = np.float64, raw_format = None, sample_rate = 8000, num_channels = 1):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.channel = channel
+        self.dtype = np.dtype(dtype)
+
+        if raw_format == None:
+            # scipy.io is only imported when a WAV file is actually opened.
+            from scipy.io import wavfile
+            self.sample_rate, self.data = wavfile.read(filename, mmap=True)
+        else:
+            self.sample_rate = sample_rate
+            self.data = np.memmap(filename, dtype=raw_format, mode='r')
+            self.data = self.data[:len(self.data) - len(self.data) % num_channels].reshape(-1, num_channels)
+
+        if self.data.ndim == 1:
+            self.data = self.data[:,np.newaxis]
+        self.num_channels = self.data.shape[1]
+        if channel < 0 or channel >= self.num_channels:
+            raise ValueError("Channel %d requested, but %s has %d channel(s)." % (channel, filename, self.num_channels))
+
+        self.num_samples = self.data.shape[0]
+        self.duration = self.num_samples/float(self.sample_rate)
+        self.position = 0 # Next sample to be read.
+
+    def read(self, num_samples = None):
+        """
+        Read and convert the next (num_samples) samples (default chunk_size) of the selected channel.
+        Returns an empty array at the end of the file.
+        """
+        if num_samples == None:
+            num_samples = self.chunk_size
+        chunk = self.data[self.position:self.position + num_samples, self.channel]
+        self.position = self.position + len(chunk)
+        return pcm_to_float(chunk, self.dtype)
+
+    def seek(self, sample):
+        """ Move the read position to the given sample. """
+        self.position = min(max(0, int(sample)), self.num_samples)
+
+    def __iter__(self):
+        while self.position < self.num_samples:
+            yield self.read()
+
+
+# Test script.
+if __name__ == "__main__":
+    import os, tempfile
+    from scipy.io import wavfile
+
+    # A stereo int16 WAV file, with a different ramp in each channel.
+    ramp = np.arange(-2**15, 2**15, 7, dtype=np.int16)
+    stereo = np.column_stack((ramp, -1 - ramp))
+    filename = os.path.join(tempfile.gettempdir(), 'filesource_test.wav')
+    wavfile.write(filename, 48000, stereo)
+
+    for channel in [0, 1]:
+        source = FileSource(filename, chunk_size = 1000, channel = channel)
+        chunks = list(source)
+        data = np.concatenate(chunks)
+        assert source.sample_rate == 48000 and len(chunks) == int(np.ceil(len(ramp)/1000.0))
+        assert np.array_equal(data, stereo[:,channel]/2.0**15)
+        print "Channel %d: %d chunks, range %.5f to %.5f" % (channel, len(chunks), data.min(), data.max())
+
+    # The same samples as raw int32 PCM.
+    (stereo.astype(np.int32) << 16).tofile(filename)
+    source = FileSource(filename, chunk_size = 1000, channel = 1, dtype = np.float32, raw_format = np.int32, num_channels = 2)
+    data = np.concatenate(list(source))
+    assert data.dtype == np.float32 and np.array_equal(data, (stereo[:,1]/2.0**15).astype(np.float32))
+    print "Raw int32: %d samples, %.2f seconds." % (len(data), source.duration)
+
+    del source
+    os.remove(filename)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# MFSKBurstReceiver.py - Preamble-triggered MFSK burst receiver.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct, crc16, logging
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from ModemUtils import *
+import FFTBackend
+
+
+class MFSKBurstReceiver(object):
+    """ Preamble-triggered MFSK Burst Receiver Class
+
+    Instead of estimating symbol timing continuously, this receiver searches for the two-tone alternating
+    preamble sent at the start of each burst (as in gen_test_packets.py), using a matched filter over the
+    tone energy track. The preamble gives symbol timing and frequency, after which the rest of the burst is
+    demodulated with exactly one tone-bin evaluation per symbol, until the packet (or packets) it contains
+    have been received. Packets use the same format as Packetizer/DePacketizer.
+
+    sample_rate:    Sample rate of incoming data (Hz)
+    base_freq:      The nominal frequency of the lowest MFSK tone (Hz)
+    symbol_rate:    Symbol rate of the MFSK modulation (baud)
+    num_tones:      Number of tones in use. Tone spacing is assumed to be orthogonal (equal to the symbol rate).
+    preamble:       The preamble, as a list of tones. It must alternate between two tones.
+    callback:       Function pointer. Payloads of packets which pass their CRC check are passed to this function.
+    max_offset:     How far (in tones) either side of base_freq to search for the preamble.
+    threshold:      Normalised preamble correlation required to trigger (0-1).
+
+    """
+    def __init__(self, sample_rate=8000, base_freq=1500, symbol_rate=15.625, num_tones = 16, preamble = [0,15]*15,
+            sync_bytes = '\xAB\xCD', payload_length_cap = 32, callback = False, gray_coded = True, max_offset = 4, threshold = 0.5):
+        self.fs = sample_rate
+        self.base_freq = base_freq
+        self.symbol_rate = symbol_rate
+        self.num_tones = num_tones
+        self.sync_bytes = sync_bytes
+        self.sync_length = len(sync_bytes)*8
+        self.payload_length_cap = payload_length_cap
+        self.callback = callback
+        self.gray_coded = gray_coded
+        self.max_offset = max_offset
+        self.threshold = threshold
+
+        self.sym_bits = int(np.log2(self.num_tones))
+        self.symbol_length = int(round(self.fs/self.symbol_rate))
+        self.tone_zero = int(round(self.base_freq/self.symbol_rate))
+
+        # Preamble template: +1 for symbols on the first preamble tone, -1 for the second.
+        self.preamble = np.array(preamble)
+        self.preamble_tones = (self.preamble[0], self.preamble[1])
+        self.preamble_sign = np.where(self.preamble == self.preamble_tones[0], 1.0, -1.0)
+
+        # The tone energy track is evaluated every (hop) samples while searching.
+        self.hop = max(1, self.symbol_length//16)
+        self.hops_per_symbol = self.symbol_length//self.hop
+        self.search_bins = self.tone_zero - self.max_offset + np.arange(self.num_tones + 2*self.max_offset)
+
+        self.state = "SEARCH" # "SEARCH" for the preamble, or "DECODE" symbols once locked.
+        self.buffer = np.array([])
+        self.buffer_start = 0 # Sample number of the first sample in the buffer.
+
+        self.reset_search(0)
+
+    def reset_search(self, sample):
+        """
+        Start searching for a preamble from the given sample onwards.
+        """
+        self.state = "SEARCH"
+        self.track = np.zeros((0, len(self.search_bins))) # Tone energies, one row per hop.
+        self.track_start = sample # Sample at which the first frame in the track starts.
+        self.search_pos = 0 # Next track index at which to evaluate the preamble correlation.
+        self.trigger_pos = None # Track index at which the correlation first crossed the threshold.
+        self.trim_buffer(sample)
+
+    def trim_buffer(self, sample):
+        """ Discard buffered samples before the given sample. """
+        if sample > self.buffer_start:
+            self.buffer = self.buffer[sample - self.buffer_start:]
+            self.buffer_start = sample
+
+    def consume(self, data):
+        """
+        Consumes incoming data samples, searching for preambles and decoding bursts.
+        """
+        self.buffer = np.append(self.buffer, data)
+
+        progress = True
+        while progress:
+            if self.state == "SEARCH":
+                progress = self.search()
+            else:
+                progress = self.decode()
+
+    def search(self):
+        """
+        Extend the tone energy track with any new data, and run the preamble matched filter over it.
+        Returns True if a preamble was found.
+        """
+        # Add frames for every hop that now has a full symbol of data.
+        first = self.track_start + len(self.track)*self.hop - self.buffer_start
+        num_frames = (len(self.buffer) - first - self.symbol_length)//self.hop + 1
+        if num_frames > 0:
+            data = self.buffer[first:]
+            frames = as_strided(data, shape=(num_frames, self.symbol_length), strides=(data.strides[0]*self.hop, data.strides[0]))
+            energy = np.absolute(FFTBackend.fft(frames, axis=1)[:,self.search_bins])
+            self.track = np.vstack((self.track, energy))
+
+        # Matched filter against the preamble, for every track position which covers a full preamble.
+        span = (len(self.preamble) - 1)*self.hops_per_symbol
+        end = len(self.track) - span
+        if end <= self.search_pos:
+            return False
+
+        if self.trigger_pos == None:
+            positions = np.arange(self.search_pos, end)
+            correlation, energy = self.preamble_correlation(positions)
+            metric = np.max(correlation, axis=1)/energy
+
+            above = np.nonzero(metric >= self.threshold)[0]
+            if len(above) == 0:
+                # Nothing here. Drop everything that can't be part of a future preamble.
+                self.search_pos = end
+                self.drop_track(end)
+                return False
+            self.trigger_pos = positions[above[0]]
+
+        # The correlation keeps rising while more of the preamble comes into view, so wait until a full
+        # preamble length past the trigger point has been evaluated, then take the peak.
+        self.search_pos = end
+        peak_end = self.trigger_pos + len(self.preamble)*self.hops_per_symbol
+        if end < peak_end:
+            return False
+
+        candidates = np.arange(self.trigger_pos, peak_end)
+        correlation, energy = self.preamble_correlation(candidates)
+        peak, offset = np.unravel_index(np.argmax(correlation), correlation.shape)
+        self.lock(candidates[peak], offset)
+
+        return True
+
+    def preamble_correlation(self, positions):
+        """
+        Correlate the tone energy track against the preamble template, for preambles starting at each of the given
+        track positions. Returns the correlation for each position and frequency offset (in bins), and the total
+        tone energy covered by each position.
+        """
+        width = 2*self.max_offset + 1
+        first = self.preamble_tones[0]
+        second = self.preamble_tones[1]
+        total = np.sum(self.track, axis=1)
+
+        correlation = 0
+        energy = 0
+        for k in range(len(self.preamble)):
+            rows = self.track[positions + k*self.hops_per_symbol]
+            correlation = correlation + self.preamble_sign[k]*(rows[:,first:first + width] - rows[:,second:second + width])
+            energy = energy + total[positions + k*self.hops_per_symbol]
+
+        return correlation, energy
+
+    def drop_track(self, index):
+        """ Drop track frames before the given index. """
+        self.track = self.track[index:]
+        self.track_start = self.track_start + index*self.hop
+        self.search_pos = self.search_pos - index
+        self.trim_buffer(self.track_start)
+
+    def lock(self, position, offset):
+        """
+        Lock symbol timing and frequency to a preamble starting at the given track position, with the given bin offset.
+        """
+        # Fine frequency, from a parabolic fit to the first preamble tone, averaged over the preamble.
+        rows = self.track[position + np.nonzero(self.preamble_sign > 0)[0]*self.hops_per_symbol]
+        peak_bin = self.preamble_tones[0] + offset
+        spectrum = np.mean(rows, axis=0)
+        fine = 0.0
+        if peak_bin > 0 and peak_bin < len(spectrum) - 1:
+            a, b, c = spectrum[peak_bin - 1:peak_bin + 2]
+            if (a - 2*b + c) != 0:
+                fine = 0.5*(a - c)/(a - 2*b + c)
+
+        self.lock_freq = (self.tone_zero + offset - self.max_offset + fine)*self.symbol_rate
+        start = self.track_start + position*self.hop
+        logging.debug("Preamble found at sample %d, tone zero at %.2f Hz." % (start, self.lock_freq))
+
+        # One DFT per symbol, evaluated only at the tone frequencies.
+        tone_freqs = self.lock_freq + np.arange(self.num_tones)*self.symbol_rate
+        self.tone_dft = np.exp(-2j*np.pi*np.arange(self.symbol_length)[:,np.newaxis]*tone_freqs/self.fs)
+
+        self.state = "DECODE"
+        self.next_symbol = start + len(self.preamble)*self.symbol_length
+        self.bits = np.array([], dtype=np.uint8)
+        self.packet_bits = self.sync_length + 16 # Number of bits needed before anything more can be checked.
+        self.trim_buffer(self.next_symbol)
+
+    def decode(self):
+        """
+        Demodulate as many symbols as are needed (and available) for the current packet, then check it.
+        Returns True if any progress was made.
+        """
+        needed = int(np.ceil((self.packet_bits - len(self.bits))/float(self.sym_bits)))
+        if needed > 0:
+            available = (self.buffer_start + len(self.buffer) - self.next_symbol)//self.symbol_length
+            count = min(needed, available)
+            if count <= 0:
+                return False
+
+            data = self.buffer[self.next_symbol - self.buffer_start:]
+            windows = as_strided(data, shape=(count, self.symbol_length), strides=(data.strides[0]*self.symbol_length, data.strides[0]))
+            tones = np.argmax(np.absolute(windows.dot(self.tone_dft)), axis=1)
+            if self.gray_coded:
+                tones = gray_decode(tones)
+            bits = ((tones[:,np.newaxis] >> np.arange(self.sym_bits - 1, -1, -1)) & 1).astype(np.uint8)
+            self.bits = np.append(self.bits, bits.ravel())
+
+            self.next_symbol = self.next_symbol + count*self.symbol_length
+            self.trim_buffer(self.next_symbol)
+            if count < needed:
+                return False
+
+        self.check_packet()
+        return True
+
+    def check_packet(self):
+        """
+        Test the received bits against the packet format.
+        """
+        if np.packbits(self.bits[:self.sync_length]).tostring() != self.sync_bytes:
+            logging.debug("No sync header. End of burst.")
+            self.reset_search(self.next_symbol)
+            return
+
+        packet_flags = struct.unpack(">H", np.packbits(self.bits[self.sync_length:self.sync_length + 16]).tostring())[0]
+        packet_length = packet_flags & 0x03FF
+        if packet_length > self.payload_length_cap:
+            logging.debug("Packet length bigger than cap.")
+            self.reset_search(self.next_symbol)
+            return
+
+        total_bits = self.sync_length + 16 + packet_length*8 + 16
+        if len(self.bits) < total_bits:
+            # Now we know how long the packet is, go and get the rest of it.
+            self.packet_bits = total_bits
+            return
+
+        packet_string = np.packbits(self.bits[:total_bits]).tostring()
+        calc_crc = crc16.crc16_buff(packet_string[len(self.sync_bytes):-2])
+        packet_crc = struct.unpack(">H", packet_string[-2:])[0]
+
+        if packet_crc != calc_crc:
+            logging.debug("CRC Check failed.")
+            self.reset_search(self.next_symbol)
+            return
+
+        payload = packet_string[len(self.sync_bytes) + 2:-2]
+        logging.info("Found complete packet: " + payload)
+        if self.callback != False:
+            self.callback(payload)
+
+        # Another packet may follow straight on in the same burst.
+        self.bits = self.bits[total_bits:]
+        self.packet_bits = self.sync_length + 16
+
+
+# Test script.
+if __name__ == "__main__":
+    from scipy.io import wavfile
+    import time
+
+    def print_payload(payload):
+        print payload
+
+    fs, data = wavfile.read('generated_MFSK16_packets.wav')
+
+    if(data.dtype == np.int16):
+        data = data.astype(np.float)/2**15
+    elif(data.dtype == np.int32):
+        data = data.astype(np.float)/2**31
+
+    receiver = MFSKBurstReceiver(sample_rate = fs, callback = print_payload)
+
+    start = time.time()
+    chunk_size = 1024
+    for i in range(0, len(data), chunk_size):
+        receiver.consume(data[i:i+chunk_size])
+    print "Processed %.1f seconds of audio in %.2f seconds." % (len(data)/float(fs), time.time() - start)
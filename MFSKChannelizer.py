@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# MFSKChannelizer.py - FFT Channelizer, feeding many MFSK Demodulators from one wideband input.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from MFSKDemodulator import MFSKDemodulator
+from ModemUtils import *
+import FFTBackend
+
+
+class MFSKChannel(object):
+    """ A single sub-band of the channelizer, and the demodulator attached to it. """
+    def __init__(self, first_bin, residual_freq, demod):
+        self.first_bin = first_bin          # Wideband FFT bin which maps to DC in the sub-band.
+        self.residual_freq = residual_freq  # Fine frequency shift applied after decimation (Hz)
+        self.nco_phase = 0                  # Output sample counter for the fine frequency shift.
+        self.demod = demod
+
+
+class MFSKChannelizer(object):
+    """ FFT (overlap-save) Channelizer Class
+
+    Splits a wideband input into decimated complex sub-bands, using one forward FFT per block of input,
+    and a small inverse FFT per monitored channel. Each sub-band is passed to its own MFSKDemodulator,
+    running at the decimated sample rate.
+
+    sample_rate:    Sample rate of incoming data (Hz)
+    symbol_rate:    Symbol rate of the monitored MFSK signals (baud)
+    num_tones:      Number of tones in the monitored MFSK signals.
+    channel_rate:   Sample rate of each sub-band (Hz). If None, the lowest rate which holds the signal with
+                    some margin, and is an integer multiple of the symbol rate, is chosen.
+    fft_length:     Length of the wideband FFT. If None, chosen so the FFT bin spacing is at most 1/4 of the symbol rate.
+    dtype:          Real dtype of the input buffer (np.float64 or np.float32). Also the default dtype of the
+                    channel demodulators.
+
+    """
+    def __init__(self, sample_rate=48000, symbol_rate=15.625, num_tones = 16, channel_rate = None, fft_length = None, dtype = np.float64):
+        self.fs = sample_rate
+        self.symbol_rate = symbol_rate
+        self.num_tones = num_tones
+        self.bandwidth = num_tones*symbol_rate
+        self.dtype = np.dtype(dtype)
+
+        if channel_rate == None:
+            self.decimation = select_decimation(self.fs, self.symbol_rate, 2*self.bandwidth)
+        else:
+            self.decimation = int(round(self.fs/float(channel_rate)))
+        self.channel_rate = self.fs/float(self.decimation)
+
+        # Number of wideband FFT bins handed to each channel. This is the length of the inverse FFTs.
+        if fft_length == None:
+            self.channel_bins = max(16, int(2**np.ceil(np.log2(4*self.channel_rate/self.symbol_rate))))
+        else:
+            self.channel_bins = fft_length//self.decimation
+        self.fft_length = self.channel_bins*self.decimation
+        self.bin_spacing = self.fs/float(self.fft_length)
+        # 50% overlap-save.
+        self.hop = self.fft_length//2
+        self.block_count = 0
+
+        # Input samples from previous calls still needed for the next FFT.
+        self.buffer = np.zeros(self.fft_length - self.hop, dtype=self.dtype)
+
+        # Channel filter: flat over the signal (centred in the sub-band), raised-cosine roll-off out to the sub-band edges.
+        offset = np.absolute(np.arange(self.channel_bins) - self.channel_bins//2)*self.bin_spacing
+        flat = self.bandwidth/2 + self.symbol_rate
+        edge = self.channel_rate/2
+        rolloff = np.clip((offset - flat)/(edge - flat), 0, 1)
+        self.channel_filter = 0.5 + 0.5*np.cos(np.pi*rolloff)
+
+        self.channels = []
+
+    def add_channel(self, base_freq, **kwargs):
+        """
+        Start monitoring an MFSK signal with its lowest tone at base_freq (Hz).
+        Any extra keyword arguments (callback, block_callback, etc) are passed to the MFSKDemodulator.
+        Sample counts reported by the demodulator are at the channel rate; multiply by the decimation to
+        get the corresponding input sample.
+
+        Returns the MFSKDemodulator instance attached to this channel.
+        """
+        # Place the wideband bins so that the signal is centred in the sub-band.
+        centre_freq = base_freq + (self.num_tones - 1)*self.symbol_rate/2.0
+        first_bin = int(round(centre_freq/self.bin_spacing)) - self.channel_bins//2
+        channel_base_freq = base_freq - first_bin*self.bin_spacing
+
+        # Shift the signal the rest of the way, so the demodulator tones land exactly on its FFT bins.
+        demod_base_freq = round(channel_base_freq/self.symbol_rate)*self.symbol_rate
+
+        if 'block_length' not in kwargs:
+            # Keep the same timing resolution (relative to the symbol length) as a full-rate demodulator.
+            kwargs['block_length'] = max(1, int(round(self.channel_rate/self.symbol_rate))//32)
+        kwargs.setdefault('dtype', self.dtype)
+
+        demod = MFSKDemodulator(sample_rate=self.channel_rate, base_freq=demod_base_freq, symbol_rate=self.symbol_rate, num_tones=self.num_tones, **kwargs)
+        self.channels.append(MFSKChannel(first_bin, channel_base_freq - demod_base_freq, demod))
+
+        return demod
+
+    def consume(self, data):
+        """
+        Consumes incoming (real or complex) wideband samples, and passes each sub-band onto its demodulator.
+        """
+        data = np.append(self.buffer, np.asarray(data, dtype=complex_dtype(self.dtype) if np.iscomplexobj(data) else self.dtype))
+        num_blocks = (len(data) - (self.fft_length - self.hop))//self.hop
+        if num_blocks <= 0:
+            self.buffer = data
+            return
+
+        # Overlapping FFT frames, one per hop.
+        frames = as_strided(data, shape=(num_blocks, self.fft_length), strides=(data.strides[0]*self.hop, data.strides[0]))
+        spectra = FFTBackend.fft(frames, axis=1)
+        self.buffer = data[num_blocks*self.hop:].copy()
+
+        block_index = self.block_count + np.arange(num_blocks)
+        self.block_count = self.block_count + num_blocks
+        keep = self.hop//self.decimation
+
+        for channel in self.channels:
+            bins = (channel.first_bin + np.arange(self.channel_bins)) % self.fft_length
+            subband = FFTBackend.ifft(spectra[:,bins]*self.channel_filter, axis=1)[:,-keep:]/self.decimation
+
+            # Each block starts (hop) samples later, so undo the phase rotation this causes in the frequency shifted output.
+            subband = subband*np.exp(-2j*np.pi*channel.first_bin*self.hop*block_index/float(self.fft_length))[:,np.newaxis]
+            subband = subband.ravel()
+
+            # Fine frequency shift.
+            if channel.residual_freq != 0:
+                n = np.arange(channel.nco_phase, channel.nco_phase + len(subband))
+                subband = subband*np.exp(-2j*np.pi*(channel.residual_freq/self.channel_rate)*n)
+            channel.nco_phase = channel.nco_phase + len(subband)
+
+            channel.demod.consume(subband)
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKModulator, Packetizer, DePacketizer, MFSKSymbolDecoder, time
+
+    sample_rate = 48000
+    symbol_rate = 15.625
+    num_tones = 16
+    frequencies = [700, 1300.5, 2210]
+
+    # Generate a wideband signal containing several MFSK16 signals, each sending packets.
+    p = Packetizer.Packetizer()
+    signals = []
+    for freq in frequencies:
+        mod = MFSKModulator.MFSKModulator(sample_rate=sample_rate, symbol_rate=symbol_rate, tone_spacing=symbol_rate, start_silence=3, base_freq=freq, amplitude=0.2)
+        mod.modulate_symbol([0,15]*15)
+        data = p.pack_message("Channel at %.1f Hz" % freq) + p.pack_message("Second packet")
+        mod.modulate_bits(4, np.unpackbits(np.fromstring(data, dtype=np.uint8)))
+        mod.modulate_symbol([0]*20)
+        signals.append(mod.emit_all())
+
+    signal = np.zeros(max([len(x) for x in signals]))
+    for x in signals:
+        signal[:len(x)] += x
+    signal = signal + 0.05*np.random.randn(len(signal))
+
+    def make_payload_printer(freq):
+        def print_payload(payload):
+            print "%.1f Hz: %s" % (freq, payload)
+        return print_payload
+
+    def make_symbol_parser(symb_dec, packet_extract):
+        def parse_symbol(symbols):
+            for symbol in symbols["symbol"]:
+                packet_extract.process_data(symb_dec.tone_to_bits(symbol))
+        return parse_symbol
+
+    channelizer = MFSKChannelizer(sample_rate=sample_rate, symbol_rate=symbol_rate, num_tones=num_tones)
+    print "Channel rate: %.1f Hz (decimation %d), FFT length %d" % (channelizer.channel_rate, channelizer.decimation, channelizer.fft_length)
+    for freq in frequencies:
+        symb_dec = MFSKSymbolDecoder.MFSKSymbolDecoder(num_tones=num_tones, gray_coded=True)
+        packet_extract = DePacketizer.DePacketizer(callback=make_payload_printer(freq))
+        channelizer.add_channel(freq, block_callback=make_symbol_parser(symb_dec, packet_extract))
+
+    start = time.time()
+    chunk_size = 4096
+    for i in range(0, len(signal), chunk_size):
+        channelizer.consume(signal[i:i+chunk_size])
+    print "Processed %.1f seconds of audio in %.2f seconds." % (len(signal)/float(sample_rate), time.time() - start)
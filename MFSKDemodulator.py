@@ -16,12 +16,19 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
-from pylab import *
 import numpy as np
-from scipy.io import wavfile
-from scipy.signal import hilbert
 from ModemUtils import *
-import logging
+from Decimator import Decimator
+from SymbolCapture import SymbolCapture
+import FFTBackend
+import logging, sys, time
+
+# Default watchdog degradation levels, in increasing order of their effect on decoding.
+DEFAULT_WATCHDOG_LEVELS = [{},
+    {"diagnostics": False},
+    {"diagnostics": False, "soft_decode": False},
+    {"diagnostics": False, "soft_decode": False, "block_length": 2},
+    {"diagnostics": False, "soft_decode": False, "block_length": 2, "squelch": 6.0}]
 
 class MFSKDemodulator(object):
     """ MFSK Demodulator Class 
@@ -29,42 +36,119 @@ class MFSKDemodulator(object):
     sample_rate:    Sample rate of incoming data (Hz)
     base_freq:      The frequncy of the lowest MFSK tone (Hz)
     symbol_rate:    Symbol rate of the MFSK modulation (baud)
-    num_tones:      Number of tones in use. Tone spacing is assumed to be orthogonal (equal to the symbol rate).
+    num_tones:      Number of tones in use.
     callback:       Function pointer. A dictionary containing symbol information is passed to this function when
                     a symbol is detected.
+    block_callback: Function pointer. At the end of each call to consume(), a NumPy structured array (see
+                    ModemUtils.symbol_dtype) containing all symbols detected in that chunk is passed to this function.
+    soft_bits:      If True, soft bit values (from soft_decode) are included in the block_callback output.
+    block_length:   How many samples to process at a time. Higher values will increase speed, but reduce accuracy.
+                    Defaults to 16, or 1/32 of a symbol if decimating.
+    decimate:       If True, the input is mixed down and decimated to the lowest sample rate that holds the signal
+                    and is a multiple of the symbol rate, before symbol detection. Reported sample counts are
+                    still in input samples.
+    squelch:        If not None, symbol detection only runs while the strongest tone bin is at least this many dB
+                    above the median tone bin, measured once per symbol period. Timing state is reset when the
+                    squelch opens.
+    tracking:       If True, once symbol timing has been acquired the demodulator switches to a tracking mode, where
+                    tone bins are only evaluated once per symbol (plus an early/late check). It falls back to
+                    acquisition if the SNR or timing confidence drops. The current mode is in timing_mode.
+    afc:            If True, the signal is searched for within +/- afc_range Hz of base_freq, using a long averaged
+                    FFT matched against the tone comb. Once found, a fine AFC loop keeps the tones centred in their
+                    FFT bins, using the phase drift of the detected tone across each symbol. The search keeps
+                    running, and retunes if a clear, unambiguous match is more than half a tone away.
+                    The current frequency offset (Hz) is in freq_offset.
+    afc_range:      Maximum frequency error (Hz) that the AFC will search for, or follow.
+    capture:        If a filename, the tone bin magnitudes, timing and SNR of every symbol are saved to that file
+                    (see SymbolCapture), so the back-end can be re-run later with SymbolReplay. The SymbolCapture
+                    is in the capture attribute.
+    tone_callback:  Function pointer. At the end of each call to consume(), the same per-symbol records as the
+                    capture file (see ModemUtils.capture_dtype) are passed to this function, as a NumPy structured
+                    array. Used by DiversityCombiner.
+    dtype:          Real dtype used for the internal buffers and processing (np.float64 or np.float32). With
+                    np.float32, all sample and tone bin buffers are single precision (complex64), which halves
+                    their memory use. Input is converted to this type.
+    watchdog:       If True, the time spent in each call to consume() is compared with the duration of the audio it
+                    was given. If the demodulator falls behind realtime, it steps up through watchdog_levels,
+                    shedding load, and steps back down once it has caught up. See watchdog_metrics().
+    watchdog_levels: List of degradation levels, each a dictionary of settings, applied in full at that level
+                    (level 0 is normal operation, and the configured settings are restored there). Settings are:
+                    "diagnostics" (False stops the debug logging and dft_phase buffer), "soft_decode" (False
+                    outputs zero soft bits instead of running soft_decode), "block_length" (multiple of the
+                    configured block_length) and "squelch" (threshold in dB, if no squelch is configured).
+                    Defaults to DEFAULT_WATCHDOG_LEVELS.
+    tone_spacing:   Spacing between the tones (Hz). Defaults to the symbol rate (orthogonal tones). If it isn't a
+                    multiple of the symbol rate, the tones don't land on FFT bins, and a DFT at the exact tone
+                    frequencies is used instead.
 
     """
-    def __init__(self, sample_rate=8000, base_freq=1500, symbol_rate=15.625, num_tones = 16, callback = False, gray_coded = True, cheating = False):
+    def __init__(self, sample_rate=8000, base_freq=1500, symbol_rate=15.625, num_tones = 16, callback = False, gray_coded = True, cheating = False, block_callback = False, soft_bits = False, block_length = None, decimate = False, squelch = None, tracking = False, afc = False, afc_range = 50.0, capture = False, dtype = np.float64, watchdog = False, watchdog_levels = None, tone_spacing = None, tone_callback = False):
+        self.input_rate = sample_rate
         self.fs = sample_rate
         self.base_freq = base_freq
         self.symbol_rate = symbol_rate
-        self.tone_spacing = symbol_rate
+        self.tone_spacing = tone_spacing if tone_spacing != None else symbol_rate
         self.num_tones = num_tones
         self.callback = callback
+        self.block_callback = block_callback
+        self.soft_bits = soft_bits
         self.gray_coded = gray_coded
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = complex_dtype(self.dtype)
 
         # Cheating mode! Ignore timing estimation and demodulate whenever n is a multiple of the symbol length
         self.cheating = cheating
 
         #
         self.buffer_size = 4 # Length of the internal buffers used, in symbols.
-        self.block_length = 16 # How many samples to process at a time. Higher values will increase speed, but reduce accuracy.
+        self.decimation = 1
+        self.decimator = False
         self.dft_phase_threshold = 0.01
-        self.mixing_phase = 0 # So we can mix with constant phase.
+        self.mixing_phase = 0.0 # Mixer NCO phase (radians), so we can mix with constant phase.
         self.sample_count = 0 # Internal counter for testing
 
+        if decimate:
+            # Leave the same amount of room either side of the signal as it takes up.
+            bandwidth = self.num_tones*self.tone_spacing
+            self.decimation = select_decimation(self.input_rate, self.symbol_rate, 2*bandwidth)
+
+        if self.decimation > 1:
+            self.fs = self.input_rate/float(self.decimation)
+            # The decimator puts its centre frequency at fs/2. Pick it so the tones also land on FFT bins.
+            self.base_freq = round((self.fs/2 - bandwidth/2)/self.symbol_rate)*self.symbol_rate
+            self.decimator = Decimator(self.input_rate, self.decimation, base_freq - self.base_freq + self.fs/2, bandwidth, dtype = self.dtype)
+
         # Calculate some variables we need.
         self.sym_bits = int(np.log2(self.num_tones))
         self.symbol_length = int(round(self.fs/self.symbol_rate))
+
+        if block_length == None:
+            block_length = 16 if self.decimation == 1 else max(1, self.symbol_length//32)
+        self.block_length = block_length
+        self.nominal_block_length = block_length
         # Calculate how far we need to move the signal to align it over a FFT bin (usually not far)
         self.mixing_freq = round(self.base_freq/self.symbol_rate)*self.symbol_rate - self.base_freq
+        self.nominal_mixing_freq = self.mixing_freq
         # Location of 'tone zero' in the symbol-length FFT.
         self.tone_zero = int(round(self.base_freq/self.symbol_rate))
+        # Positions of the tones, in FFT bins.
+        self.tone_offsets = np.arange(self.num_tones)*(self.tone_spacing/float(self.symbol_rate))
+        self.tone_positions = self.tone_zero + self.tone_offsets
+        if np.allclose(self.tone_offsets, np.round(self.tone_offsets)):
+            self.tone_indices = np.round(self.tone_positions).astype(int)
+            self.tone_kernel = None
+        else:
+            self.tone_indices = None
+            self.tone_kernel = np.exp(-2j*np.pi*self.tone_positions[:,np.newaxis]*np.arange(self.symbol_length)/float(self.symbol_length)).astype(self.complex_dtype)
 
         # Instantiate our local buffers.
-        self.sample_buffer = np.zeros( self.symbol_length*self.buffer_size, dtype=np.complex )
-        self.fft_energy_buffer = np.zeros( (self.num_tones,self.symbol_length*self.buffer_size), dtype=np.complex )
-        self.max_fft_energy_buffer = np.zeros( self.symbol_length*self.buffer_size, dtype=np.float )
+        self.sample_buffer = np.zeros( self.symbol_length*self.buffer_size, dtype=self.complex_dtype )
+        self.fft_energy_buffer = np.zeros( (self.num_tones,self.symbol_length*self.buffer_size), dtype=self.complex_dtype )
+        self.max_fft_energy_buffer = np.zeros( self.symbol_length*self.buffer_size, dtype=self.dtype )
+        # Single-point DFT at (symbol_rate) Hz, applied to max_fft_energy_buffer to find the symbol timing.
+        # If block_length is >1, the fft energy data is effectively downsampled by that factor, and we
+        # compensate for that here.
+        self.timing_dft = self.timing_kernel()
 
         # Symbol storage, for SNR calculations.
         self.symbol_gap = 0
@@ -75,15 +159,88 @@ class MFSKDemodulator(object):
         self.s2n_instant = 0
         self.last_dftphase = 0.0
 
+        # Symbols detected during the current call to consume(), for block_callback.
+        self.symbol_block = []
+        self.symbol_block_dtype = symbol_dtype(self.sym_bits if self.soft_bits else 0)
+
+        # Tone bin magnitudes of the symbols detected during the current call to consume(), for the capture file
+        # and tone_callback.
+        self.capture = False
+        self.capture_block = []
+        self.capture_dtype = capture_dtype(self.num_tones)
+        if capture != False:
+            self.capture = SymbolCapture(capture, self.num_tones)
+        self.tone_callback = tone_callback
+
+        # Samples left over from the last call to consume() which don't make up a full block.
+        self.pending = np.array([], dtype=self.complex_dtype)
+
+        # Acquisition/tracking state.
+        self.tracking = tracking
+        self.timing_mode = "ACQUIRE" # "ACQUIRE" while searching for timing every block, "TRACK" once locked.
+        self.track_lock = 8 # Consecutive zero-crossing detections, one symbol apart, needed before tracking.
+        self.track_s2n = 0.0 # Minimum SNR (dB) to start, or keep, tracking.
+        self.track_step = 0.1 # Accumulated early/late error needed to move the symbol timing by one block.
+        self.track_max_error = 0.2 # Average early/late error above which timing is considered lost.
+        self.track_count = 0
+        self.timing_error = 0.0
+        self.track_error = 0.0
+
+        # Frequency acquisition/AFC state.
+        self.afc = afc
+        self.afc_range = afc_range
+        self.afc_state = "SEARCH" if afc else "OFF" # "SEARCH" while looking for the tone comb, "LOCK" once found.
+        self.afc_search_symbols = 32 # Length of the coarse search, in symbols.
+        self.afc_oversample = 4 # Coarse search FFT bin spacing is symbol_rate/afc_oversample.
+        self.afc_threshold = 2.0 # Comb power above the noise floor (dB) needed to declare the signal found.
+        self.afc_move_threshold = 10.0 # Comb power above the noise floor (dB) needed to move the mixer, once locked.
+        self.afc_tie = 0.97 # Offsets matching at least this fraction of the best comb power are treated as equally good.
+        self.afc_s2n = 10.0 # Minimum ratio (dB) of the detected tone to the mean of the other tones, for a symbol to be used by the fine AFC loop.
+        self.afc_weight = 8 # Decaying average weight of the fine AFC loop.
+        self.afc_level = 0.0 # Most recent coarse search result (dB)
+        self.afc_buffer = np.array([], dtype=self.complex_dtype)
+        self.afc_candidate = None # Offset (Hz) found by the previous search, which the next one must agree with.
+        self.freq_offset = 0.0 # Current estimate of the signal frequency, relative to base_freq (Hz)
+        self.freq_error = 0.0 # Averaged residual frequency error from the fine AFC loop (Hz)
+        self.afc_comb = self.comb_template()
+
+        # Squelch state.
+        self.squelch = squelch
+        self.squelch_hang = 4 # How many symbol periods to stay open after the signal drops below the threshold.
+        self.squelch_open = False
+        self.squelch_level = 0.0 # Most recent squelch measurement (dB)
+        self.squelch_countdown = 0
+        self.squelch_blocks = max(1, self.symbol_length//self.block_length) # Blocks between squelch measurements.
+        self.block_count = 0
+        # The most recent (sample_buffer) samples, so the buffers can be refilled when the squelch opens.
+        self.squelch_history = np.zeros(len(self.sample_buffer), dtype=self.complex_dtype)
+
         # and some debugging buffers
+        self.diagnostics = True
         self.dft_phase = np.array([])
 
+        # Realtime watchdog state.
+        self.watchdog = watchdog
+        self.watchdog_levels = watchdog_levels if watchdog_levels != None else DEFAULT_WATCHDOG_LEVELS
+        self.watchdog_level = 0
+        self.watchdog_weight = 8 # Decaying average weight of the load measurement, in calls to consume().
+        self.watchdog_max_backlog = 1.0 # Backlog (s) above which the next level is used, even if the load is below 1.
+        self.watchdog_recover = 0.5 # Load below which (with no backlog) the previous level is used.
+        self.watchdog_hold = 2.0 # Minimum time (s of audio) between level changes, so the load can settle.
+        self.watchdog_held = 0.0
+        self.load = 0.0 # Processing time as a fraction of the audio duration, averaged.
+        self.backlog = 0.0 # How far behind realtime (s) processing has fallen, if audio arrives in realtime.
+        self.level_changes = 0
+        self.nominal_squelch = squelch
+        self.use_soft_decode = True
+
 
     def consume(self,data):
         """
         Consumes incoming data samples, mixes such that the data aligns over a FFT bin then passes it onto the symbol tracker.
 
-        data: Numpy float array. Preferably 2^n samples long, but doesn't matter so much.
+        data: Numpy float (or complex) array. Preferably 2^n samples long, but doesn't matter so much.
+              Samples that don't fill a whole block are held over until the next call.
         """
 
         # Type checking
@@ -92,9 +249,26 @@ class MFSKDemodulator(object):
         # We don't actually need to do this.
         #data = hilbert(data)
 
+        if np.iscomplexobj(data):
+            data = np.asarray(data, dtype=self.complex_dtype)
+        else:
+            data = np.asarray(data, dtype=self.dtype)
+
+        # Processing time, and the duration of the audio, for the watchdog.
+        start = time.time()
+        duration = len(data)/float(self.input_rate)
+
+        if self.decimator != False:
+            data = self.decimator.process(data)
+
         # Mix the signal so that it lines up with a FFT bin.
-        data = data*hilbert(np.cos(2.0*np.pi*(self.mixing_freq/self.fs)*np.arange(self.mixing_phase,self.mixing_phase+data.size)))
-        self.mixing_phase = self.mixing_phase + len(data)
+        if self.mixing_freq != 0:
+            step = 2.0*np.pi*(self.mixing_freq/self.fs)
+            data = data*np.exp(1j*(self.mixing_phase + step*np.arange(len(data))).astype(self.dtype))
+            self.mixing_phase = (self.mixing_phase + step*len(data)) % (2*np.pi)
+
+        if self.afc:
+            self.frequency_search(data)
 
         # Feed data to symbol_detector, 1 sample at a time.
         # TODO: Make the symbol_detect function process more than on sample at a time.
@@ -102,18 +276,379 @@ class MFSKDemodulator(object):
         #for sample in data:
         #    self.symbol_detect(sample)
 
-        data = np.reshape(data,(-1,self.block_length))
+        data = np.append(self.pending, data)
+        usable = (len(data)//self.block_length)*self.block_length
+        self.pending = data[usable:]
+
+        data = np.reshape(data[:usable],(-1,self.block_length))
+
+        if self.squelch == None:
+            for block in data:
+                self.symbol_detect(block)
+        else:
+            self.squelched_detect(data)
+
+        if self.block_callback != False and len(self.symbol_block) > 0:
+            self.block_callback(self.emit_symbol_block())
+
+        if len(self.capture_block) > 0:
+            records = self.emit_capture_block()
+            if self.capture != False:
+                self.capture.write(records)
+            if self.tone_callback != False:
+                self.tone_callback(records)
+
+        if self.watchdog:
+            self.update_watchdog(time.time() - start, duration)
+
+    def tone_bins(self, windows):
+        """
+        Complex tone bin values over a symbol-length window of samples, or over each row of an array of windows.
+        """
+        if self.tone_kernel is None:
+            return FFTBackend.fft(windows, axis=-1)[...,self.tone_indices]
+        return windows.dot(self.tone_kernel.T)
+
+    def timing_kernel(self):
+        """
+        Single-point DFT at (symbol_rate) Hz, over the max_fft_energy_buffer, which has one entry per block.
+        """
+        return np.exp(-2*np.pi*1j * (self.symbol_rate/(self.fs/self.block_length)) * np.arange(0,len(self.max_fft_energy_buffer))).astype(self.complex_dtype)
+
+    def update_watchdog(self, elapsed, duration):
+        """
+        Realtime watchdog. Called after each call to consume() with the time it took (elapsed) and the duration of
+        the audio it was given (both in seconds). Moves up a degradation level if processing is slower than
+        realtime or too far behind, and back down once it is comfortably faster and has caught up.
+        """
+        self.backlog = max(0.0, self.backlog + elapsed - duration)
+        if duration > 0:
+            self.load = self.decayavg(self.load, elapsed/duration, self.watchdog_weight)
+
+        self.watchdog_held += duration
+        if self.watchdog_held < self.watchdog_hold:
+            return
+
+        if (self.load > 1.0 or self.backlog > self.watchdog_max_backlog) and self.watchdog_level < len(self.watchdog_levels) - 1:
+            self.set_watchdog_level(self.watchdog_level + 1)
+            logging.warning("Demodulator behind realtime (load %.2f, %.2f s behind), degradation level %d." % (self.load, self.backlog, self.watchdog_level))
+        elif self.load < self.watchdog_recover and self.backlog == 0 and self.watchdog_level > 0:
+            self.set_watchdog_level(self.watchdog_level - 1)
+            logging.info("Demodulator keeping up (load %.2f), degradation level %d." % (self.load, self.watchdog_level))
+
+    def set_watchdog_level(self, level):
+        """
+        Apply the settings of one of the watchdog_levels. Anything a level doesn't set returns to its configured value.
+        """
+        settings = self.watchdog_levels[level]
+        if level != self.watchdog_level:
+            self.level_changes += 1
+        self.watchdog_level = level
+        self.watchdog_held = 0.0
+
+        self.diagnostics = settings.get("diagnostics", True)
+        self.use_soft_decode = settings.get("soft_decode", True)
+        self.set_block_length(min(self.symbol_length, self.nominal_block_length*settings.get("block_length", 1)))
+
+        squelch = settings.get("squelch") if self.nominal_squelch == None else self.nominal_squelch
+        if squelch != None and self.squelch == None:
+            # Start with the squelch open, and the recent samples in its history, so a signal being decoded isn't cut off.
+            self.squelch_history[:] = self.sample_buffer
+            self.squelch_open = True
+            self.squelch_countdown = self.squelch_hang
+            self.block_count = 0
+        self.squelch = squelch
+
+    def set_block_length(self, block_length):
+        """
+        Change the block length. Outside of tracking mode, the timing DFT buffer holds one entry per block, so it is
+        cleared, and symbol timing is re-acquired.
+        """
+        if block_length == self.block_length:
+            return
+
+        self.block_length = block_length
+        self.timing_dft = self.timing_kernel()
+        self.squelch_blocks = max(1, self.symbol_length//self.block_length)
+        if self.timing_mode != "TRACK":
+            self.max_fft_energy_buffer[:] = 0
+            self.last_dftphase = 0.0
+            self.track_count = 0
+
+    def watchdog_metrics(self):
+        """
+        Dictionary of the watchdog's measurements: the current degradation level, the averaged load (processing time
+        as a fraction of the audio duration), the backlog (s behind realtime), the number of level changes, and the
+        current block length.
+        """
+        return {"level": self.watchdog_level, "load": self.load, "backlog": self.backlog, "level_changes": self.level_changes,
+            "block_length": self.block_length}
 
-        for block in data:
-            self.symbol_detect(block)
+    def comb_template(self):
+        """
+        Expected average power spectrum of the MFSK signal, on the coarse search FFT bins: one sinc^2 response
+        per tone, covering the tones plus one bin either side.
+        """
+        k = np.arange(-self.afc_oversample, int(np.ceil((self.tone_offsets[-1] + 2)*self.afc_oversample)))/float(self.afc_oversample)
+        return np.sum(np.sinc(k[:,np.newaxis] - self.tone_offsets)**2, axis=1)
 
+    def frequency_search(self, data):
+        """
+        Coarse frequency acquisition. Mixed samples are collected until (afc_search_symbols) symbols are available,
+        then the averaged power spectrum is correlated against the tone comb over +/- afc_range Hz. If the best match
+        is far enough above the noise floor, the mixer is retuned onto it and the fine AFC loop takes over.
+
+        Only the outer tones fix which tone is which, so a search over a few tones matches the comb equally well at
+        several offsets. Two searches in a row must agree before the first lock, with near-ties going to the offset
+        closest to the previous search. Once locked, only a search which places the comb unambiguously (all its
+        near-ties within half a tone spacing, in practice one covering a preamble) and clearly (afc_move_threshold)
+        can move the mixer, if it finds the comb more than half a tone spacing away. A search over part of a packet,
+        or over noise, matches a shifted comb surprisingly often, and retuning a signal which is on frequency by a
+        whole tone loses the packets in flight. Those searches are skipped, without holding up the correction of a
+        lock which started a tone off.
+        """
+        self.afc_buffer = np.append(self.afc_buffer, data)
+        search_length = self.afc_search_symbols*self.symbol_length
+        if len(self.afc_buffer) < search_length:
+            return
+
+        windows = np.reshape(self.afc_buffer[:search_length], (-1, self.symbol_length))
+        self.afc_buffer = self.afc_buffer[search_length:]
+        fft_length = self.symbol_length*self.afc_oversample
+        power = np.mean(np.absolute(FFTBackend.fft(windows, n=fft_length, axis=1))**2, axis=0)
+
+        # Candidate positions of tone zero, in coarse bins relative to where it should be.
+        max_offset = int(self.afc_range*self.afc_oversample/self.symbol_rate)
+        offsets = np.arange(-max_offset, max_offset + 1)
+        start = self.tone_zero*self.afc_oversample - self.afc_oversample
+        bins = start + offsets[:,np.newaxis] + np.arange(len(self.afc_comb))
+        score = np.take(power, bins, mode='wrap').dot(self.afc_comb)
+
+        # The averaged noise power is close to its mean, so a low percentile of the spectrum gives the noise floor.
+        noise = np.percentile(power, 25)*np.sum(self.afc_comb)
+        best = np.argmax(score)
+        with np.errstate(divide='ignore'):
+            self.afc_level = 10*np.log10(score[best]/noise)
+        if self.afc_level < self.afc_threshold:
+            self.afc_candidate = None
+            return
+
+        # Of the best matches, take the one closest to the previous search (or the current tuning, if locked).
+        candidates = offsets[score - noise >= self.afc_tie*(score[best] - noise)]*self.symbol_rate/float(self.afc_oversample)
+        reference = self.afc_candidate if self.afc_state == "SEARCH" and self.afc_candidate != None else 0.0
+        offset = candidates[np.argmin(np.absolute(candidates - reference))]
+
+        if self.afc_state == "LOCK":
+            if np.ptp(candidates) > self.tone_spacing/2.0 or self.afc_level < self.afc_move_threshold:
+                # Matches a tone or more apart (part of a packet, without the outer tones), or only weakly (mostly
+                # noise). This search can't tell where the signal is, so the tuning is left alone.
+                return
+            if abs(offset) > self.tone_spacing/2.0:
+                self.retune(offset)
+                logging.debug("Signal moved to %.2f Hz offset (%.1f dB)." % (self.freq_offset, self.afc_level))
+            return
+
+        if self.afc_candidate == None or abs(offset - self.afc_candidate) > self.tone_spacing/2.0:
+            self.afc_candidate = offset
+            return
+
+        self.retune(offset)
+        self.afc_candidate = None
+        logging.debug("Signal found at %.2f Hz offset (%.1f dB)." % (self.freq_offset, self.afc_level))
+        self.afc_state = "LOCK"
+
+    def retune(self, offset):
+        """
+        Move the mixer by (offset) Hz, keeping the total offset within +/- afc_range.
+        """
+        self.freq_offset = np.clip(self.freq_offset + offset, -self.afc_range, self.afc_range)
+        self.mixing_freq = self.nominal_mixing_freq - self.freq_offset
+
+    def track_frequency(self, sample):
+        """
+        Fine AFC. The detected tone's bin is evaluated separately over the first and second halves of the symbol
+        window that ended at (sample). A tone exactly on the bin has the same phase in both halves; a tone (d) bins
+        off advances by pi*d, which gives the residual frequency error. This is averaged and fed back to the mixer.
+        """
+        tone_mags = np.absolute(self.fft_energy_buffer[:,-1])
+        others = (np.sum(tone_mags) - tone_mags[self.currsymbol])/(self.num_tones - 1)
+        if others > 0 and 20*np.log10(tone_mags[self.currsymbol]/others) < self.afc_s2n:
+            return
+
+        end = len(self.sample_buffer) - (self.sample_count - sample)
+        window = self.sample_buffer[end - self.symbol_length:end]
+        half = self.symbol_length//2
+        tone_bin = self.tone_positions[self.currsymbol]
+        halves = (window*np.exp(-2j*np.pi*tone_bin*np.arange(self.symbol_length)/float(self.symbol_length))).reshape(2, half).sum(axis=1)
+        error = np.angle(halves[1]*np.conj(halves[0]))*self.symbol_rate/np.pi
+
+        self.freq_error = self.decayavg(self.freq_error, error, self.afc_weight)
+        self.retune(error/self.afc_weight)
+
+    def emit_capture_block(self):
+        """
+        Tone bin magnitudes collected since the last call, as an array of capture records.
+        """
+        records = np.zeros(len(self.capture_block), dtype=self.capture_dtype)
+        records["sample"] = [x[0] for x in self.capture_block]
+        with np.errstate(divide='ignore'):
+            records["s2n"] = 20*np.log10([x[1] for x in self.capture_block])
+            records["s2n_instant"] = 20*np.log10([x[2] for x in self.capture_block])
+        records["timing"] = [x[3] for x in self.capture_block]
+        records["tones"] = [x[4] for x in self.capture_block]
+        self.capture_block = []
+
+        return records
+
+    def emit_symbol_block(self):
+        """
+        Convert the symbols collected since the last call into a structured array, and clear the collection.
+        SNR values are converted to dB here, for the whole block at once.
+        """
+        symbols = np.array(self.symbol_block, dtype=self.symbol_block_dtype)
+        self.symbol_block = []
 
+        with np.errstate(divide='ignore'):
+            symbols["s2n"] = 20*np.log10(symbols["s2n"])
+            symbols["s2n_instant"] = 20*np.log10(symbols["s2n_instant"])
+
+        return symbols
+
+    # Attributes saved by get_state(). Buffers are copied, everything else is stored as a NumPy scalar.
+    state_buffers = ["sample_buffer", "fft_energy_buffer", "max_fft_energy_buffer", "pending", "afc_buffer", "squelch_history"]
+    state_scalars = ["mixing_phase", "mixing_freq", "sample_count", "symbol_gap", "currsymbol", "last_symbol", "last_symbol2", "s2n",
+        "s2n_instant", "last_dftphase", "timing_mode", "track_count", "timing_error", "track_error", "afc_state", "afc_level",
+        "freq_offset", "freq_error", "squelch_open", "squelch_level", "squelch_countdown", "block_count", "watchdog_level"]
+
+    def state_config(self):
+        """ Configuration a saved state must match to be restored. """
+        return {"input_rate": self.input_rate, "fs": self.fs, "base_freq": self.base_freq, "symbol_rate": self.symbol_rate,
+            "num_tones": self.num_tones, "tone_spacing": self.tone_spacing, "block_length": self.nominal_block_length, "decimation": self.decimation, "dtype": self.dtype.str}
+
+    def get_state(self):
+        """
+        Snapshot of the demodulator's state (sample and tone bin buffers, mixer phase, sample count, symbol timing,
+        SNR averages, AFC and squelch state), as a dictionary of NumPy arrays which can be saved with
+        ModemUtils.save_state. Callbacks and the capture file are not included. Take snapshots between calls
+        to consume().
+        """
+        state = {"state_version": np.array(STATE_VERSION)}
+        for (key, value) in self.state_config().items():
+            state[key] = np.array(value)
+        for key in self.state_buffers:
+            state[key] = getattr(self, key).copy()
+        for key in self.state_scalars:
+            state[key] = np.array(getattr(self, key))
+        # No AFC candidate is stored as NaN.
+        state["afc_candidate"] = np.array(np.nan if self.afc_candidate == None else self.afc_candidate)
+        if self.decimator != False:
+            for (key, value) in self.decimator.get_state().items():
+                state["decimator_" + key] = value
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a snapshot from get_state (or ModemUtils.load_state). The demodulator must have been created with
+        the same configuration, or ValueError is raised. Processing then continues exactly as if the samples
+        consumed before the snapshot had been fed to this instance.
+        """
+        if int(state["state_version"]) != STATE_VERSION:
+            raise ValueError("Unsupported state version %s." % state["state_version"])
+        check_state(state, self.state_config())
+
+        # The watchdog level sets the block length and squelch, which the buffers below depend on.
+        self.set_watchdog_level(min(int(state["watchdog_level"]), len(self.watchdog_levels) - 1))
+        for key in self.state_buffers:
+            current = getattr(self, key)
+            setattr(self, key, np.array(state[key], dtype=current.dtype))
+        for key in self.state_scalars:
+            setattr(self, key, state[key].item())
+        self.afc_candidate = None if np.isnan(state["afc_candidate"]) else float(state["afc_candidate"])
+        if self.decimator != False:
+            self.decimator.set_state(dict([(key[len("decimator_"):], value) for (key, value) in state.items() if key.startswith("decimator_")]))
+
+
+    def squelched_detect(self, data):
+        """
+        Run symbol detection on a set of blocks, skipping any blocks where the squelch is closed.
+        The squelch is measured using a single FFT over the symbol period before every (squelch_blocks)'th block.
+        """
+        history = len(self.squelch_history)
+        stream = np.append(self.squelch_history, data.ravel())
+        self.squelch_history = stream[len(stream)-history:]
+
+        # Blocks at which the squelch is re-evaluated, and the FFT windows ending at each of them.
+        boundaries = np.nonzero((self.block_count + np.arange(len(data))) % self.squelch_blocks == 0)[0]
+        self.block_count = self.block_count + len(data)
+        if len(boundaries) > 0:
+            starts = history + boundaries*self.block_length - self.symbol_length
+            windows = stream[starts[:,np.newaxis] + np.arange(self.symbol_length)]
+            tone_power = np.absolute(self.tone_bins(windows))**2
+            with np.errstate(divide='ignore'):
+                levels = 10*np.log10(np.max(tone_power, axis=1)/np.median(tone_power, axis=1))
+
+        boundary = 0
+        for i in range(len(data)):
+            if boundary < len(boundaries) and boundaries[boundary] == i:
+                self.squelch_level = levels[boundary]
+                boundary += 1
+
+                if self.squelch_level >= self.squelch:
+                    if not self.squelch_open:
+                        # Signal onset. Reload the sample buffer, and start timing estimation from scratch.
+                        logging.debug("Squelch open.")
+                        self.reset_timing(stream[i*self.block_length:i*self.block_length + history])
+                    self.squelch_open = True
+                    self.squelch_countdown = self.squelch_hang
+                elif self.squelch_open:
+                    self.squelch_countdown -= 1
+                    if self.squelch_countdown <= 0:
+                        logging.debug("Squelch closed.")
+                        self.squelch_open = False
+
+            if self.squelch_open:
+                self.symbol_detect(data[i])
+            else:
+                self.sample_count = self.sample_count + self.block_length
+
+    def reset_timing(self, samples):
+        """
+        Clear the symbol timing state, and reload the sample buffer with the given samples.
+        """
+        self.sample_buffer[:] = samples
+        self.fft_energy_buffer[:] = 0
+        self.max_fft_energy_buffer[:] = 0
+        self.symbol_gap = 0
+        self.last_dftphase = 0.0
+        self.acquire()
+        if self.afc:
+            # A new transmission might be on a different frequency.
+            self.afc_state = "SEARCH"
+            self.afc_buffer = np.array([], dtype=self.complex_dtype)
+            self.afc_candidate = None
+
+    def acquire(self):
+        """
+        Return to acquisition mode. The timing DFT buffer isn't updated while tracking, so it is cleared.
+        """
+        if self.timing_mode == "TRACK":
+            logging.debug("Lost timing, acquiring.")
+            self.max_fft_energy_buffer[:] = 0
+            self.symbol_gap = 0
+            self.last_dftphase = 0.0
+        self.timing_mode = "ACQUIRE"
+        self.track_count = 0
+        self.timing_error = 0.0
+        self.track_error = 0.0
 
     def symbol_detect(self,samples):
         """
         Consumes a sample of data, adding it to a buffer and looking for the beginning of a symbol period.
 
         """
+        if self.timing_mode == "TRACK":
+            self.track_symbol(samples)
+            return
 
         # Roll buffers.
         self.sample_buffer = np.roll(self.sample_buffer,-1*self.block_length)
@@ -123,21 +658,17 @@ class MFSKDemodulator(object):
         # Add new samples.
         self.sample_buffer[-1*self.block_length:] = samples
 
-        # Calculate FFT over the last (symbol_length) samples in the buffer
-        fft_instant = np.fft.fft(self.sample_buffer[-1*self.symbol_length:])
-
-        # Add the relevant bins to a buffer.
+        # Calculate the tone bins over the last (symbol_length) samples in the buffer, and add them to a buffer.
         # TODO: Sum positive and negative frequency bins! Might add 3dB
-        self.fft_energy_buffer[:,-1] = fft_instant[self.tone_zero:self.tone_zero+self.num_tones]
+        self.fft_energy_buffer[:,-1] = self.tone_bins(self.sample_buffer[-1*self.symbol_length:])
         # Add the maximum bin to the end of another buffer for signal energy detection.
         self.max_fft_energy_buffer[-1] = np.max(np.absolute(self.fft_energy_buffer[:,-1]))
 
         # Calculate single-point DFT phase at (symbol_rate) Hz over the max fft energy buffer.
-        # If block_length is >1, the fft energy data is effectively downsampled by that factor, and we
-        # compensate for that here
-        dft_energy = np.angle( self.max_fft_energy_buffer.dot(np.exp(-2*np.pi*1j * (self.symbol_rate/(self.fs/self.block_length)) * np.arange(0,len(self.max_fft_energy_buffer))))) % (2*np.pi)
+        dft_energy = np.angle( self.max_fft_energy_buffer.dot(self.timing_dft) ) % (2*np.pi)
         # Save the dft phase value for debugging purposes
-        self.dft_phase = np.append(self.dft_phase, dft_energy)
+        if self.diagnostics:
+            self.dft_phase = np.append(self.dft_phase, dft_energy)
 
         # SYMBOL DETECTION
 
@@ -151,12 +682,22 @@ class MFSKDemodulator(object):
             # Zero crossing symbol detection: Detect the zero crossing of the DFT phase. 
             # This indicates that the last (symbol_length) symbols in the buffer contain a symbol.
             if(dft_energy<1.0 and self.last_dftphase > 5.5 and self.symbol_gap > (self.symbol_length*0.8)):
+                if abs(self.symbol_gap - self.symbol_length) <= self.block_length:
+                    self.track_count += 1
+                else:
+                    self.track_count = 1
+
                 self.detect_symbol("D")
 
+                if self.tracking and self.track_count >= self.track_lock and 20*np.log10(self.s2n) >= self.track_s2n:
+                    logging.debug("Timing acquired, tracking.")
+                    self.timing_mode = "TRACK"
+
             # Flywheeling: Attempt to detect a symbol when no zero crossing are detected in the last
             # (symbol_length) samples.
             if self.symbol_gap > self.symbol_length:
                 logging.debug("Flywheeling...")
+                self.track_count = 0
                 self.detect_symbol("F")
 
         # Increment counters.
@@ -164,19 +705,81 @@ class MFSKDemodulator(object):
         self.sample_count = self.sample_count + self.block_length
         self.last_dftphase = dft_energy
 
-    def detect_symbol(self, timing):
+    def track_symbol(self, samples):
+        """
+        Tracking mode: add a block of samples to the buffer, and only evaluate tone bins one block after
+        the expected end of each symbol. The windows ending one block early, on time, and one block late are
+        compared on every tone transition, and once enough error has accumulated the expected timing of the
+        next symbol is moved by one block.
+        """
+        self.sample_buffer = np.roll(self.sample_buffer,-1*self.block_length)
+        self.sample_buffer[-1*self.block_length:] = samples
+
+        if self.symbol_gap >= self.symbol_length + self.block_length:
+            end = len(self.sample_buffer)
+            windows = np.array([self.sample_buffer[end - self.symbol_length - 2*self.block_length:end - 2*self.block_length],
+                self.sample_buffer[end - self.symbol_length - self.block_length:end - self.block_length],
+                self.sample_buffer[end - self.symbol_length:]])
+            tone_bins = self.tone_bins(windows)
+            early, on_time, late = np.max(np.absolute(tone_bins), axis=1)
+
+            self.fft_energy_buffer[:,-1] = tone_bins[1]
+            self.detect_symbol("T", self.sample_count - self.block_length)
+
+            # The on-time window ended one block ago.
+            self.symbol_gap = self.block_length
+
+            # Only symbol transitions carry timing information.
+            if self.currsymbol != self.last_symbol2:
+                error = (late - early)/(late + early)
+                self.timing_error += error
+                self.track_error = self.decayavg(self.track_error, abs(error), 8)
+
+                if self.timing_error > self.track_step:
+                    self.symbol_gap -= self.block_length
+                    self.timing_error = 0.0
+                elif self.timing_error < -self.track_step:
+                    self.symbol_gap += self.block_length
+                    self.timing_error = 0.0
+
+            if self.track_error > self.track_max_error or 20*np.log10(self.s2n) < self.track_s2n:
+                self.acquire()
+
+        self.symbol_gap += self.block_length
+        self.sample_count = self.sample_count + self.block_length
+
+    def detect_symbol(self, timing, sample = None):
         """
         Run the symbol detection routines, and pass decoded data to the callback function.
+        sample: Sample count to report for this symbol, if not the current sample count.
         """
+        if sample == None:
+            sample = self.sample_count
+
         self.hard_decode()
         self.eval_s2n()
+        if self.afc_state == "LOCK":
+            self.track_frequency(sample)
 
         self.symbol_gap = 0
 
-        symbol_stats = {"symbol":self.currsymbol, "sample":self.sample_count, "s2n":(20*np.log10(self.s2n)), "s2n_instant":(20*np.log10(self.s2n_instant)), "timing":timing}
-        logging.debug(str(symbol_stats))
-        if self.callback != False:
-            self.callback(symbol_stats)
+        if self.block_callback != False:
+            if self.soft_bits:
+                soft = self.soft_decode() if self.use_soft_decode else np.zeros(self.sym_bits)
+                self.symbol_block.append((self.currsymbol, sample*self.decimation, self.s2n, self.s2n_instant, timing, soft))
+            else:
+                self.symbol_block.append((self.currsymbol, sample*self.decimation, self.s2n, self.s2n_instant, timing))
+
+        if self.capture != False or self.tone_callback != False:
+            self.capture_block.append((sample*self.decimation, self.s2n, self.s2n_instant, timing, np.absolute(self.fft_energy_buffer[:,-1])))
+
+        # Only build the per-symbol dictionary if someone is going to look at it.
+        if self.callback != False or (self.diagnostics and logging.getLogger().isEnabledFor(logging.DEBUG)):
+            symbol_stats = {"symbol":self.currsymbol, "sample":sample*self.decimation, "s2n":(20*np.log10(self.s2n)), "s2n_instant":(20*np.log10(self.s2n_instant)), "timing":timing}
+            if self.diagnostics:
+                logging.debug("%s", symbol_stats)
+            if self.callback != False:
+                self.callback(symbol_stats)
 
     def hard_decode(self):
         """
@@ -236,8 +839,8 @@ class MFSKDemodulator(object):
             # Then we multiply these bits by the magnitude of the symbol bin, and add it to our total.
             b += symbol_weights * binmag
 
-        # Now we normalise the values to +- 1.
-        b = b/np.sum(np.absolute(self.fft_energy_buffer[:,-1]))
+        # Now we normalise the values to +- 1. Silence (no energy in any bin) gives zeros.
+        b = b/max(np.sum(np.absolute(self.fft_energy_buffer[:,-1])), np.finfo(np.float32).tiny)
         return b
 
 
@@ -245,16 +848,15 @@ class MFSKDemodulator(object):
 
 # Test script.
 if __name__ == "__main__":
-    filename = 'generated_MFSK16_packets.wav';
+    from FileSource import FileSource
 
-    fs, data = wavfile.read('generated_MFSK16_packets.wav')
+    filename = 'generated_MFSK16_packets.wav';
 
-    if(data.dtype == np.int16):
-        data = data.astype(np.float)/2**16
-    elif(data.dtype == np.int32):
-        data = data.astype(np.float)/2**32
+    # Feed data in X samples at a time. This kind of simulates getting data from a buffered audio stream.
+    # The file is memory-mapped, so only one chunk at a time is converted.
+    source = FileSource(filename, chunk_size = 1024)
 
-    demod = MFSKDemodulator(sample_rate = fs)
+    demod = MFSKDemodulator(sample_rate = source.sample_rate)
 
     root = logging.getLogger()
     ch = logging.StreamHandler(sys.stdout)
@@ -262,18 +864,40 @@ if __name__ == "__main__":
     root.addHandler(ch)
     root.setLevel(logging.DEBUG)
 
-    # Feed data in X samples at a time. This kind of simulates getting data from a buffered audio stream.
-    chunk_size = 1024
-    i = 0
-    while (i+chunk_size < len(data)): 
-        demod.consume(data[i:i+chunk_size])
-        i = i + chunk_size
+    for chunk in source:
+        demod.consume(chunk)
+
 
-    # process any remaning data.
-    demod.consume(data[i:])
 
 
 
 
 
+    # AFC check. Many packets on frequency, with short gaps between them, must decode the same with the AFC
+    # running as without it. The repetitive payloads leave some tones much stronger than others, so single
+    # searches sometimes match the comb a tone away, and a locked AFC must not retune onto it.
+    import MFSKModulator, Packetizer, DePacketizer
+    root.setLevel(logging.INFO)
+    rng = np.random.RandomState(1)
+    p = Packetizer.Packetizer()
+    mod = MFSKModulator.MFSKModulator(sample_rate=8000, symbol_rate=15.625, tone_spacing=15.625, base_freq=1520, amplitude=0.3)
+    sent = []
+    for i in range(30):
+        mod.write(np.zeros(int(rng.uniform(0.2, 1.5)*8000)))
+        mod.modulate_symbol([0,15]*15)
+        message = "Packet %02d " % i + "x"*20
+        mod.modulate_bits(4, np.unpackbits(np.fromstring(p.pack_message(message), dtype=np.uint8)))
+        mod.modulate_symbol([0]*4)
+        sent.append(message)
+    signal = np.append(mod.emit_all(), np.zeros(8000))
+    signal = signal + 0.02*rng.randn(len(signal))
 
+    for afc in [False, True]:
+        received = []
+        packet_extract = DePacketizer.DePacketizer(callback = received.append)
+        demod = MFSKDemodulator(sample_rate = 8000, base_freq = 1520, afc = afc,
+            block_callback = lambda symbols: packet_extract.process_data(tones_to_bits(symbols["symbol"], 16)))
+        for i in range(0, len(signal), 1024):
+            demod.consume(signal[i:i+1024])
+        print "AFC %s: %d/%d packets, final offset %.2f Hz." % (afc, len(received), len(sent), demod.freq_offset)
+        assert received == sent
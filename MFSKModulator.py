@@ -16,24 +16,26 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
-from pylab import *
 import numpy as np
-from scipy.io import wavfile
 from ModemUtils import *
 
 
 class MFSKModulator(object):
-    """ Constant Amplitude/Phase MFSK Modulator Class """
-    def __init__(self, sample_rate=8000, base_freq=1000, symbol_rate=31.25, tone_spacing=31.25, start_silence=0, amplitude=0.5):
+    """ Constant Amplitude/Phase MFSK Modulator Class
+
+    dtype:  Floating point dtype of the generated baseband (np.float64 or np.float32).
+    """
+    def __init__(self, sample_rate=8000, base_freq=1000, symbol_rate=31.25, tone_spacing=31.25, start_silence=0, amplitude=0.5, dtype=np.float64):
         self.sample_rate = sample_rate
         self.base_freq = base_freq
         self.symbol_rate = symbol_rate
         self.tone_spacing = tone_spacing
         self.symbol_length = int(sample_rate/symbol_rate)
         self.amplitude = amplitude
+        self.dtype = np.dtype(dtype)
 
         self.phase = int(0)
-        self.baseband = np.zeros(start_silence*self.symbol_length)
+        self.baseband = np.zeros(start_silence*self.symbol_length, dtype=self.dtype)
 
         self.read_ptr = 0
         self.write_lock = 0
@@ -44,7 +46,7 @@ class MFSKModulator(object):
         samples_available = len(self.baseband) - self.read_ptr
         if(block_size > samples_available):
             # Add silence to baseband output, so we can give data to the consumer
-            self.baseband = np.append(self.baseband, np.zeros(block_size - samples_available))
+            self.baseband = np.append(self.baseband, np.zeros(block_size - samples_available, dtype=self.dtype))
 
         self.write_lock = 0
         chunk = self.baseband[self.read_ptr:(self.read_ptr + block_size)]
@@ -58,22 +60,23 @@ class MFSKModulator(object):
             pass
 
         # Append data onto the end of our baseband array.
-        self.baseband = np.append(self.baseband,data)
+        self.baseband = np.append(self.baseband, np.asarray(data, dtype=self.dtype))
 
     def emit_all(self):
         return self.baseband
 
     def write_wave(self,filename):
+        from scipy.io import wavfile
         scaled = np.int16(self.baseband * 32767)
         wavfile.write(filename,self.sample_rate,scaled)
 
     def modulate_symbol(self,symbol_list=0):
-        for symb in symbol_list:
-            tone_freq = float(self.base_freq) + float(self.tone_spacing)*int(symb)
-            x = np.arange(self.phase, self.phase + self.symbol_length, 1)
-            symbol = self.amplitude * np.cos(2*np.pi*(tone_freq/self.sample_rate)*x)
+        # All the symbols are generated at once (one row each), and appended to the baseband in a single write.
+        tone_freq = float(self.base_freq) + float(self.tone_spacing)*np.asarray(symbol_list, dtype=int).reshape(-1,1)
+        x = np.arange(self.phase, self.phase + self.symbol_length, 1)
+        symbols = (self.amplitude * np.cos(2*np.pi*(tone_freq/self.sample_rate)*x)).astype(self.dtype)
 
-            self.write(symbol)
+        self.write(symbols.ravel())
 
     def modulate_bits(self, symbol_bits, bit_array):
         """ Converts a numpy array of bits (0,1) to gray coded symbols, then transmits them. 
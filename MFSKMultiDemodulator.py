@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# MFSKMultiDemodulator.py - Batched MFSK Demodulator for many independent streams.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from ModemUtils import *
+import FFTBackend
+
+class MFSKMultiDemodulator(object):
+    """ Batched MFSK Demodulator Class
+
+    Runs the same symbol detection algorithm as MFSKDemodulator, on N independent streams at once.
+    The state of every stream is held in stacked arrays, and each call to consume() processes a
+    (N x samples) chunk using one set of vectorised FFT, tone-bin and timing operations.
+
+    num_streams:    Number of independent input streams.
+    sample_rate:    Sample rate of incoming data (Hz)
+    base_freq:      The frequency of the lowest MFSK tone (Hz). Either a single value, or one value per stream.
+    symbol_rate:    Symbol rate of the MFSK modulation (baud)
+    num_tones:      Number of tones in use. Tone spacing is assumed to be orthogonal (equal to the symbol rate).
+    block_callback: Function pointer. At the end of each call to consume(), this is called once for each stream
+                    with symbols, as block_callback(stream_index, symbols), where symbols is a structured array
+                    (see ModemUtils.symbol_dtype).
+    soft_bits:      If True, soft bit values are included in the output.
+    block_length:   How many samples to process at a time. Higher values will increase speed, but reduce accuracy.
+    dtype:          Real dtype used for the sample and tone bin buffers (np.float64 or np.float32).
+
+    """
+    def __init__(self, num_streams, sample_rate=8000, base_freq=1500, symbol_rate=15.625, num_tones = 16, block_callback = False, gray_coded = True, soft_bits = False, block_length = 16, dtype = np.float64):
+        self.num_streams = num_streams
+        self.fs = sample_rate
+        self.base_freq = np.zeros(num_streams) + base_freq
+        self.symbol_rate = symbol_rate
+        self.tone_spacing = symbol_rate
+        self.num_tones = num_tones
+        self.block_callback = block_callback
+        self.gray_coded = gray_coded
+        self.soft_bits = soft_bits
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = complex_dtype(self.dtype)
+
+        self.buffer_size = 4 # Length of the internal buffers used, in symbols.
+        self.block_length = block_length
+        self.mixing_phase = 0
+        self.sample_count = 0
+
+        # Calculate some variables we need.
+        self.sym_bits = int(np.log2(self.num_tones))
+        self.symbol_length = int(round(self.fs/self.symbol_rate))
+        self.mixing_freq = np.round(self.base_freq/self.symbol_rate)*self.symbol_rate - self.base_freq
+        self.tone_zero = np.round(self.base_freq/self.symbol_rate).astype(int)
+        # FFT bin index of each tone, for each stream.
+        self.tone_bins = self.tone_zero[:,np.newaxis] + np.arange(self.num_tones)
+        # Normalised frequency of the timing DFT, in cycles per block.
+        self.timing_freq = self.symbol_rate/(self.fs/float(self.block_length))
+        self.energy_length = self.symbol_length*self.buffer_size
+
+        # Stacked per-stream buffers.
+        # Mixed samples that still fall inside the next FFT window.
+        self.sample_history = np.zeros( (num_streams, self.symbol_length - self.block_length), dtype=self.complex_dtype )
+        # Mixed samples which don't yet make up a whole block.
+        self.pending = np.zeros( (num_streams, 0), dtype=self.complex_dtype )
+        # Maximum tone bin magnitude, one entry per block.
+        self.max_fft_energy_buffer = np.zeros( (num_streams, self.energy_length), dtype=self.dtype )
+
+        # Per-stream symbol timing and SNR state.
+        self.symbol_gap = np.zeros(num_streams, dtype=int)
+        self.last_dftphase = np.zeros(num_streams)
+        self.last_symbol = np.zeros(num_streams, dtype=int)
+        self.last_symbol2 = np.zeros(num_streams, dtype=int)
+        self.s2n = np.zeros(num_streams)
+        self.s2n_instant = np.zeros(num_streams)
+
+        self.soft_weights = soft_decode_weights(self.num_tones, self.gray_coded)
+        self.symbol_block_dtype = symbol_dtype(self.sym_bits if self.soft_bits else 0)
+        self.symbol_block = []
+
+    def consume(self, data):
+        """
+        Consumes a (num_streams x samples) array of incoming data, and runs symbol detection on all streams.
+        Chunks do not need to be a multiple of the block length; leftover samples are carried over to the next call.
+        """
+        data = np.atleast_2d(data)
+        data = data.astype(self.complex_dtype if np.iscomplexobj(data) else self.dtype, copy=False)
+        if data.shape[0] != self.num_streams:
+            raise ValueError("Expected %d streams, got %d." % (self.num_streams, data.shape[0]))
+
+        # Mix each stream so that it lines up with a FFT bin.
+        n = np.arange(self.mixing_phase, self.mixing_phase + data.shape[1])
+        mixed = data*np.exp(2j*np.pi*(self.mixing_freq[:,np.newaxis]/self.fs)*n).astype(self.complex_dtype)
+        self.mixing_phase = self.mixing_phase + data.shape[1]
+
+        samples = np.concatenate((self.pending, mixed), axis=1)
+        num_blocks = samples.shape[1]//self.block_length
+        used = num_blocks*self.block_length
+        self.pending = samples[:,used:]
+        if num_blocks == 0:
+            return
+
+        # One FFT window of (symbol_length) samples ends at the end of each block.
+        stream = np.concatenate((self.sample_history, samples[:,:used]), axis=1)
+        self.sample_history = stream[:,used:].copy()
+        windows = as_strided(stream, shape=(self.num_streams, num_blocks, self.symbol_length),
+            strides=(stream.strides[0], stream.strides[1]*self.block_length, stream.strides[1]))
+
+        fft_instant = FFTBackend.fft(windows, axis=-1)
+        tone_mags = np.absolute(fft_instant[np.arange(self.num_streams)[:,np.newaxis,np.newaxis], np.arange(num_blocks)[np.newaxis,:,np.newaxis], self.tone_bins[:,np.newaxis,:]]).astype(self.dtype, copy=False)
+
+        # Single-point DFT phase at (symbol_rate) over the last (energy_length) max energy values, for every block.
+        # Computed for all blocks at once using a cumulative sum; the phase reference cancels out.
+        # The cumulative sum is always double precision, as it is differenced over long runs of blocks.
+        energy = np.concatenate((self.max_fft_energy_buffer, tone_mags.max(axis=-1)), axis=1)
+        self.max_fft_energy_buffer = energy[:,-self.energy_length:].copy()
+        rotated = energy*np.exp(-2j*np.pi*self.timing_freq*np.arange(energy.shape[1]))
+        cumulative = np.concatenate((np.zeros((self.num_streams,1)), np.cumsum(rotated, axis=1)), axis=1)
+        b = np.arange(1, num_blocks+1)
+        dft = (cumulative[:,b+self.energy_length] - cumulative[:,b])*np.exp(2j*np.pi*self.timing_freq*b)
+        dft_phase = np.angle(dft) % (2*np.pi)
+
+        # Symbol timing. This is sequential in time, but vectorised across streams.
+        for block in range(num_blocks):
+            phase = dft_phase[:,block]
+            # Zero crossing of the DFT phase.
+            zero_crossing = (phase < 1.0) & (self.last_dftphase > 5.5) & (self.symbol_gap > (self.symbol_length*0.8))
+            # Flywheeling, if no zero crossing has been seen for a symbol period.
+            flywheel = ~zero_crossing & (self.symbol_gap > self.symbol_length)
+            detected = np.nonzero(zero_crossing | flywheel)[0]
+
+            if len(detected) > 0:
+                self.detect_symbols(detected, tone_mags[detected,block], zero_crossing[detected])
+                self.symbol_gap[detected] = 0
+
+            self.symbol_gap += self.block_length
+            self.sample_count = self.sample_count + self.block_length
+            self.last_dftphase = phase
+
+        if self.block_callback != False and len(self.symbol_block) > 0:
+            self.emit_symbol_blocks()
+
+    def detect_symbols(self, streams, tone_mags, zero_crossing):
+        """
+        Hard decode and SNR estimation for a set of streams that have a symbol available in the current block.
+        """
+        symbols = np.argmax(tone_mags, axis=1)
+        self.last_symbol2[streams] = self.last_symbol[streams]
+        self.last_symbol[streams] = symbols
+
+        # SNR Estimation, as per MFSKDemodulator.eval_s2n
+        rows = np.arange(len(streams))
+        sig = tone_mags[rows, symbols]
+        noise = tone_mags[rows, self.last_symbol2[streams]]*self.num_tones
+        valid = noise > 0
+        update = streams[valid]
+        s2n_instant = sig[valid]/noise[valid]
+        self.s2n[update] = s2n_instant*(1.0/16) + self.s2n[update]*(1.0 - 1.0/16)
+        self.s2n_instant[update] = s2n_instant
+
+        if self.block_callback == False:
+            return
+
+        records = np.zeros(len(streams), dtype=self.symbol_block_dtype)
+        records["symbol"] = symbols
+        records["sample"] = self.sample_count
+        records["s2n"] = self.s2n[streams]
+        records["s2n_instant"] = self.s2n_instant[streams]
+        records["timing"] = np.where(zero_crossing, "D", "F")
+        if self.soft_bits:
+            records["soft"] = tone_mags.dot(self.soft_weights)/np.sum(tone_mags, axis=1)[:,np.newaxis]
+
+        self.symbol_block.append((streams, records))
+
+    def emit_symbol_blocks(self):
+        """
+        Split the symbols collected during consume() up by stream, and pass them to the block callback.
+        """
+        streams = np.concatenate([x[0] for x in self.symbol_block])
+        records = np.concatenate([x[1] for x in self.symbol_block])
+        self.symbol_block = []
+
+        with np.errstate(divide='ignore'):
+            records["s2n"] = 20*np.log10(records["s2n"])
+            records["s2n_instant"] = 20*np.log10(records["s2n_instant"])
+
+        # A stable sort keeps each stream's symbols in time order.
+        order = np.argsort(streams, kind='mergesort')
+        streams = streams[order]
+        records = records[order]
+        boundaries = np.nonzero(np.diff(streams))[0] + 1
+
+        start = 0
+        for end in list(boundaries) + [len(streams)]:
+            self.block_callback(streams[start], records[start:end])
+            start = end
+
+
+# Test script.
+if __name__ == "__main__":
+    from scipy.io import wavfile
+    import time, MFSKDemodulator
+
+    fs, data = wavfile.read('generated_MFSK16_packets.wav')
+
+    data = pcm_to_float(data)
+
+    chunk_size = 1024
+
+    # Reference: a single MFSKDemodulator instance.
+    single_symbols = []
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate = fs, block_callback = single_symbols.append)
+    start = time.time()
+    for i in range(0, len(data), chunk_size):
+        demod.consume(data[i:i+chunk_size])
+    single_time = time.time() - start
+    single_symbols = np.concatenate(single_symbols)["symbol"]
+
+    for num_streams in [1, 4, 16, 64]:
+        multi_symbols = [[] for x in range(num_streams)]
+        def store_symbols(stream, symbols):
+            multi_symbols[stream].append(symbols)
+
+        multi = MFSKMultiDemodulator(num_streams, sample_rate = fs, block_callback = store_symbols)
+        streams = np.tile(data, (num_streams,1))
+        start = time.time()
+        for i in range(0, len(data), chunk_size):
+            multi.consume(streams[:,i:i+chunk_size])
+        multi_time = time.time() - start
+
+        matches = all(np.array_equal(np.concatenate(x)["symbol"], single_symbols) for x in multi_symbols)
+        print "%d streams: %.3f s (%.4f s/stream), single demodulator %.3f s. Symbols match: %s" % (num_streams, multi_time, multi_time/num_streams, single_time, matches)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# MFSKScanner.py - Detects MFSK signals across the passband, and starts demodulators for them.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from MFSKDemodulator import MFSKDemodulator
+import FFTBackend
+import logging
+
+# Modes the scanner looks for: (name, symbol_rate, num_tones, tone_spacing)
+MFSK_MODES = [
+    ("MFSK16", 15.625, 16, 15.625),
+    ("MFSK32", 31.25, 32, 31.25),
+    ("MFSK64", 15.625, 64, 15.625),
+]
+
+
+class MFSKScanner(object):
+    """ MFSK Signal Scanner Class
+
+    Looks for MFSK signals of any of a table of modes, anywhere between min_freq and max_freq, and starts an
+    MFSKDemodulator (with AFC enabled, to take up the remaining frequency error) for each one found.
+
+    Input is collected into windows of scan_length seconds. A single spectrogram is calculated for each window,
+    and every mode is tested against it at once:
+    - Comb detection: at every start frequency, and for each mode's bandwidth, the averaged spectrum is compared
+      against the spectrum just outside the band. The band must stand above it by the threshold, the spectrum
+      outside must be close to the noise floor, and most of the band (occupancy) must be within 10 dB of the
+      band's peak, so the band is both filled by the signal and bounded by its edges. (A single strong tone, such
+      as one half of a preamble, fills little of any band, and a few unused tones inside a wider signal don't
+      fall to the noise floor.) For each mode, only the best placed of any overlapping bands is kept.
+    - Keying rate detection: the strongest bin in each candidate band dips whenever the tone changes, so its
+      envelope has spectral lines at multiples of the symbol rate. The line at the symbol rate itself depends on
+      the data, so a rate is counted if there is a line at three times it (which a signal keyed at twice the rate
+      doesn't have), and at either it or twice it. The lowest mode symbol rate which qualifies is taken as the
+      keying rate.
+    Candidates are accepted in order of the power they account for (so a wide signal with a few unused tones isn't
+    split into narrower ones), as long as they don't overlap a signal already being demodulated.
+    New demodulators are given the previous scan window onwards, so the start of the transmission isn't lost.
+    A demodulator which hasn't output a symbol with an SNR of at least retire_s2n for retire_time seconds (the
+    transmission has ended, or it was squelched) is retired, and its band can be detected again.
+
+    sample_rate:    Sample rate of incoming data (Hz)
+    modes:          List of (name, symbol_rate, num_tones, tone_spacing) tuples.
+    min_freq:       Lowest frequency to search (Hz)
+    max_freq:       Highest frequency to search (Hz)
+    scan_length:    Length of each scan window (seconds)
+    threshold:      Power (dB) of a candidate band above the surrounding spectrum for it to be detected.
+    callback:       Function pointer. Called with each new MFSKDemodulator instance (which also has name, and
+                    the detected SNR as scan_level, added to it), before any samples are passed to it, so
+                    callbacks can be attached. Set the demodulator's block_callback in this function: the scanner
+                    wraps it afterwards, to watch for activity.
+    retire_time:    Time (seconds) without a symbol at or above retire_s2n before a demodulator is retired.
+    retire_s2n:     SNR (dB, as reported in the demodulator's symbol output) of a symbol which counts as activity.
+    retire_callback: Function pointer. Called with each MFSKDemodulator instance as it is retired.
+    demod_kwargs:   Any other keyword arguments are passed to each MFSKDemodulator.
+
+    """
+    def __init__(self, sample_rate=8000, modes=MFSK_MODES, min_freq=200, max_freq=3500, scan_length=4.0, threshold=6.0, callback=False, retire_time=10.0, retire_s2n=3.0, retire_callback=False, **demod_kwargs):
+        self.fs = sample_rate
+        self.modes = modes
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.threshold = threshold
+        self.callback = callback
+        self.retire_length = int(retire_time*self.fs)
+        self.retire_s2n = retire_s2n
+        self.retire_callback = retire_callback
+        self.demod_kwargs = demod_kwargs
+        self.demod_kwargs.setdefault('afc', True)
+
+        self.scan_length = int(scan_length*self.fs)
+        self.occupancy = 0.75 # Fraction of a candidate band which must be within 10 dB of its peak.
+        self.guard_level = 3.0 # Maximum power (dB) of the spectrum either side of a candidate band, above the noise floor.
+        self.keying_threshold = 12.0 # Envelope line power (dB) above the median of the envelope spectrum.
+
+        # Spectrogram parameters. Frames the length of the shortest symbol, so every mode's keying can be seen,
+        # with bins at a quarter of the narrowest tone spacing, so the tones are placed to within an eighth of a tone.
+        self.frame_length = int(round(self.fs/max([x[1] for x in self.modes])))
+        self.fft_length = int(round(self.fs/(min([x[3] for x in self.modes])/4.0)))
+        self.hop = max(1, self.frame_length//8)
+        self.bin_spacing = self.fs/float(self.fft_length)
+        self.frame_rate = self.fs/float(self.hop)
+
+        self.buffer = np.array([])
+        self.last_window = np.array([])
+        self.sample_count = 0
+        self.input_count = 0 # Samples consumed so far.
+        self.demods = [] # Running demodulators, each with the band (Hz) it covers in .band, and the input sample
+                         # at which it last output a symbol above retire_s2n in .last_active
+
+    def consume(self, data):
+        """
+        Consumes incoming (real) samples. These are passed to every running demodulator, and scanned once a
+        full window has been collected.
+        """
+        self.input_count = self.input_count + len(data)
+        for demod in self.demods:
+            demod.consume(data)
+        self.retire_demods()
+
+        self.buffer = np.append(self.buffer, data)
+        while len(self.buffer) >= self.scan_length:
+            window = self.buffer[:self.scan_length]
+            self.buffer = self.buffer[self.scan_length:]
+            for detection in self.scan(window):
+                self.start_demod(detection, np.concatenate((self.last_window, window, self.buffer)))
+            self.last_window = window
+            self.sample_count = self.sample_count + self.scan_length
+
+    def spectrogram(self, data):
+        """
+        Power spectrogram of a window of samples, one row per frame.
+        """
+        num_frames = (len(data) - self.frame_length)//self.hop + 1
+        frames = as_strided(data, shape=(num_frames, self.frame_length), strides=(data.strides[0]*self.hop, data.strides[0]))
+        return np.absolute(FFTBackend.rfft(frames*np.hanning(self.frame_length), n=self.fft_length, axis=1))**2
+
+    def scan(self, data):
+        """
+        Look for signals in a window of samples. Returns a list of detections, as dictionaries.
+        """
+        data = np.asarray(data, dtype=np.float)
+        spec = self.spectrogram(data)
+        power = np.mean(spec, axis=0)
+        cumulative = np.concatenate(([0], np.cumsum(power)))
+
+        lowest = int(np.ceil(self.min_freq/self.bin_spacing))
+        highest = int(self.max_freq/self.bin_spacing)
+        # The averaged noise power is close to its mean, so a low percentile of the spectrum gives the noise floor.
+        noise = np.percentile(power[lowest:highest], 25)
+
+        # Comb detection. Mean power of a guard band either side of each mode's band (clear of the outer tones'
+        # main lobes), at every start bin, and how much of the band is filled.
+        candidates = []
+        for mode_index, (name, symbol_rate, num_tones, tone_spacing) in enumerate(self.modes):
+            # The tones, plus half a symbol rate (the tones' main lobes) either side.
+            width = int(round(((num_tones - 1)*tone_spacing + symbol_rate)/self.bin_spacing))
+            gap = int(round(max(tone_spacing, 2*self.fs/float(self.frame_length))/self.bin_spacing))
+            guard = int(round(2*tone_spacing/self.bin_spacing))
+            start = np.arange(max(lowest, gap + guard), min(highest - width, len(power) - gap - guard - width) + 1)
+            if len(start) == 0:
+                continue
+
+            inside = (cumulative[start + width] - cumulative[start])/width
+            outside = (cumulative[start - gap] - cumulative[start - gap - guard] + cumulative[start + width + gap + guard] - cumulative[start + width + gap])/(2*guard)
+            band = power[start[:,np.newaxis] + np.arange(width)]
+            filled = np.mean(band >= np.max(band, axis=1)[:,np.newaxis]/10.0, axis=1)
+            with np.errstate(divide='ignore'):
+                level = 10*np.log10(inside/outside)
+
+            detected = (level >= self.threshold) & (filled >= self.occupancy) & (outside <= noise*10**(self.guard_level/10.0))
+            taken = np.zeros(len(start), dtype=bool)
+            for i in np.nonzero(detected)[0][np.argsort(-level[detected])]:
+                if taken[i]:
+                    continue
+                taken[max(0, i - width + 1):i + width] = True
+                # The tones' main lobes make the signal a little wider than the band, so the level is flat over
+                # a range of start bins. The signal is centred in the middle of that range.
+                edges = np.nonzero(level < level[i] - 1.0)[0]
+                low = np.max(edges[edges < i], initial=-1) + 1
+                high = np.min(edges[edges > i], initial=len(start))
+                centre = (low + high - 1)//2
+                candidates.append(((inside[i] - outside[i])*width, level[i], mode_index, start[centre], width))
+
+        if len(candidates) == 0:
+            return []
+
+        # Keying rate detection, for every candidate at once.
+        envelopes = np.array([spec[:,b:b+w].max(axis=1) for (p, l, m, b, w) in candidates])
+        envelopes = envelopes - np.mean(envelopes, axis=1)[:,np.newaxis]
+        line_power = np.absolute(FFTBackend.rfft(envelopes, axis=1))**2
+        line_freqs = np.fft.rfftfreq(envelopes.shape[1], 1.0/self.frame_rate)
+        rates = np.unique([x[1] for x in self.modes])
+        # Lines at the first three multiples of each rate (or just the rate, if they are above the envelope sample rate's Nyquist).
+        harmonics = rates*np.arange(1, 4)[:,np.newaxis]
+        harmonics = np.where(harmonics[2] < self.frame_rate/2, harmonics, rates)
+        with np.errstate(divide='ignore'):
+            lines = 10*np.log10(line_power[:,np.searchsorted(line_freqs, harmonics)]/np.median(line_power[:,1:], axis=1)[:,np.newaxis,np.newaxis])
+        lines = lines >= self.keying_threshold
+        keying = lines[:,2] & (lines[:,0] | lines[:,1])
+
+        # Most power first, skipping anything overlapping a running demodulator or an earlier detection.
+        detections = []
+        occupied = [demod.band for demod in self.demods]
+        for index in np.argsort([-x[0] for x in candidates]):
+            (excess, level, mode_index, start, width) = candidates[index]
+            (name, symbol_rate, num_tones, tone_spacing) = self.modes[mode_index]
+
+            keyed = np.nonzero(keying[index])[0]
+            if len(keyed) == 0 or rates[keyed[0]] != symbol_rate:
+                continue
+
+            band = (start*self.bin_spacing, (start + width)*self.bin_spacing)
+            if any(band[0] < high and low < band[1] for (low, high) in occupied):
+                continue
+            occupied.append(band)
+
+            base_freq = band[0] + symbol_rate/2.0
+            detection = {"name":name, "symbol_rate":symbol_rate, "num_tones":num_tones, "tone_spacing":tone_spacing,
+                "base_freq":base_freq, "level":level, "band":band, "sample":self.sample_count}
+            logging.debug("Detected %s" % str(detection))
+            detections.append(detection)
+
+        return detections
+
+    def start_demod(self, detection, history):
+        """
+        Start a demodulator for a detected signal, and give it the samples from the start of the window before the
+        one the signal was found in, up to the most recent sample.
+        """
+        demod = MFSKDemodulator(sample_rate=self.fs, base_freq=detection["base_freq"], symbol_rate=detection["symbol_rate"],
+            num_tones=detection["num_tones"], tone_spacing=detection["tone_spacing"], **self.demod_kwargs)
+        demod.name = detection["name"]
+        demod.band = detection["band"]
+        demod.scan_level = detection["level"]
+        demod.last_active = self.input_count
+        self.demods.append(demod)
+
+        if self.callback != False:
+            self.callback(demod)
+        demod.block_callback = self.activity_callback(demod, demod.block_callback)
+
+        demod.consume(history)
+
+    def activity_callback(self, demod, block_callback):
+        """
+        Block callback for a demodulator, which notes when it last output a symbol above retire_s2n, then passes the
+        symbols on to its original block_callback (if any).
+        """
+        def process_symbols(symbols):
+            if np.any(symbols["s2n"] >= self.retire_s2n):
+                demod.last_active = self.input_count
+            if block_callback != False:
+                block_callback(symbols)
+        return process_symbols
+
+    def retire_demods(self):
+        """
+        Stop the demodulators which have been inactive for retire_time, freeing their bands.
+        """
+        retired = [x for x in self.demods if self.input_count - x.last_active > self.retire_length]
+        if len(retired) == 0:
+            return
+
+        self.demods = [x for x in self.demods if x not in retired]
+        for demod in retired:
+            logging.debug("Retiring %s at %.1f Hz." % (demod.name, demod.base_freq))
+            if self.retire_callback != False:
+                self.retire_callback(demod)
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKModulator, Packetizer, DePacketizer, MFSKSymbolDecoder, time
+
+    sample_rate = 8000
+    # Signals at unknown (to the scanner) offsets: (name, base_freq, start time in seconds). The last one starts
+    # well after the first has finished, in the same band, so it is only found if the first demodulator is retired.
+    signals = [("MFSK16", 500, 1.0), ("MFSK32", 1000, 3.0), ("MFSK64", 2312.5, 0.5), ("MFSK16", 515.625, 28.0)]
+    modes = dict([(x[0], x[1:]) for x in MFSK_MODES])
+
+    p = Packetizer.Packetizer()
+    audio = []
+    for (name, base_freq, start) in signals:
+        (symbol_rate, num_tones, tone_spacing) = modes[name]
+        sym_bits = int(np.log2(num_tones))
+        mod = MFSKModulator.MFSKModulator(sample_rate=sample_rate, symbol_rate=symbol_rate, tone_spacing=tone_spacing, base_freq=base_freq, amplitude=0.2)
+        mod.write(np.zeros(int(start*sample_rate)))
+        mod.modulate_symbol([0,num_tones-1]*15)
+        bits = np.unpackbits(np.fromstring(p.pack_message("Hello from %s" % name)*3, dtype=np.uint8))
+        mod.modulate_bits(sym_bits, np.append(bits, np.zeros((-len(bits)) % sym_bits, dtype=np.uint8)))
+        mod.modulate_symbol([0]*20)
+        audio.append(mod.emit_all())
+
+    signal = np.zeros(max([len(x) for x in audio]) + 2*sample_rate)
+    for x in audio:
+        signal[:len(x)] += x
+    signal = signal + 0.05*np.random.randn(len(signal))
+
+    def make_symbol_parser(demod):
+        symb_dec = MFSKSymbolDecoder.MFSKSymbolDecoder(num_tones=demod.num_tones, gray_coded=True)
+        def print_payload(payload):
+            print "%s at %.1f Hz: %s" % (demod.name, demod.base_freq, payload)
+        packet_extract = DePacketizer.DePacketizer(callback=print_payload)
+        def parse_symbol(symbols):
+            for symbol in symbols["symbol"]:
+                packet_extract.process_data(symb_dec.tone_to_bits(symbol))
+        return parse_symbol
+
+    def new_signal(demod):
+        print "Found %s at %.1f Hz (%.1f dB)" % (demod.name, demod.base_freq, demod.scan_level)
+        demod.block_callback = make_symbol_parser(demod)
+
+    def signal_ended(demod):
+        print "Retired %s at %.1f Hz" % (demod.name, demod.base_freq)
+
+    scanner = MFSKScanner(sample_rate=sample_rate, callback=new_signal, retire_callback=signal_ended)
+    start = time.time()
+    chunk_size = 1024
+    for i in range(0, len(signal), chunk_size):
+        scanner.consume(signal[i:i+chunk_size])
+    print "Processed %.1f seconds of audio in %.2f seconds." % (len(signal)/float(sample_rate), time.time() - start)
@@ -17,6 +17,7 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
+import os
 
 def gray_decode(tone):
     """ Gray-decode the received tone number """
@@ -33,3 +34,125 @@ def gray_encode(data):
     bits ^= data >> 7;
 
     return bits;
+
+def soft_decode_weights(num_tones, gray_coded = True):
+    """ Matrix (num_tones x sym_bits) of +-1 bit weights for each tone, as used by soft decoding.
+    Multiplying a vector of tone bin magnitudes by this matrix gives the (unnormalised) soft bits.
+    """
+    sym_bits = int(np.log2(num_tones))
+    tones = np.arange(num_tones)
+    if gray_coded:
+        tones = gray_decode(tones)
+
+    bits = (tones[:,np.newaxis] >> np.arange(sym_bits-1,-1,-1)) & 1
+    return 2.0*bits - 1
+
+def hard_decode_tones(tones):
+    """ Hard decision for an array of tone bin magnitudes (... x num_tones): the index of the strongest tone. """
+    return np.argmax(tones, axis=-1)
+
+def soft_decode_tones(tones, gray_coded = True):
+    """ Soft bits (as per MFSKDemodulator.soft_decode) for an array of tone bin magnitudes (... x num_tones).
+    Returns an array of (... x sym_bits) values, normalised to +-1. Symbols with no energy at all (digital
+    silence) give zeros.
+    """
+    tones = np.asarray(tones)
+    total = np.sum(tones, axis=-1)[...,np.newaxis]
+    return tones.dot(soft_decode_weights(tones.shape[-1], gray_coded))/np.maximum(total, np.finfo(np.float32).tiny)
+
+def tones_to_bits(symbols, num_tones, gray_coded = True):
+    """ Convert an array of received tone numbers to a flat array of bits (MSB first), as uint8 0/1 values. """
+    sym_bits = int(np.log2(num_tones))
+    symbols = np.asarray(symbols, dtype=np.int64)
+    if gray_coded:
+        symbols = gray_decode(symbols)
+
+    return ((symbols[:,np.newaxis] >> np.arange(sym_bits-1,-1,-1)) & 1).astype(np.uint8).ravel()
+
+def select_decimation(sample_rate, symbol_rate, bandwidth):
+    """ Find the largest integer decimation factor for which the decimated sample rate is still at least
+    (bandwidth) Hz, and is an integer multiple of the symbol rate, so each symbol is a whole number of samples.
+    """
+    best = 1
+    for decimation in range(1, int(sample_rate//bandwidth) + 1):
+        samples_per_symbol = float(sample_rate)/decimation/symbol_rate
+        if abs(samples_per_symbol - round(samples_per_symbol)) < 1e-9:
+            best = decimation
+
+    return best
+
+def complex_dtype(dtype):
+    """ The complex dtype matching a real dtype, i.e. np.float32 -> np.complex64, np.float64 -> np.complex128 """
+    return np.promote_types(dtype, np.complex64)
+
+def pcm_to_float(data, dtype = np.float64):
+    """ Convert integer PCM samples (as read from a WAV file) to floating point in the range +-1.0.
+
+    data:   Array of samples. int16 and int32 are scaled by 2^15 and 2^31. uint8 (which is offset binary) is
+            scaled by 2^7 about 128. Floating point samples are passed through.
+    dtype:  Floating point dtype of the output (np.float64 or np.float32).
+    """
+    data = np.asarray(data)
+    dtype = np.dtype(dtype)
+    if data.dtype == np.uint8:
+        return (data.astype(dtype) - 128)/dtype.type(2**7)
+    elif data.dtype.kind == 'i':
+        return data.astype(dtype)/dtype.type(2**(8*data.dtype.itemsize - 1))
+    else:
+        return data.astype(dtype)
+
+def symbol_dtype(sym_bits = 0):
+    """ NumPy structured dtype used for batched symbol output.
+
+    sym_bits:   If >0, a 'soft' field holding that many soft bit values is added.
+    """
+    fields = [("symbol", np.int32), ("sample", np.int64), ("s2n", np.float64), ("s2n_instant", np.float64), ("timing", "S1")]
+    if sym_bits > 0:
+        fields.append(("soft", np.float64, (sym_bits,)))
+
+    return np.dtype(fields)
+
+def capture_dtype(num_tones):
+    """ NumPy structured dtype of the per-symbol records saved by SymbolCapture.
+
+    num_tones:  Number of tone bin magnitudes stored for each symbol.
+    """
+    return np.dtype([("sample", np.int64), ("s2n", np.float32), ("s2n_instant", np.float32), ("timing", "S1"), ("tones", np.float32, (num_tones,))])
+
+# Version of the state dictionaries produced by get_state(). Bump this if their contents change.
+STATE_VERSION = 1
+
+def save_state(filename, state):
+    """ Save a state dictionary (see MFSKDemodulator.get_state) to a .npz file.
+
+    The file is written under a temporary name (unique to this save, in the same directory) and then renamed, so
+    an interrupted save never leaves a truncated checkpoint behind, and concurrent saves don't share a file.
+    """
+    import tempfile
+    (handle, temp_filename) = tempfile.mkstemp(prefix = os.path.basename(filename) + ".", suffix = ".tmp", dir = os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            np.savez(f, **state)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+def load_state(filename):
+    """ Load a state dictionary saved by save_state. Only plain arrays are accepted (no pickled objects).
+    Raises ValueError if the file was written by a different STATE_VERSION.
+    """
+    with np.load(filename, allow_pickle = False) as f:
+        state = dict(f.items())
+    if int(state.get("state_version", -1)) != STATE_VERSION:
+        raise ValueError("%s: unsupported state version %s." % (filename, state.get("state_version")))
+    return state
+
+def check_state(state, config):
+    """ Raise ValueError if a state dictionary was saved with a different configuration.
+
+    config: Dictionary of configuration values, which must match those in the state.
+    """
+    for (key, value) in config.items():
+        if key not in state or state[key] != value:
+            raise ValueError("State does not match this configuration (%s is %s, expected %s)." % (key, state.get(key), value))
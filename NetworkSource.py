@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# NetworkSource.py - Receive PCM audio over UDP or TCP, and feed it to the demodulator.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import socket, select, struct, time, collections, logging
+import MFSKDemodulator, DePacketizer
+from ModemUtils import *
+
+
+class JitterBuffer(object):
+    """ Jitter Buffer Class
+
+    Puts sequence numbered blocks back into order. Blocks are held until the next expected block arrives, or
+    until more than (depth) blocks are waiting, at which point the missing block is given up on as lost.
+    Blocks which arrive after they have been given up on (or already played out) are counted as late.
+
+    depth:  Number of blocks to wait for a missing block.
+
+    """
+    def __init__(self, depth = 4):
+        self.depth = depth
+        self.blocks = {}
+        self.next = None
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+
+    def put(self, sequence, block, arrival):
+        """
+        Add a block. Returns a list of (block, arrival time) ready to be played out, in order.
+        Lost blocks are returned as (None, arrival time).
+        """
+        if self.next == None:
+            self.next = sequence
+        if sequence < self.next:
+            self.late += 1
+            return []
+        if sequence in self.blocks:
+            self.duplicates += 1
+            return []
+
+        self.blocks[sequence] = (block, arrival)
+        return self.release(self.depth)
+
+    def release(self, depth):
+        ready = []
+        while len(self.blocks) > 0 and (self.next in self.blocks or len(self.blocks) > depth):
+            if self.next in self.blocks:
+                ready.append(self.blocks.pop(self.next))
+            else:
+                self.lost += 1
+                ready.append((None, min([x[1] for x in self.blocks.values()])))
+            self.next += 1
+        return ready
+
+    def flush(self):
+        """ Play out everything still held. """
+        return self.release(0)
+
+
+class LatencyStats(object):
+    """ Running count, mean and maximum of a latency (s). """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def summary(self):
+        return {"count": self.count, "mean": self.total/self.count if self.count > 0 else 0.0, "max": self.max}
+
+
+class NetworkReceiver(object):
+    """ Network PCM Receiver Class
+
+    Receives raw PCM audio over UDP or TCP, and feeds it through MFSKDemodulator and DePacketizer.
+    The PCM bytes are converted with np.frombuffer (no intermediate copy) and pcm_to_float.
+
+    UDP:    Each datagram holds a block of samples. If sequence_header is True, each datagram starts with a
+            big-endian uint32 sequence number, and blocks go through a JitterBuffer to undo reordering;
+            lost blocks are replaced with silence, so sample timing is preserved.
+    TCP:    The receiver listens for one connection, and treats it as a continuous stream of samples.
+
+    End-to-end latency is measured from the arrival of the datagram (or TCP read) holding the last sample
+    of each symbol, to the demodulator's decision on that symbol, and to the DePacketizer's output for each
+    packet. See stats().
+
+    port, host:         Address to listen on.
+    protocol:           "udp" or "tcp".
+    sample_format:      NumPy dtype of the PCM samples, e.g. '<i2' (little-endian int16) or '<f4'.
+    sequence_header:    UDP only. Whether datagrams start with a sequence number.
+    jitter_depth:       UDP only. Number of blocks to wait for a missing (sequence numbered) block.
+    callback:           Function pointer. Called with a dictionary for each packet: sample, s2n, crc, payload
+                        and latency (s).
+    sync_bytes, payload_length_cap:     Passed to DePacketizer.
+    Any other keyword arguments (sample_rate, base_freq, afc, etc) are passed to MFSKDemodulator.
+
+    """
+    def __init__(self, port = 7355, host = "127.0.0.1", protocol = "udp", sample_format = '<i2', sequence_header = False, jitter_depth = 4,
+            callback = False, sync_bytes = '\xAB\xCD', payload_length_cap = 32, **demod_kwargs):
+        self.protocol = protocol
+        self.sample_format = np.dtype(sample_format)
+        self.sequence_header = sequence_header
+        self.callback = callback
+
+        self.demod = MFSKDemodulator.MFSKDemodulator(block_callback = self.process_symbols, **demod_kwargs)
+        self.packet_extract = DePacketizer.DePacketizer(sync_bytes = sync_bytes, payload_length_cap = payload_length_cap, callback = self.store_packet)
+        self.jitter = JitterBuffer(jitter_depth)
+
+        self.samples_received = 0
+        self.last_block_length = 0
+        self.malformed = 0
+        # (Last sample + 1, arrival time) of each block fed to the demodulator, for the latency measurements.
+        self.arrivals = collections.deque()
+        self.symbol_latency = LatencyStats()
+        self.packet_latency = LatencyStats()
+        self.state = {"sample": 0, "s2n": 0.0, "latency": 0.0}
+
+        self.connection = None
+        self.remainder = ""
+        self.closed = False
+        if protocol == "udp":
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self.socket.bind((host, port))
+        elif protocol == "tcp":
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host, port))
+            self.socket.listen(1)
+        else:
+            raise ValueError("Unknown protocol '%s'. Use 'udp' or 'tcp'." % protocol)
+        self.port = self.socket.getsockname()[1]
+
+    def poll(self, timeout = 0.1):
+        """
+        Wait up to timeout seconds for data, and process everything which has arrived.
+        Returns False once a TCP sender has disconnected.
+        """
+        sock = self.connection if self.connection != None else self.socket
+        (readable, writable, errored) = select.select([sock], [], [], timeout)
+        if len(readable) == 0:
+            return not self.closed
+
+        if self.protocol == "udp":
+            while True:
+                try:
+                    datagram = self.socket.recv(65536, socket.MSG_DONTWAIT)
+                except socket.error:
+                    break
+                self.receive_datagram(datagram, time.time())
+        elif self.connection == None:
+            (self.connection, address) = self.socket.accept()
+            logging.info("PCM connection from %s:%d" % address)
+        else:
+            data = self.connection.recv(65536)
+            if len(data) == 0:
+                self.closed = True
+            else:
+                self.receive_stream(data, time.time())
+        return not self.closed
+
+    def run(self, duration = None):
+        """ Receive and decode until the TCP sender disconnects, or for (duration) seconds. """
+        start = time.time()
+        while duration == None or time.time() - start < duration:
+            if not self.poll():
+                break
+
+    def receive_datagram(self, datagram, arrival):
+        if self.sequence_header:
+            if len(datagram) < 4:
+                self.malformed += 1
+                return
+            sequence = struct.unpack(">I", datagram[:4])[0]
+            blocks = self.jitter.put(sequence, datagram, arrival)
+        else:
+            blocks = [(datagram, arrival)]
+
+        for (block, block_arrival) in blocks:
+            self.play_block(block, block_arrival)
+
+    def play_block(self, block, arrival):
+        if block == None:
+            # Lost. Keep the sample timing with a block of silence.
+            self.feed(np.zeros(self.last_block_length, dtype=self.demod.dtype), arrival)
+            return
+        offset = 4 if self.sequence_header else 0
+        if (len(block) - offset) % self.sample_format.itemsize != 0:
+            self.malformed += 1
+            return
+        samples = np.frombuffer(block, dtype=self.sample_format, offset=offset)
+        self.last_block_length = len(samples)
+        self.feed(pcm_to_float(samples, self.demod.dtype), arrival)
+
+    def receive_stream(self, data, arrival):
+        data = self.remainder + data
+        usable = len(data) - len(data) % self.sample_format.itemsize
+        self.remainder = data[usable:]
+        self.feed(pcm_to_float(np.frombuffer(data[:usable], dtype=self.sample_format), self.demod.dtype), arrival)
+
+    def feed(self, samples, arrival):
+        self.samples_received = self.samples_received + len(samples)
+        self.arrivals.append((self.samples_received, arrival))
+        self.demod.consume(samples)
+
+    def flush(self):
+        """ Play out anything held in the jitter buffer. """
+        for (block, arrival) in self.jitter.flush():
+            self.play_block(block, arrival)
+
+    def arrival_time(self, sample):
+        # Arrival time of the block holding (sample). Symbols come out in order, so older blocks can be forgotten.
+        while len(self.arrivals) > 1 and self.arrivals[0][0] < sample:
+            self.arrivals.popleft()
+        return self.arrivals[0][1]
+
+    def process_symbols(self, symbols):
+        now = time.time()
+        bits = tones_to_bits(symbols["symbol"], self.demod.num_tones, self.demod.gray_coded).reshape(len(symbols), -1)
+        for i in range(len(symbols)):
+            self.state["sample"] = int(symbols["sample"][i])
+            self.state["s2n"] = float(symbols["s2n"][i])
+            self.state["latency"] = now - self.arrival_time(self.state["sample"])
+            self.symbol_latency.add(self.state["latency"])
+            self.packet_extract.process_data(bits[i])
+
+    def store_packet(self, payload):
+        latency = time.time() - self.arrival_time(self.state["sample"])
+        self.packet_latency.add(latency)
+        if self.callback != False:
+            self.callback({"sample": self.state["sample"], "s2n": self.state["s2n"], "crc": self.packet_extract.packet_crc, "payload": payload, "latency": latency})
+
+    def stats(self):
+        """
+        Dictionary of receive counters (samples, lost, late, duplicate and malformed blocks), and symbol and
+        packet latency (count, mean and max, in seconds).
+        """
+        return {"samples": self.samples_received, "lost": self.jitter.lost, "late": self.jitter.late, "duplicates": self.jitter.duplicates,
+            "malformed": self.malformed, "symbol_latency": self.symbol_latency.summary(), "packet_latency": self.packet_latency.summary()}
+
+    def close(self):
+        if self.connection != None:
+            self.connection.close()
+        self.socket.close()
+
+
+# Test script.
+if __name__ == "__main__":
+    import threading
+    from scipy.io import wavfile
+
+    fs, pcm = wavfile.read('generated_MFSK16_packets.wav')
+    pcm = np.append(pcm, np.zeros(fs, dtype=np.int16)).astype('<i2')
+    block = 256
+
+    def print_payload(packet):
+        print "  %s (sample %d, %.1f ms after arrival)" % (packet["payload"], packet["sample"], packet["latency"]*1e3)
+
+    def print_stats(receiver):
+        stats = receiver.stats()
+        print "  Samples %d, lost %d, late %d, duplicates %d, malformed %d" % (stats["samples"], stats["lost"], stats["late"], stats["duplicates"], stats["malformed"])
+        for name in ["symbol_latency", "packet_latency"]:
+            print "  %s: %d, mean %.1f ms, max %.1f ms" % (name, stats[name]["count"], stats[name]["mean"]*1e3, stats[name]["max"]*1e3)
+
+    # UDP, at 4x realtime, with some datagrams swapped over, one delivered very late, and one never sent.
+    print "UDP:"
+    receiver = NetworkReceiver(port = 0, protocol = "udp", sequence_header = True, sample_rate = fs, callback = print_payload)
+    def send_udp():
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        order = range(len(pcm)//block)
+        order[10], order[11] = order[11], order[10]
+        order.remove(40)
+        order.remove(60)
+        order.insert(order.index(100), 60)
+        order.remove(200)
+        for sequence in order:
+            sender.sendto(struct.pack(">I", sequence) + pcm[sequence*block:(sequence+1)*block].tostring(), ("127.0.0.1", receiver.port))
+            time.sleep(block/float(fs)/4)
+    sender = threading.Thread(target = send_udp)
+    sender.start()
+    receiver.run(duration = len(pcm)/float(fs)/4 + 1.0)
+    receiver.flush()
+    sender.join()
+    print_stats(receiver)
+    receiver.close()
+
+    # TCP, in odd sized writes.
+    print "TCP:"
+    receiver = NetworkReceiver(port = 0, protocol = "tcp", sample_rate = fs, callback = print_payload)
+    def send_tcp():
+        sender = socket.create_connection(("127.0.0.1", receiver.port))
+        data = pcm.tostring()
+        for i in range(0, len(data), 1001):
+            sender.sendall(data[i:i+1001])
+            time.sleep(500.5/fs/4)
+        sender.close()
+    sender = threading.Thread(target = send_tcp)
+    sender.start()
+    receiver.run()
+    sender.join()
+    print_stats(receiver)
+    receiver.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Pipeline.py - Streaming decode pipeline, with each stage running in its own thread.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import Queue, threading, time, logging
+import MFSKDemodulator, DePacketizer
+from ModemUtils import *
+
+# Queue marker which shuts a stage down, after everything queued ahead of it has been processed.
+_STOP = object()
+
+
+class PipelineStage(object):
+    """ Pipeline Stage Class
+
+    Runs a processing function on a worker thread, taking its input from a bounded queue. Whatever the
+    function returns (a list of output items) is passed on to the input queues of the downstream stages.
+
+    Each item carries the time it entered the pipeline, so the latency from audio input to any stage can be
+    measured, as well as the time spent waiting in, and processing, this stage.
+
+    name:       Name of the stage, for the metrics.
+    process:    Function, called with each input item. Returns a list of output items (or None).
+    queue_size: Maximum number of items waiting for this stage.
+    drop:       If True, items arriving at a full queue are dropped (and counted), rather than blocking the
+                upstream stage. Used for sinks, so a slow sink can never stall the rest of the pipeline.
+
+    """
+    def __init__(self, name, process, queue_size = 16, drop = False):
+        self.name = name
+        self.process = process
+        self.queue = Queue.Queue(queue_size)
+        self.drop = drop
+        self.outputs = []
+
+        # Metrics
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_latency = 0.0    # Time from entering the pipeline to leaving this stage (s), summed.
+        self.max_latency = 0.0
+        self.total_busy = 0.0       # Time spent in the processing function (s)
+
+        self.thread = threading.Thread(target = self.run, name = name)
+        self.thread.daemon = True
+
+    def put(self, item, origin, block = True):
+        """
+        Queue an item. (origin) is the time the data it came from entered the pipeline.
+        Returns False if the item was dropped.
+        """
+        if self.drop or not block:
+            try:
+                self.queue.put_nowait((origin, item))
+            except Queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            self.queue.put((origin, item))
+
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def stop(self):
+        # The stop marker must not be dropped, even on a full sink queue.
+        self.queue.put((None, _STOP))
+
+    def run(self):
+        while True:
+            (origin, item) = self.queue.get()
+            if item is _STOP:
+                for output in self.outputs:
+                    output.stop()
+                return
+
+            start = time.time()
+            try:
+                results = self.process(item)
+            except Exception:
+                logging.exception("Pipeline stage %s failed." % self.name)
+                results = None
+            now = time.time()
+
+            self.processed += 1
+            self.total_busy += now - start
+            self.total_latency += now - origin
+            self.max_latency = max(self.max_latency, now - origin)
+
+            for result in results or []:
+                for output in self.outputs:
+                    output.put(result, origin)
+
+    def metrics(self):
+        return {"processed": self.processed, "dropped": self.dropped, "queued": self.queue.qsize(), "max_queued": self.max_depth,
+            "mean_latency": self.total_latency/self.processed if self.processed > 0 else 0.0, "max_latency": self.max_latency,
+            "busy": self.total_busy}
+
+
+class DecodePipeline(object):
+    """ Streaming Decode Pipeline Class
+
+    audio -> MFSKDemodulator -> symbols to bits -> DePacketizer -> sinks
+
+    Each stage runs on its own thread, connected by bounded queues. If the DSP falls behind, feed() blocks
+    (backpressure), so audio is never silently lost between stages. Each sink has its own queue and thread,
+    and drops packets (counting them) rather than blocking if it falls behind, so slow sinks (database
+    writes, network uploads) never stall sample ingestion.
+
+    Packets are passed to the sinks as dictionaries containing:
+        sample:     Input sample at which the last symbol of the packet was detected.
+        s2n:        Signal to noise estimate (dB) at the end of the packet.
+        crc:        Packet CRC.
+        payload:    Packet payload.
+
+    queue_size:             Maximum number of items queued between the processing stages.
+    sync_bytes, payload_length_cap:     Passed to DePacketizer.
+    Any other keyword arguments (sample_rate, base_freq, afc, etc) are passed to MFSKDemodulator.
+
+    """
+    def __init__(self, queue_size = 16, sync_bytes = '\xAB\xCD', payload_length_cap = 32, **demod_kwargs):
+        self.demod = MFSKDemodulator.MFSKDemodulator(block_callback = self.store_symbols, **demod_kwargs)
+        self.packet_extract = DePacketizer.DePacketizer(sync_bytes = sync_bytes, payload_length_cap = payload_length_cap, callback = self.store_packet)
+        self.symbols = []
+        self.packets = []
+        self.state = {"sample": 0, "s2n": 0.0}
+
+        self.stages = [PipelineStage("demod", self.demod_stage, queue_size),
+            PipelineStage("bits", self.bits_stage, queue_size),
+            PipelineStage("depacketizer", self.packet_stage, queue_size)]
+        for (stage, next_stage) in zip(self.stages[:-1], self.stages[1:]):
+            stage.outputs.append(next_stage)
+        self.sinks = []
+        self.started = False
+
+    def add_sink(self, function, name = None, queue_size = 256):
+        """
+        Add a function to be called with each decoded packet. Must be called before start().
+        """
+        sink = PipelineStage(name or "sink%d" % len(self.sinks), function, queue_size, drop = True)
+        self.stages[-1].outputs.append(sink)
+        self.sinks.append(sink)
+        return sink
+
+    def start(self):
+        for stage in self.stages + self.sinks:
+            stage.thread.start()
+        self.started = True
+
+    def feed(self, data, block = True):
+        """
+        Pass a chunk of audio into the pipeline. Blocks while the demodulator's queue is full, unless block
+        is False, in which case the chunk is dropped (and counted). Returns False if the chunk was dropped.
+        """
+        if not self.started:
+            self.start()
+        return self.stages[0].put(data, time.time(), block)
+
+    def close(self, timeout = None):
+        """
+        Flush everything through the pipeline, and stop all the threads.
+        """
+        self.stages[0].stop()
+        for stage in self.stages + self.sinks:
+            stage.thread.join(timeout)
+
+    # Stage functions. Each runs on its own thread.
+    def store_symbols(self, symbols):
+        self.symbols.append(symbols)
+
+    def demod_stage(self, data):
+        self.demod.consume(data)
+        symbols = self.symbols
+        self.symbols = []
+        return symbols
+
+    def bits_stage(self, symbols):
+        bits = tones_to_bits(symbols["symbol"], self.demod.num_tones, self.demod.gray_coded).reshape(len(symbols), -1)
+        return [(bits, symbols["sample"], symbols["s2n"])]
+
+    def store_packet(self, payload):
+        self.packets.append({"sample": self.state["sample"], "s2n": self.state["s2n"], "crc": self.packet_extract.packet_crc, "payload": payload})
+
+    def packet_stage(self, item):
+        (bits, samples, s2n) = item
+        for i in range(len(bits)):
+            self.state["sample"] = int(samples[i])
+            self.state["s2n"] = float(s2n[i])
+            self.packet_extract.process_data(bits[i])
+        packets = self.packets
+        self.packets = []
+        return packets
+
+    def metrics(self):
+        """
+        Dictionary of metrics for each stage (and sink): items processed and dropped, current and maximum queue
+        depth, mean and maximum latency from audio input to the end of that stage (s), and busy time (s).
+        """
+        return dict([(stage.name, stage.metrics()) for stage in self.stages + self.sinks])
+
+
+# Test script.
+if __name__ == "__main__":
+    from FileSource import FileSource
+
+    pipeline = DecodePipeline(sample_rate = 8000)
+
+    def print_payload(packet):
+        print "Packet at sample %d (%.1f dB): %s" % (packet["sample"], packet["s2n"], packet["payload"])
+
+    def slow_upload(packet):
+        # Something which takes far longer than the audio does to arrive.
+        time.sleep(2.0)
+
+    pipeline.add_sink(print_payload, "print")
+    pipeline.add_sink(slow_upload, "upload", queue_size = 1)
+
+    # Feed the test file in 1024 sample chunks, recording how long feed() takes.
+    source = FileSource('generated_MFSK16_packets.wav', chunk_size = 1024)
+    start = time.time()
+    max_feed = 0
+    for chunk in source:
+        feed_start = time.time()
+        pipeline.feed(chunk)
+        max_feed = max(max_feed, time.time() - feed_start)
+    feed_time = time.time() - start
+
+    pipeline.close()
+    print "Fed %.1f s of audio in %.2f s (longest feed() call %.1f ms), all stages done after %.2f s." % (source.duration, feed_time,
+        max_feed*1e3, time.time() - start)
+    for (name, metrics) in sorted(pipeline.metrics().items()):
+        print "%-14s processed %4d, dropped %d, max queued %2d, latency mean %6.1f ms, max %6.1f ms, busy %.2f s" % (name,
+            metrics["processed"], metrics["dropped"], metrics["max_queued"], metrics["mean_latency"]*1e3, metrics["max_latency"]*1e3, metrics["busy"])
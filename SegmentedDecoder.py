@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# SegmentedDecoder.py - Parallel decoding of long recordings, in overlapping segments.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import hashlib, multiprocessing, logging, os
+import MFSKDemodulator, DePacketizer, MFSKSymbolDecoder, FFTBackend
+from FileSource import FileSource
+from ModemUtils import STATE_VERSION, save_state, load_state
+
+
+def unprefix(state, prefix):
+    """ The entries of a combined state dictionary which start with prefix, with the prefix removed. """
+    return dict([(key[len(prefix):], value) for (key, value) in state.items() if key.startswith(prefix)])
+
+
+def decode_segment(job):
+    """
+    Demodulate and depacketize one segment of a file. This runs in the worker processes, so it opens the
+    (memory-mapped) file itself, and only reads its own segment.
+
+    job:    Tuple of (filename, start sample, end sample, flush, include_failed, source_kwargs, demod_kwargs,
+            depacketizer_kwargs, state). If flush is True, a few symbols of silence are fed in after the segment, so a
+            packet right at the end of the file is still output. If include_failed is True, packets which fail
+            their CRC check are also returned. If state is None, the segment is decoded from scratch. Otherwise the
+            demodulator and depacketizer carry on from the state left by the previous segment (an empty dictionary
+            for the first segment), which must end exactly where this one starts.
+
+    Returns (packets, state): a list of packet dictionaries (see SegmentedDecoder), with absolute sample positions,
+    and, if a state was passed in, the state at the end of the segment for the next one to carry on from.
+    """
+    (filename, start, end, flush, include_failed, source_kwargs, demod_kwargs, depacketizer_kwargs, state) = job
+
+    source = FileSource(filename, **source_kwargs)
+    source.seek(start)
+
+    packets = []
+    current = {"sample": 0, "s2n": 0.0}
+    # A demodulator carried on from an earlier segment already counts samples from the start of the file.
+    origin = start if state == None else 0
+
+    def store_packet(payload, crc_ok = True):
+        packets.append({"sample": origin + current["sample"], "s2n": current["s2n"], "crc": packet_extract.packet_crc, "crc_ok": crc_ok, "payload": payload})
+
+    def store_failed(payload):
+        store_packet(payload, crc_ok = False)
+
+    packet_extract = DePacketizer.DePacketizer(callback = store_packet, failed_callback = store_failed if include_failed else False, **depacketizer_kwargs)
+
+    def parse_symbols(symbols):
+        for record in symbols:
+            current["sample"] = int(record["sample"])
+            current["s2n"] = float(record["s2n"])
+            packet_extract.process_data(symb_dec.tone_to_bits(record["symbol"]))
+
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate = source.sample_rate, block_callback = parse_symbols, **demod_kwargs)
+    symb_dec = MFSKSymbolDecoder.MFSKSymbolDecoder(num_tones = demod.num_tones, gray_coded = demod.gray_coded)
+    if state:
+        demod.set_state(unprefix(state, "demod_"))
+        packet_extract.set_state(unprefix(state, "depacketizer_"))
+
+    while source.position < end:
+        demod.consume(source.read(min(source.chunk_size, end - source.position)))
+
+    if state != None:
+        state = dict([("demod_" + key, value) for (key, value) in demod.get_state().items()] +
+            [("depacketizer_" + key, value) for (key, value) in packet_extract.get_state().items()])
+
+    if flush:
+        demod.consume(np.zeros(4*demod.symbol_length*demod.decimation))
+
+    return (packets, state)
+
+
+class SegmentedDecoder(object):
+    """ Parallel Segmented Decoder Class
+
+    Decodes a long recording by splitting it into segments, which are demodulated and depacketized in a pool
+    of worker processes. Each segment starts (overlap) samples before the end of the previous one, so a
+    packet which straddles a segment boundary is still completely contained in one segment, after the
+    demodulator has had time to acquire symbol timing (and frequency, if afc is used). A packet which ends in the overlap region, and was also
+    found (with the same CRC and payload, within a couple of symbols) by the previous segment, is only output once.
+    Repeated packets which are genuinely sent more than once are all output.
+
+    Packets are returned in time order, as dictionaries containing:
+        sample:     Input sample at which the last symbol of the packet was detected.
+        s2n:        Signal to noise estimate (dB) at the end of the packet.
+        crc:        Packet CRC.
+        crc_ok:     True if the packet passed its CRC check.
+        payload:    Packet payload.
+
+    segment_length:     Length of each segment (seconds), not including the overlap.
+    num_workers:        Number of worker processes. Defaults to the number of CPUs. If 1, segments are
+                        decoded in this process.
+    acquisition_time:   Time allowed for the demodulator to acquire timing, in symbols. If afc is used, the
+                        two coarse searches needed for the first frequency lock are added, and if tracking is
+                        used, the symbols needed to lock it. The overlap is this plus the longest possible packet.
+    include_failed:     If True, packets which fail their CRC check are also returned (with crc_ok False).
+    checkpoint_dir:     If set, files are decoded one segment after another in this process, with no overlap: each
+                        segment carries on from the demodulator and depacketizer state left by the previous one.
+                        After each segment the state is saved to (checkpoint_dir)/(file name).(path hash).state.npz,
+                        and an interrupted decode of the same file resumes from there. Packets output after the last
+                        checkpoint may be output again on resume. The checkpoint is deleted once the file is done.
+    channel, dtype, raw_format, sample_rate, num_channels:  Passed to FileSource.
+    sync_bytes, payload_length_cap:                         Passed to DePacketizer.
+    Any other keyword arguments (base_freq, symbol_rate, num_tones, afc, etc) are passed to MFSKDemodulator.
+
+    """
+    def __init__(self, segment_length = 300.0, num_workers = None, acquisition_time = 32, include_failed = False, checkpoint_dir = None, channel = 0, dtype = np.float64,
+            raw_format = None, sample_rate = 8000, num_channels = 1, sync_bytes = '\xAB\xCD', payload_length_cap = 32, **demod_kwargs):
+        self.segment_length = segment_length
+        self.num_workers = num_workers if num_workers != None else multiprocessing.cpu_count()
+        self.acquisition_time = acquisition_time
+        self.include_failed = include_failed
+        self.checkpoint_dir = checkpoint_dir
+
+        self.source_kwargs = {"channel": channel, "dtype": dtype, "raw_format": raw_format, "sample_rate": sample_rate, "num_channels": num_channels}
+        self.depacketizer_kwargs = {"sync_bytes": sync_bytes, "payload_length_cap": payload_length_cap}
+        self.demod_kwargs = demod_kwargs
+        self.demod_kwargs["dtype"] = dtype
+
+        # Longest possible packet: sync bytes, 16 bits of flags, the payload, and up to a 32-bit CRC.
+        self.max_packet_bits = (len(sync_bytes) + 2 + payload_length_cap + 4)*8
+
+    def segments(self, source):
+        """
+        List of (start, end) samples of the segments covering a FileSource.
+        """
+        symbol_rate = self.demod_kwargs.get("symbol_rate", 15.625)
+        sym_bits = int(np.log2(self.demod_kwargs.get("num_tones", 16)))
+        symbol_length = source.sample_rate/float(symbol_rate)
+        self.symbol_length = int(symbol_length)
+        self.overlap = int((int(np.ceil(self.max_packet_bits/float(sym_bits))) + self.acquisition_symbols(source.sample_rate))*symbol_length)
+
+        step = max(int(self.segment_length*source.sample_rate), self.overlap)
+        return [(max(0, start - self.overlap), min(start + step, source.num_samples)) for start in range(0, source.num_samples, step)]
+
+    def acquisition_symbols(self, sample_rate):
+        """
+        Symbols a demodulator needs, from the start of a segment, before it can decode packets: acquisition_time,
+        plus the two agreeing coarse searches of the first AFC lock, plus the timing lock if tracking is used.
+        The search length and lock count are read from a demodulator built with the same settings.
+        """
+        symbols = self.acquisition_time
+        if self.demod_kwargs.get("afc", False) or self.demod_kwargs.get("tracking", False):
+            demod = MFSKDemodulator.MFSKDemodulator(sample_rate = sample_rate, **dict(self.demod_kwargs, capture = False))
+            if demod.afc:
+                symbols += 2*demod.afc_search_symbols
+            if demod.tracking:
+                symbols += demod.track_lock
+        return symbols
+
+    def is_duplicate(self, packet, previous, overlap_end):
+        """
+        True if a packet was already found by the previous segment (previous is its list of packets), which ends
+        at sample overlap_end. The same packet, decoded in two segments, can be reported a few blocks apart.
+        """
+        if packet["sample"] >= overlap_end:
+            return False
+        return any([packet["crc"] == x["crc"] and packet["payload"] == x["payload"] and abs(packet["sample"] - x["sample"]) <= 2*self.symbol_length
+            for x in previous])
+
+    def decode(self, filename):
+        """
+        Decode a file. Returns a generator, which yields packets (in time order) as soon as all the
+        segments which could contain them have been decoded.
+        """
+        if self.checkpoint_dir != None:
+            return self.decode_checkpointed(filename)
+        return self.decode_parallel(filename)
+
+    def checkpoint_filename(self, filename):
+        """
+        Checkpoint file for a file. Files with the same name in different directories (which batch_decode can
+        decode at the same time) get different checkpoints, as the name includes a hash of the absolute path.
+        """
+        path_hash = hashlib.sha1(os.path.abspath(filename)).hexdigest()[:16]
+        return os.path.join(self.checkpoint_dir, "%s.%s.state.npz" % (os.path.basename(filename), path_hash))
+
+    def decode_checkpointed(self, filename):
+        """
+        Decode a file segment by segment, handing the decoder state from each segment to the next, and saving
+        it as a checkpoint after each one. Resumes from an existing checkpoint for the same file.
+        """
+        source = FileSource(filename, **self.source_kwargs)
+        checkpoint = self.checkpoint_filename(filename)
+        position = 0
+        state = {}
+
+        if os.path.exists(checkpoint):
+            try:
+                saved = load_state(checkpoint)
+                if str(saved["filename"]) == os.path.abspath(filename) and int(saved["num_samples"]) == source.num_samples:
+                    position = int(saved["position"])
+                    state = saved
+                    logging.info("Resuming %s from sample %d." % (filename, position))
+                else:
+                    logging.warning("Checkpoint %s is for a different file, starting from the beginning." % checkpoint)
+            except (ValueError, IOError, KeyError) as e:
+                logging.warning("Could not load checkpoint %s (%s), starting from the beginning." % (checkpoint, e))
+
+        step = max(1, int(self.segment_length*source.sample_rate))
+        for start in range(position, source.num_samples, step):
+            end = min(start + step, source.num_samples)
+            job = (filename, start, end, end == source.num_samples, self.include_failed, self.source_kwargs, self.demod_kwargs, self.depacketizer_kwargs, state)
+            (packets, state) = decode_segment(job)
+            for packet in packets:
+                yield packet
+
+            if end < source.num_samples:
+                state.update({"state_version": np.array(STATE_VERSION), "filename": np.array(os.path.abspath(filename)),
+                    "position": np.array(end), "num_samples": np.array(source.num_samples)})
+                save_state(checkpoint, state)
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def decode_parallel(self, filename):
+        """
+        Decode a file in overlapping segments, spread across the worker pool.
+        """
+        source = FileSource(filename, **self.source_kwargs)
+        segments = self.segments(source)
+        jobs = [(filename, start, end, end == source.num_samples, self.include_failed, self.source_kwargs, self.demod_kwargs, self.depacketizer_kwargs, None) for (start, end) in segments]
+        logging.debug("Decoding %s: %d segments, %d sample overlap, %d workers." % (filename, len(segments), self.overlap, self.num_workers))
+
+        if self.num_workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self.num_workers, initializer = FFTBackend.set_backend, initargs = (FFTBackend.backend, 1))
+            results = pool.imap(decode_segment, jobs)
+        else:
+            pool = None
+            results = (decode_segment(job) for job in jobs)
+
+        try:
+            held = []       # Packets which a later segment could still need to be ordered around.
+            previous = []   # Packets found by the previous segment, which this one might find again in the overlap.
+            for index, (packets, state) in enumerate(results):
+                overlap_end = segments[index - 1][1] if index > 0 else 0
+                held.extend([x for x in packets if not self.is_duplicate(x, previous, overlap_end)])
+                held.sort(key = lambda x: x["sample"])
+                previous = packets
+
+                # Later segments can't find anything before their start.
+                next_start = segments[index + 1][0] if index + 1 < len(segments) else source.num_samples + 1
+                ready = [x for x in held if x["sample"] < next_start]
+                held = held[len(ready):]
+                for packet in ready:
+                    yield packet
+        finally:
+            if pool != None:
+                pool.terminate()
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKModulator, Packetizer, os, tempfile, time
+    from scipy.io import wavfile
+
+    sample_rate = 8000
+    rng = np.random.RandomState(42)
+    p = Packetizer.Packetizer()
+
+    # A long recording, with packets at random intervals. Some packets are sent twice, back-to-back (like a
+    # beacon repeating its telemetry), and both copies must be output.
+    mod = MFSKModulator.MFSKModulator(sample_rate=sample_rate, symbol_rate=15.625, tone_spacing=15.625, base_freq=1500, amplitude=0.3)
+    sent = []
+    for i in range(40):
+        mod.write(np.zeros(int(rng.uniform(0.5, 8.0)*sample_rate)))
+        mod.modulate_symbol([0,15]*15)
+        message = "Packet %d" % i
+        mod.modulate_bits(4, np.unpackbits(np.fromstring(p.pack_message(message), dtype=np.uint8)))
+        mod.modulate_symbol([0]*4)
+        sent.append(message)
+        if i % 10 == 5:
+            mod.modulate_symbol([0,15]*15)
+            mod.modulate_bits(4, np.unpackbits(np.fromstring(p.pack_message(message), dtype=np.uint8)))
+            mod.modulate_symbol([0]*4)
+            sent.append(message)
+    signal = mod.emit_all() + 0.05*rng.randn(len(mod.emit_all()))
+
+    filename = os.path.join(tempfile.gettempdir(), 'segmented_test.wav')
+    wavfile.write(filename, sample_rate, np.int16(signal*32767))
+    duration = len(signal)/float(sample_rate)
+
+    for (segment_length, num_workers) in [(1e6, 1), (30.0, 1), (30.0, multiprocessing.cpu_count())]:
+        decoder = SegmentedDecoder(segment_length = segment_length, num_workers = num_workers)
+        start = time.time()
+        packets = list(decoder.decode(filename))
+        elapsed = time.time() - start
+
+        received = [x["payload"] for x in packets]
+        samples = [x["sample"] for x in packets]
+        print "%.0f s segments, %d worker(s): %d/%d packets, in order: %s, %.1f s of audio in %.1f s." % (min(segment_length, duration),
+            num_workers, len(received), len(sent), samples == sorted(samples), duration, elapsed)
+        assert received == sent
+        if received != sent:
+            print "Missing: %s  Extra: %s" % ([x for x in set(sent) if received.count(x) < sent.count(x)], [x for x in set(received) if received.count(x) > sent.count(x)])
+
+    # AFC: packets 20 Hz off frequency, more closely spaced. Each segment must acquire the frequency before it can
+    # decode anything, and short segments must still find every packet the unsegmented decode finds.
+    mod = MFSKModulator.MFSKModulator(sample_rate=sample_rate, symbol_rate=15.625, tone_spacing=15.625, base_freq=1520, amplitude=0.3)
+    for i in range(30):
+        mod.write(np.zeros(int(rng.uniform(0.5, 4.0)*sample_rate)))
+        mod.modulate_symbol([0,15]*15)
+        mod.modulate_bits(4, np.unpackbits(np.fromstring(p.pack_message("AFC packet %d" % i), dtype=np.uint8)))
+        mod.modulate_symbol([0]*4)
+    afc_signal = mod.emit_all() + 0.05*rng.randn(len(mod.emit_all()))
+    afc_filename = os.path.join(tempfile.gettempdir(), 'segmented_afc_test.wav')
+    wavfile.write(afc_filename, sample_rate, np.int16(afc_signal*32767))
+
+    unsegmented = [x["payload"] for x in SegmentedDecoder(segment_length = 1e6, num_workers = 1, afc = True).decode(afc_filename)]
+    for segment_length in [20.0, 10.0]:
+        received = [x["payload"] for x in SegmentedDecoder(segment_length = segment_length, afc = True).decode(afc_filename)]
+        print "AFC, %.0f s segments: %d/30 packets (%d unsegmented)." % (segment_length, len(received), len(unsegmented))
+        assert received == unsegmented
+    os.remove(afc_filename)
+
+    # Checkpointed decode, interrupted part way through and then resumed.
+    checkpoint_dir = tempfile.mkdtemp()
+    decoder = SegmentedDecoder(segment_length = 30.0, checkpoint_dir = checkpoint_dir)
+    first_run = []
+    for packet in decoder.decode(filename):
+        first_run.append(packet["payload"])
+        if len(first_run) == 20:
+            break
+    resumed = [x["payload"] for x in SegmentedDecoder(segment_length = 30.0, checkpoint_dir = checkpoint_dir).decode(filename)]
+    # Packets after the last checkpoint are output again.
+    received = first_run + [x for x in resumed if x not in first_run]
+    print "Checkpointed: %d packets before the interruption, %d after resuming (%d repeated), all received: %s" % (len(first_run),
+        len(resumed), len(first_run) + len(resumed) - len(received), received == sent)
+    os.rmdir(checkpoint_dir)
+
+    os.remove(filename)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# Selcall.py - CCIR 493-4 HF SELCALL words and messages, and a vectorised waveform generator.
+#
+# The word format, phasing sequence and messages are as in CCIR493-4.py (ported from the QITX project). Here
+# every word is looked up in a precomputed table, and a whole call is built as one bit array, which is turned
+# into a waveform in a single indexing operation.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import multiprocessing, os
+
+# Some defines for SELCALL Codes.
+SEL_SEL = 120     # Selective call
+SEL_ID  = 123     # Individual station semi-automatic/automatic service (Codan channel test)
+SEL_EOS = 127     # ROS
+SEL_RTN = 100     # Routine call
+SEL_ARQ = 117     # Acknowledge Request (EOS)
+SEL_PDX = 125     # Phasing DX Position
+SEL_PH7 = 111     # Phasing RX-7 position
+SEL_PH6 = 110     # RX-6
+SEL_PH5 = 109     # RX-5
+SEL_PH4 = 108     # RX-4
+SEL_PH3 = 107     # RX-3
+SEL_PH2 = 106     # RX-2
+SEL_PH1 = 105     # RX-1
+SEL_PH0 = 104     # Phasing RX-0 Position
+
+# Phasing sequence, sent between the preamble and the message.
+PHASING = [SEL_PDX, SEL_PH5, SEL_PDX, SEL_PH4, SEL_PDX, SEL_PH3, SEL_PDX, SEL_PH2, SEL_PDX, SEL_PH1, SEL_PDX, SEL_PH0]
+
+PREAMBLE_BITS = 600 # Length of the dot pattern (alternating 0 and 1 bits) at the start of a call: 6 seconds at 100 baud.
+WORD_BITS = 10
+
+
+def selcall_get_word(value):
+    """
+    A CCIR 493-4 word consists of a 7-bit word number (0-127), and a 3-bit parity,
+    which is the number of 0's in the word.
+    The 7-bit word number is send LSB first, then the parity MSB first.
+    """
+    accum = 0
+    lookuptable = [0x0000,0x0200,0x0100,0x0300,0x0080,0x0280,0x0180,0x0380]
+    for i in range(0,7):
+        if(not((value>>i)&1)):
+            accum = accum + 1
+
+    return (value&0x007F)|lookuptable[accum&0x007F]
+
+# All 128 words, as 10-bit values, and as rows of bits in the order they are sent (LSB of the value first).
+WORD_VALUES = np.array([selcall_get_word(x) for x in range(128)], dtype=np.uint16)
+WORD_TABLE = ((WORD_VALUES[:,np.newaxis] >> np.arange(WORD_BITS)) & 1).astype(np.uint8)
+
+
+def word_bits(words):
+    """ Bits of a sequence of words, in the order they are sent. Words outside 0-127 are skipped. """
+    words = np.asarray(words, dtype=int)
+    return WORD_TABLE[words[(words >= 0) & (words < 128)]].ravel()
+
+def preamble_bits():
+    """ The dot pattern sent at the start of a call. """
+    return np.tile(np.array([0,1], dtype=np.uint8), PREAMBLE_BITS//2)
+
+def message_bits(message):
+    """
+    Bits of a complete transmission: preamble, phasing sequence and message words.
+    CCIR 493-9 specifies error correction, but this is not required for CCIR 493-4.
+    """
+    return np.concatenate((preamble_bits(), word_bits(PHASING), word_bits(message)))
+
+def selcall_message(source, dest, format_word = SEL_SEL):
+    """
+    Words of a call from one 4-digit address to another. format_word is SEL_SEL for a selective call,
+    or SEL_ID for a channel test.
+    """
+    addr_A1 = (source//100)%100
+    addr_A2 = (source%100)
+    addr_B1 = (dest//100)%100
+    addr_B2 = dest%100
+
+    return [format_word, format_word, addr_B1, format_word, addr_B2, format_word, SEL_RTN, addr_B1, addr_A1, addr_B2, addr_A2, SEL_RTN, SEL_ARQ, addr_A1, SEL_ARQ, addr_A2, SEL_ARQ, SEL_ARQ]
+
+def call_message(source, dest):
+    """ Words of a call to a 4-digit address. On most commercial HF radios (Codan, Barrett), this will make the radio ring. """
+    return selcall_message(source, dest, SEL_SEL)
+
+def chan_test_message(source, dest):
+    """
+    Words of a channel test to a 4-digit address, which causes the recipient radio to respond with a
+    'High-Low-Low-Low-Low' tone sequence. This is only confirmed to work with Codan radios.
+    """
+    return selcall_message(source, dest, SEL_ID)
+
+
+class SelcallGenerator(object):
+    """ SELCALL Waveform Generator Class
+
+    Renders SELCALL transmissions straight from bit arrays. The waveform of each of the two tones is
+    calculated once, and a transmission is built by indexing them with the bits, giving the same output as
+    MFSKModulator.modulate_symbol (each symbol starts at zero phase).
+
+    sample_rate:    Output sample rate (Hz)
+    base_freq:      Frequency of the '0' tone (Hz)
+    symbol_rate:    Symbol rate (baud)
+    tone_spacing:   Frequency shift of the '1' tone (Hz). NOTE: 170 Hz at 100 baud is NOT orthogonal, so the
+                    waveform does not have constant phase. Sidebands can be removed by bandpass filtering.
+    start_silence:  Symbols of silence before each transmission.
+    amplitude:      Peak amplitude.
+    dtype:          Floating point dtype of the output.
+
+    """
+    def __init__(self, sample_rate = 48000, base_freq = 1700, symbol_rate = 100, tone_spacing = 170, start_silence = 30, amplitude = 0.5, dtype = np.float64):
+        self.sample_rate = sample_rate
+        self.symbol_length = int(sample_rate/symbol_rate)
+        self.start_silence = start_silence
+        self.dtype = np.dtype(dtype)
+
+        tone_freq = float(base_freq) + float(tone_spacing)*np.arange(2).reshape(-1,1)
+        x = np.arange(0, self.symbol_length, 1)
+        self.tones = (amplitude * np.cos(2*np.pi*(tone_freq/sample_rate)*x)).astype(self.dtype)
+
+    def render(self, bits):
+        """ Waveform of an array of bits, preceded by the start silence. """
+        silence = np.zeros(self.start_silence*self.symbol_length, dtype=self.dtype)
+        return np.concatenate((silence, self.tones[np.asarray(bits, dtype=np.uint8)].ravel()))
+
+    def render_message(self, message):
+        """ Waveform of a complete transmission of a list of message words. """
+        return self.render(message_bits(message))
+
+    def call(self, source, dest):
+        return self.render_message(call_message(source, dest))
+
+    def chan_test(self, source, dest):
+        return self.render_message(chan_test_message(source, dest))
+
+    def write_wave(self, filename, waveform):
+        """ Write a waveform to a 16-bit WAV file. """
+        from scipy.io import wavfile
+        wavfile.write(filename, self.sample_rate, np.int16(waveform * 32767))
+
+
+def render_job(job):
+    """
+    Render one batch job to a WAV file. Runs in the worker processes.
+
+    job:    Tuple of (kind, source, dest, filename, generator_kwargs), where kind is "call" or "chan_test".
+    """
+    (kind, source, dest, filename, generator_kwargs) = job
+    generator = SelcallGenerator(**generator_kwargs)
+    if kind == "call":
+        waveform = generator.call(source, dest)
+    elif kind == "chan_test":
+        waveform = generator.chan_test(source, dest)
+    else:
+        raise ValueError("Unknown SELCALL type '%s'." % kind)
+    generator.write_wave(filename, waveform)
+    return filename
+
+def generate_batch(calls, directory, num_workers = None, **generator_kwargs):
+    """
+    Generate a WAV file for each of a list of calls, spread across a pool of worker processes.
+
+    calls:          List of (kind, source, dest), where kind is "call" or "chan_test", and source and dest are
+                    4-digit addresses.
+    directory:      Output directory. Files are named selcall_(kind)_(source)_(dest).wav.
+    num_workers:    Number of worker processes. Defaults to the number of CPUs. If 1, files are generated in
+                    this process.
+    Any other keyword arguments (sample_rate, base_freq, amplitude, etc) are passed to SelcallGenerator.
+
+    Returns the list of filenames, in the same order as calls.
+    """
+    num_workers = num_workers if num_workers != None else multiprocessing.cpu_count()
+    jobs = [(kind, source, dest, os.path.join(directory, "selcall_%s_%04d_%04d.wav" % (kind, source, dest)), generator_kwargs) for (kind, source, dest) in calls]
+
+    if num_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            return pool.map(render_job, jobs, chunksize = max(1, len(jobs)//(4*num_workers)))
+        finally:
+            pool.terminate()
+    else:
+        return [render_job(job) for job in jobs]
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKModulator, shutil, tempfile, time
+
+    # The table-driven bits match the word-by-word construction.
+    for value in range(128):
+        word = selcall_get_word(value)
+        assert list(word_bits([value])) == [(word >> i) & 1 for i in range(WORD_BITS)]
+
+    # The rendered waveform matches the MFSK Modulator's.
+    generator = SelcallGenerator()
+    modulator = MFSKModulator.MFSKModulator(48000, 1700, 100, 170, 30, 0.5)
+    modulator.modulate_symbol(message_bits(chan_test_message(1882, 1881)))
+    assert np.array_equal(generator.chan_test(1882, 1881), modulator.emit_all())
+
+    start = time.time()
+    for i in range(100):
+        generator.chan_test(1882, 1881)
+    print "Rendered a %.1f s channel test in %.2f ms." % (len(modulator.emit_all())/48000.0, (time.time() - start)/100*1e3)
+
+    # A batch of regression test files.
+    directory = tempfile.mkdtemp()
+    calls = [(kind, 1000 + i, 2000 + i) for i in range(100) for kind in ["call", "chan_test"]]
+    start = time.time()
+    filenames = generate_batch(calls, directory)
+    elapsed = time.time() - start
+    print "Wrote %d files (%.0f MB) in %.1f s, %d CPU(s)." % (len(filenames), sum([os.path.getsize(x) for x in filenames])/1e6,
+        elapsed, multiprocessing.cpu_count())
+    shutil.rmtree(directory)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# SelcallDecoder.py - CCIR 493-4 HF SELCALL Decoder
+#
+# Receives the calls built in Selcall.py. The audio is demodulated by an MFSK Demodulator (2 tones, 170 Hz shift,
+# 100 baud), and the bit stream is searched for the phasing sequence, preceded by the dot pattern. The message
+# words which follow are checked against the word table, and decoded into source and destination addresses.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import logging
+from numpy.lib.stride_tricks import as_strided
+from MFSKDemodulator import MFSKDemodulator
+from Selcall import *
+
+PHASING_BITS = word_bits(PHASING)
+MESSAGE_WORDS = 18 # Length of a selcall_message
+MESSAGE_BITS = MESSAGE_WORDS*WORD_BITS
+
+# Positions of the two copies of each address word in a selcall_message, and of the format words.
+FORMAT_POSITIONS = [0, 1, 3, 5]
+ADDRESS_POSITIONS = {"B1": [2, 7], "B2": [4, 9], "A1": [8, 13], "A2": [10, 15]}
+
+MESSAGE_TYPES = {SEL_SEL: "call", SEL_ID: "chan_test"}
+
+
+def check_words(bits):
+    """
+    Split an array of bits into words, and check each against the word table.
+    Returns the 7-bit word numbers, and a boolean array which is True where the parity bits match.
+    """
+    words = np.asarray(bits, dtype=np.uint8).reshape(-1, WORD_BITS)
+    values = words[:,:7].dot(1 << np.arange(7))
+    return (values, np.all(words == WORD_TABLE[values], axis=1))
+
+def decode_message(bits):
+    """
+    Decode the bits of the message words of a call (the MESSAGE_BITS following the phasing sequence).
+
+    Each address is sent twice, and the first copy which passes its parity check is used. The format word is
+    the most common of the format words which pass their parity check.
+    Returns a dictionary with the message type ("call", "chan_test" or "unknown"), the format word, source and
+    destination addresses (None if neither copy of a part of the address could be recovered), the word numbers,
+    the number of words which failed their parity check, and whether the whole message was recovered.
+    """
+    (values, parity_ok) = check_words(bits)
+
+    formats = values[FORMAT_POSITIONS][parity_ok[FORMAT_POSITIONS]]
+    format_word = int(np.argmax(np.bincount(formats))) if len(formats) > 0 else None
+
+    address = {}
+    for (name, positions) in ADDRESS_POSITIONS.items():
+        copies = [values[x] for x in positions if parity_ok[x] and values[x] < 100]
+        address[name] = int(copies[0]) if len(copies) > 0 else None
+
+    source = None if None in (address["A1"], address["A2"]) else address["A1"]*100 + address["A2"]
+    dest = None if None in (address["B1"], address["B2"]) else address["B1"]*100 + address["B2"]
+
+    return {"type": MESSAGE_TYPES.get(format_word, "unknown"), "format": format_word, "source": source, "dest": dest,
+        "words": values, "parity_errors": int(np.sum(~parity_ok)),
+        "valid": format_word in MESSAGE_TYPES and source != None and dest != None}
+
+
+class SelcallDecoder(object):
+    """ SELCALL Decoder Class
+
+    Feed audio in with consume(). Each call which is found is passed to the callback as a dictionary (see
+    decode_message), with "sample" set to the input sample at which its phasing sequence started.
+
+    sample_rate:        Sample rate of incoming data (Hz)
+    base_freq:          Frequency of the '0' tone (Hz)
+    symbol_rate:        Symbol rate (baud)
+    tone_spacing:       Frequency shift of the '1' tone (Hz)
+    callback:           Function pointer. Decoded calls are passed to this function.
+    min_dots:           Number of dot pattern bits which must come immediately before the phasing sequence.
+    max_dot_errors:     Number of those bits which may break the alternating pattern.
+    max_phasing_errors: Number of bit errors allowed in the phasing sequence.
+
+    Any other keyword arguments (squelch, afc, dtype, etc) are passed to the MFSK Demodulator. The demodulator is
+    run decimated, with symbol timing tracking, which keeps it locked through the closely spaced tones and
+    runs many times faster than realtime.
+    """
+    def __init__(self, sample_rate = 48000, base_freq = 1700, symbol_rate = 100, tone_spacing = 170, callback = False, min_dots = 20, max_dot_errors = 2, max_phasing_errors = 10, **demod_kwargs):
+        self.callback = callback
+        self.min_dots = min_dots
+        self.max_dot_errors = max_dot_errors
+        self.max_phasing_errors = max_phasing_errors
+        self.symbol_length = int(sample_rate/symbol_rate)
+
+        demod_kwargs.setdefault("decimate", True)
+        demod_kwargs.setdefault("tracking", True)
+        self.demod = MFSKDemodulator(sample_rate, base_freq, symbol_rate, num_tones = 2, tone_spacing = tone_spacing, gray_coded = False,
+            block_callback = self.process_symbols, **demod_kwargs)
+
+        # Received bits, and the sample at which each symbol ended.
+        self.bits = np.array([], dtype=np.uint8)
+        self.samples = np.array([], dtype=np.int64)
+        self.calls = 0
+
+    def consume(self, data):
+        """ Demodulate a chunk of samples, and pass any calls which are completed to the callback. """
+        self.demod.consume(data)
+
+    def process_symbols(self, symbols):
+        """ Block callback of the MFSK Demodulator. """
+        self.bits = np.append(self.bits, symbols["symbol"].astype(np.uint8))
+        self.samples = np.append(self.samples, symbols["sample"])
+        self.search()
+
+    def find_phasing(self):
+        """
+        Search the bit buffer for the phasing sequence, preceded by at least min_dots bits of the dot pattern.
+        Returns the position of the first match, or None.
+        """
+        num_windows = len(self.bits) - len(PHASING_BITS) + 1
+        if num_windows < 1:
+            return None
+
+        # Bit errors of the phasing sequence starting at every position, all at once.
+        windows = as_strided(self.bits, shape=(num_windows, len(PHASING_BITS)), strides=(self.bits.strides[0], self.bits.strides[0]))
+        errors = np.sum(windows != PHASING_BITS, axis=1)
+
+        # Breaks in the dot pattern over the (min_dots) bits before each position.
+        breaks = np.concatenate(([0], np.cumsum(self.bits[1:] == self.bits[:-1])))
+        starts = np.arange(self.min_dots, num_windows)
+        dot_errors = breaks[starts - 1] - breaks[starts - self.min_dots]
+
+        matches = starts[(errors[starts] <= self.max_phasing_errors) & (dot_errors <= self.max_dot_errors)]
+        if len(matches) == 0:
+            return None
+
+        # A noisy dot pattern can match a shifted phasing sequence, so take the best match near the first one.
+        nearby = matches[matches < matches[0] + WORD_BITS]
+        return int(nearby[np.argmin(errors[nearby])])
+
+    def search(self):
+        """ Decode every complete call in the bit buffer, then discard the bits which can't be part of a new one. """
+        while True:
+            start = self.find_phasing()
+            if start == None:
+                # Keep enough bits to find a phasing sequence which has only partly arrived.
+                self.trim(len(self.bits) - len(PHASING_BITS) - self.min_dots)
+                return
+
+            message_start = start + len(PHASING_BITS)
+            if len(self.bits) < message_start + MESSAGE_BITS:
+                # Wait for the rest of the message.
+                self.trim(start - self.min_dots)
+                return
+
+            call = decode_message(self.bits[message_start:message_start + MESSAGE_BITS])
+            call["sample"] = int(self.samples[start]) - self.symbol_length
+            self.calls += 1
+            logging.debug("SELCALL %s from %s to %s, %d parity errors." % (call["type"], call["source"], call["dest"], call["parity_errors"]))
+
+            if self.callback != False:
+                self.callback(call)
+
+            self.trim(message_start + MESSAGE_BITS)
+
+    def trim(self, count):
+        """ Discard the first (count) bits of the buffer. """
+        if count > 0:
+            self.bits = self.bits[count:]
+            self.samples = self.samples[count:]
+
+
+# Test script. Decodes a WAV file given on the command line, or a set of generated calls.
+if __name__ == "__main__":
+    import sys, time
+    from FileSource import FileSource
+
+    calls = []
+
+    if len(sys.argv) > 1:
+        source = FileSource(sys.argv[1])
+        decoder = SelcallDecoder(source.sample_rate, callback = calls.append)
+        start = time.time()
+        decoder.consume(source.read(source.num_samples))
+        elapsed = time.time() - start
+        for call in calls:
+            print "%7.2f s: %s from %s to %s, %d parity errors" % (call["sample"]/float(source.sample_rate), call["type"], call["source"], call["dest"], call["parity_errors"])
+        print "%.1f s of audio decoded in %.2f s (%.0fx realtime)." % (source.duration, elapsed, source.duration/elapsed)
+        sys.exit(0)
+
+    # Calls and channel tests, separated by some silence, with noise added.
+    generator = SelcallGenerator()
+    sent = [("call", 1882, 1881), ("chan_test", 1234, 5678), ("call", 42, 9901), ("chan_test", 1001, 2002)]
+    audio = []
+    for (kind, source, dest) in sent:
+        audio.append(generator.call(source, dest) if kind == "call" else generator.chan_test(source, dest))
+    audio = np.concatenate(audio + [np.zeros(generator.sample_rate)])
+    audio = audio + 0.3*np.random.RandomState(0).randn(len(audio))
+
+    decoder = SelcallDecoder(generator.sample_rate, callback = calls.append)
+    start = time.time()
+    for i in range(0, len(audio), 4096):
+        decoder.consume(audio[i:i+4096])
+    elapsed = time.time() - start
+
+    for call in calls:
+        print "%7.2f s: %s from %s to %s, %d parity errors" % (call["sample"]/float(generator.sample_rate), call["type"], call["source"], call["dest"], call["parity_errors"])
+    assert [(x["type"], x["source"], x["dest"]) for x in calls] == sent
+    duration = len(audio)/float(generator.sample_rate)
+    print "%.1f s of audio decoded in %.2f s (%.0fx realtime)." % (duration, elapsed, duration/elapsed)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# SharedRingBuffer.py - Shared memory audio ring buffer, for fanning one capture out to many decoder processes.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import multiprocessing, ctypes
+
+# Fields in each consumer's row of the shared status table.
+STATUS_POSITION = 0     # Next sample the consumer will read.
+STATUS_OVERRUNS = 1     # Number of times the consumer fell more than a buffer behind.
+STATUS_LOST = 2         # Samples lost to overruns.
+STATUS_FIELDS = 3
+
+
+class SharedRingBuffer(object):
+    """ Shared Memory Ring Buffer Class
+
+    A single-producer, multiple-consumer ring buffer of audio samples, held in shared memory
+    (multiprocessing.RawArray). Create it before starting the consumer processes, which inherit it.
+    The producer never waits for the consumers: a consumer which falls more than (capacity) samples behind
+    has overrun, and skips ahead to the oldest data still in the buffer. Overruns and lost samples are
+    counted per consumer, in a shared table the producer can read with status().
+
+    capacity:       Size of the buffer (samples).
+    dtype:          Sample dtype (e.g. np.float32, or np.int16 to keep raw PCM).
+    max_consumers:  Number of consumer slots in the status table.
+
+    """
+    def __init__(self, capacity, dtype = np.float32, max_consumers = 8):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.max_consumers = max_consumers
+
+        self.shared_data = multiprocessing.RawArray(ctypes.c_char, capacity*self.dtype.itemsize)
+        self.data = np.frombuffer(self.shared_data, dtype=self.dtype)
+        # Total samples written, and whether the producer has finished.
+        self.written = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self.closed = multiprocessing.RawValue(ctypes.c_int, 0)
+        self.shared_status = multiprocessing.RawArray(ctypes.c_longlong, max_consumers*STATUS_FIELDS)
+        self.new_data = multiprocessing.Condition()
+
+    def write(self, samples):
+        """
+        Write a block of samples. Never blocks on the consumers. Blocks longer than the buffer only keep
+        their last (capacity) samples.
+        """
+        samples = np.asarray(samples, dtype=self.dtype)[-self.capacity:]
+        start = self.written.value % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+
+        # Only publish the new samples once they are in the buffer.
+        self.written.value = self.written.value + len(samples)
+        with self.new_data:
+            self.new_data.notify_all()
+
+    def close(self):
+        """ Tell the consumers there is no more data. """
+        self.closed.value = 1
+        with self.new_data:
+            self.new_data.notify_all()
+
+    def reader(self, index):
+        """ Get the reader for consumer slot (index). Call this in the consumer process. """
+        return RingReader(self, index)
+
+    def status(self):
+        """
+        List of (position, overruns, lost samples, samples behind) for each consumer slot.
+        """
+        status = np.frombuffer(self.shared_status, dtype=np.int64).reshape(self.max_consumers, STATUS_FIELDS)
+        written = self.written.value
+        return [(int(x[STATUS_POSITION]), int(x[STATUS_OVERRUNS]), int(x[STATUS_LOST]), int(written - x[STATUS_POSITION])) for x in status]
+
+
+class RingReader(object):
+    """ Ring Buffer Reader Class
+
+    One consumer's view of a SharedRingBuffer, with its own read cursor. Reads return NumPy views straight
+    into the shared memory, so there is no copy. A view stays valid until the producer writes (capacity)
+    samples past its start; read() checks the previous block on the next call, and counts an overrun if it
+    could have been overwritten while it was in use.
+
+    """
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        self.status = np.frombuffer(ring.shared_status, dtype=np.int64).reshape(ring.max_consumers, STATUS_FIELDS)[index]
+        # Start with the newest data.
+        self.position = ring.written.value
+        self.status[:] = [self.position, 0, 0]
+        self.last_start = None
+
+    def overrun(self, lost):
+        self.status[STATUS_OVERRUNS] += 1
+        self.status[STATUS_LOST] += lost
+
+    def read(self, max_samples = 4096, timeout = 1.0):
+        """
+        Get the next block of up to max_samples samples, as a view into the shared buffer. Waits up to
+        timeout seconds for new data. Returns an empty array if none arrived, or None once the producer has
+        closed the buffer and everything has been read.
+        """
+        written = self.ring.written.value
+        # Was the last block overwritten while the consumer was using it?
+        if self.last_start != None and written - self.last_start > self.ring.capacity:
+            self.overrun(0)
+        self.last_start = None
+
+        if written == self.position:
+            if self.ring.closed.value:
+                return None
+            with self.ring.new_data:
+                if self.ring.written.value == self.position and not self.ring.closed.value:
+                    self.ring.new_data.wait(timeout)
+            written = self.ring.written.value
+
+        behind = written - self.position
+        if behind > self.ring.capacity:
+            # Overrun. Skip to the oldest data still in the buffer.
+            self.overrun(behind - self.ring.capacity)
+            self.position = written - self.ring.capacity
+
+        start = self.position % self.ring.capacity
+        length = min(written - self.position, max_samples, self.ring.capacity - start)
+        self.last_start = self.position
+        self.position = self.position + length
+        self.status[STATUS_POSITION] = self.position
+
+        return self.ring.data[start:start + length]
+
+    def overruns(self):
+        """ (number of overruns, samples lost) for this consumer. """
+        return (int(self.status[STATUS_OVERRUNS]), int(self.status[STATUS_LOST]))
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKDemodulator, DePacketizer, time
+    from FileSource import FileSource
+    from ModemUtils import tones_to_bits
+
+    def decoder(ring, index, name, ready, results, delay, demod_kwargs):
+        """ Consumer process: decode packets from the ring buffer. """
+        reader = ring.reader(index)
+        packets = []
+        packet_extract = DePacketizer.DePacketizer(callback = packets.append)
+        def parse_symbols(symbols):
+            packet_extract.process_data(tones_to_bits(symbols["symbol"], 16))
+        demod = MFSKDemodulator.MFSKDemodulator(block_callback = parse_symbols, dtype = np.float32, **demod_kwargs)
+        ready.set()
+
+        while True:
+            data = reader.read(1024)
+            if data is None:
+                break
+            demod.consume(data)
+            time.sleep(delay)
+        results.put((name, packets, reader.overruns()))
+
+    source = FileSource('generated_MFSK16_packets.wav', chunk_size = 512, dtype = np.float32)
+    ring = SharedRingBuffer(2*8000, np.float32)
+    results = multiprocessing.Queue()
+
+    # Three differently configured decoders. The last one is far too slow to keep up.
+    configs = [("plain", 0, {}), ("afc", 0, {"afc": True}), ("slow", 0.2, {})]
+    consumers = []
+    for (index, (name, delay, demod_kwargs)) in enumerate(configs):
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target = decoder, args = (ring, index, name, ready, results, delay, dict(sample_rate = 8000, **demod_kwargs)))
+        process.start()
+        ready.wait()
+        consumers.append(process)
+
+    # Play the file into the ring buffer at 4x realtime.
+    for chunk in source:
+        ring.write(chunk)
+        time.sleep(len(chunk)/8000.0/4)
+    # Some silence, to flush the decoders.
+    ring.write(np.zeros(8000, dtype=np.float32))
+    ring.close()
+
+    for process in consumers:
+        process.join()
+    while not results.empty():
+        (name, packets, (overruns, lost)) = results.get()
+        print "%-6s %d packets, %d overrun(s), %d samples lost: %s" % (name, len(packets), overruns, lost, packets)
+    print "Status (position, overruns, lost, behind): %s" % ring.status()[:len(configs)]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# SymbolCapture.py - Save demodulated tone bin magnitudes, and replay them without redoing the DSP.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import struct
+from ModemUtils import *
+
+# Bytes reserved for the .npy header, so it can be rewritten in place as the record count grows.
+HEADER_LENGTH = 256
+
+
+class SymbolCapture(object):
+    """ Symbol Capture Writer Class
+
+    Writes per-symbol records (see ModemUtils.capture_dtype) to a .npy file: the sample, SNR, timing type and
+    the magnitude of every tone bin. Records are appended as they arrive, and the header is updated after
+    every write, so the file is always a valid .npy file that can be opened (or memory-mapped, with
+    np.load(filename, mmap_mode='r')) while the capture is still running.
+
+    filename:   File to write (normally ending in .npy). Any existing file is overwritten.
+    num_tones:  Number of tones in the captured mode.
+
+    """
+    def __init__(self, filename, num_tones):
+        self.filename = filename
+        self.num_tones = num_tones
+        self.dtype = capture_dtype(num_tones)
+        self.count = 0
+
+        self.file = open(filename, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(self.dtype), self.count)
+        # Pad with spaces (and a newline) out to the reserved length, as the .npy format allows.
+        header = header + " "*(HEADER_LENGTH - 10 - len(header) - 1) + "\n"
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode('latin1'))
+
+    def write(self, records):
+        """ Append a structured array of capture records. """
+        records = np.asarray(records, dtype=self.dtype)
+        self.file.seek(0, 2)
+        records.tofile(self.file)
+        self.count = self.count + len(records)
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SymbolReplay(object):
+    """ Symbol Replay Source Class
+
+    Reads a capture file written by SymbolCapture, and feeds it to the same back-end stages as a live
+    MFSKDemodulator would. The symbol decisions (hard_decode_tones) and soft bits (soft_decode_tones) are
+    re-calculated from the stored tone magnitudes, and passed on in the same structured arrays
+    (ModemUtils.symbol_dtype) as MFSKDemodulator's block_callback, so the depacketizer, FEC or sync
+    stages can be re-run at disk speed.
+
+    filename:       Capture file.
+    block_length:   Number of symbols passed to block_callback at a time.
+    block_callback: Function pointer, as for MFSKDemodulator.
+    soft_bits:      If True, soft bit values are included in the output.
+    gray_coded:     Whether the captured mode is gray coded (affects the soft bits).
+
+    """
+    def __init__(self, filename, block_length = 1024, block_callback = False, soft_bits = False, gray_coded = True):
+        self.records = np.load(filename, mmap_mode='r')
+        self.num_tones = self.records.dtype["tones"].shape[0]
+        self.sym_bits = int(np.log2(self.num_tones))
+        self.block_length = block_length
+        self.block_callback = block_callback
+        self.soft_bits = soft_bits
+        self.gray_coded = gray_coded
+        self.symbol_block_dtype = symbol_dtype(self.sym_bits if self.soft_bits else 0)
+
+    def decode(self, records):
+        """ Convert an array of capture records to a symbol_dtype array. """
+        symbols = np.zeros(len(records), dtype=self.symbol_block_dtype)
+        symbols["symbol"] = hard_decode_tones(records["tones"])
+        symbols["sample"] = records["sample"]
+        symbols["s2n"] = records["s2n"]
+        symbols["s2n_instant"] = records["s2n_instant"]
+        symbols["timing"] = records["timing"]
+        if self.soft_bits:
+            symbols["soft"] = soft_decode_tones(records["tones"], self.gray_coded)
+        return symbols
+
+    def __iter__(self):
+        for start in range(0, len(self.records), self.block_length):
+            yield self.decode(self.records[start:start + self.block_length])
+
+    def run(self):
+        """ Pass the whole capture to block_callback. """
+        for symbols in self:
+            self.block_callback(symbols)
+
+
+# Test script.
+if __name__ == "__main__":
+    import MFSKDemodulator, DePacketizer, os, tempfile, time
+    from FileSource import FileSource
+
+    filename = os.path.join(tempfile.gettempdir(), 'symbol_capture_test.npy')
+
+    # Demodulate the test file, capturing the symbols as we go.
+    live = []
+    source = FileSource('generated_MFSK16_packets.wav', chunk_size = 1024)
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate = source.sample_rate, block_callback = live.append, soft_bits = True, capture = filename)
+    start = time.time()
+    for chunk in source:
+        demod.consume(chunk)
+    live_time = time.time() - start
+    demod.capture.close()
+    live = np.concatenate(live)
+
+    # Replay the capture into a depacketizer.
+    payloads = []
+    packet_extract = DePacketizer.DePacketizer(callback = payloads.append)
+    replayed = []
+    def parse_symbols(symbols):
+        replayed.append(symbols)
+        packet_extract.process_data(tones_to_bits(symbols["symbol"], 16))
+
+    replay = SymbolReplay(filename, block_callback = parse_symbols, soft_bits = True)
+    start = time.time()
+    replay.run()
+    replay_time = time.time() - start
+    replayed = np.concatenate(replayed)
+
+    assert np.array_equal(live["symbol"], replayed["symbol"]) and np.array_equal(live["sample"], replayed["sample"])
+    assert np.allclose(live["soft"], replayed["soft"], atol = 1e-5, equal_nan = True)
+    print "%d symbols, %d bytes captured. Live: %.2f s, replay: %.3f s. Packets: %s" % (len(replayed), os.path.getsize(filename),
+        live_time, replay_time, payloads)
+
+    os.remove(filename)
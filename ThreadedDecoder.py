@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# ThreadedDecoder.py - Decoder which runs the DSP and the packet handling on separate threads.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import Queue, threading, time
+import MFSKDemodulator, DePacketizer
+from ModemUtils import *
+
+
+class BlockQueue(object):
+    """ Preallocated Block Queue Class
+
+    A fixed pool of preallocated NumPy blocks, handed from a producer thread to a consumer thread.
+    The producer acquire()s a free block, fills it and submit()s it; the consumer get()s it and release()s
+    it once done, returning it to the pool. No arrays are allocated once the queue is running, and the
+    producer blocks in acquire() when all blocks are in use (backpressure).
+
+    num_blocks:     Number of blocks in the pool.
+    block_shape:    Shape of each block. Submitted blocks may use less than the first dimension.
+    dtype:          dtype of the blocks.
+
+    """
+    def __init__(self, num_blocks, block_shape, dtype):
+        self.blocks = [np.zeros(block_shape, dtype=dtype) for x in range(num_blocks)]
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for index in range(num_blocks):
+            self.free.put(index)
+
+    def acquire(self):
+        """ Get a free block, as (index, block). Blocks until one is available. """
+        index = self.free.get()
+        return (index, self.blocks[index])
+
+    def submit(self, index, length):
+        """ Pass the first (length) entries of a block to the consumer. """
+        self.full.put((index, length))
+
+    def get(self):
+        """ Get the next submitted block, as (index, data), or None once the queue has been closed. """
+        item = self.full.get()
+        if item == None:
+            return None
+        (index, length) = item
+        return (index, self.blocks[index][:length])
+
+    def release(self, index):
+        """ Return a block to the pool. """
+        self.free.put(index)
+
+    def close(self):
+        self.full.put(None)
+
+
+class ThreadedDecoder(object):
+    """ Threaded Decoder Class
+
+    Runs MFSKDemodulator.consume() on one thread, and symbol to bit conversion, the DePacketizer and the
+    packet callback on another, so the packet handling for one block overlaps with the DSP for the next.
+    Audio and symbols are passed between the threads in preallocated BlockQueues.
+
+    callback:       Function pointer. Called (on the packet thread) with a dictionary for each packet:
+                    sample, s2n, crc and payload, as for DecodePipeline.
+    block_size:     Audio samples per block. Longer chunks passed to feed() are split up.
+    num_blocks:     Number of blocks in each queue.
+    sync_bytes, payload_length_cap:     Passed to DePacketizer.
+    Any other keyword arguments (sample_rate, base_freq, dtype, etc) are passed to MFSKDemodulator.
+
+    """
+    def __init__(self, callback = False, block_size = 4096, num_blocks = 8, sync_bytes = '\xAB\xCD', payload_length_cap = 32, **demod_kwargs):
+        self.callback = callback
+        self.block_size = block_size
+
+        self.demod = MFSKDemodulator.MFSKDemodulator(block_callback = self.store_symbols, **demod_kwargs)
+        self.packet_extract = DePacketizer.DePacketizer(sync_bytes = sync_bytes, payload_length_cap = payload_length_cap, callback = self.store_packet)
+        self.state = {"sample": 0, "s2n": 0.0}
+
+        # Each block can produce at most one symbol per demodulator block (plus one carried over).
+        max_symbols = block_size//(self.demod.block_length*self.demod.decimation) + 2
+        self.audio = BlockQueue(num_blocks, block_size, self.demod.dtype)
+        self.symbols = BlockQueue(num_blocks, max_symbols, self.demod.symbol_block_dtype)
+        self.symbol_index = None
+        self.symbol_count = 0
+        # Time (s) each thread has spent working, as opposed to waiting for blocks.
+        self.dsp_busy = 0.0
+        self.packet_busy = 0.0
+
+        self.dsp_thread = threading.Thread(target = self.run_dsp, name = "dsp")
+        self.packet_thread = threading.Thread(target = self.run_packets, name = "packets")
+        self.dsp_thread.daemon = True
+        self.packet_thread.daemon = True
+        self.dsp_thread.start()
+        self.packet_thread.start()
+
+    def feed(self, data):
+        """
+        Copy a chunk of audio into the DSP thread's queue. Blocks while all the audio blocks are in use.
+        """
+        data = np.asarray(data)
+        for start in range(0, len(data), self.block_size):
+            piece = data[start:start + self.block_size]
+            (index, block) = self.audio.acquire()
+            block[:len(piece)] = piece
+            self.audio.submit(index, len(piece))
+
+    def close(self):
+        """ Process everything fed in so far, and stop the threads. """
+        self.audio.close()
+        self.dsp_thread.join()
+        self.packet_thread.join()
+
+    # DSP thread.
+    def run_dsp(self):
+        while True:
+            item = self.audio.get()
+            if item == None:
+                self.symbols.close()
+                return
+            (index, data) = item
+
+            start = time.time()
+            self.demod.consume(data)
+            self.audio.release(index)
+            if self.symbol_index != None:
+                self.symbols.submit(self.symbol_index, self.symbol_count)
+                self.symbol_index = None
+            self.dsp_busy += time.time() - start
+
+    def store_symbols(self, symbols):
+        # Called from consume(), at most once per block. Copy into a block for the packet thread.
+        (self.symbol_index, block) = self.symbols.acquire()
+        self.symbol_count = len(symbols)
+        block[:len(symbols)] = symbols
+
+    # Packet thread.
+    def run_packets(self):
+        while True:
+            item = self.symbols.get()
+            if item == None:
+                return
+            (index, symbols) = item
+
+            start = time.time()
+            bits = tones_to_bits(symbols["symbol"], self.demod.num_tones, self.demod.gray_coded).reshape(len(symbols), -1)
+            for i in range(len(symbols)):
+                self.state["sample"] = int(symbols["sample"][i])
+                self.state["s2n"] = float(symbols["s2n"][i])
+                self.packet_extract.process_data(bits[i])
+            self.symbols.release(index)
+            self.packet_busy += time.time() - start
+
+    def store_packet(self, payload):
+        if self.callback != False:
+            self.callback({"sample": self.state["sample"], "s2n": self.state["s2n"], "crc": self.packet_extract.packet_crc, "payload": payload})
+
+
+# Benchmark script.
+if __name__ == "__main__":
+    import MFSKModulator, Packetizer, multiprocessing, time
+
+    sample_rate = 8000
+    rng = np.random.RandomState(1)
+    p = Packetizer.Packetizer()
+
+    # 2 minutes of back to back packets in noise.
+    mod = MFSKModulator.MFSKModulator(sample_rate=sample_rate, symbol_rate=15.625, tone_spacing=15.625, base_freq=1500, amplitude=0.3)
+    mod.modulate_symbol([0,15]*15)
+    while len(mod.baseband) < 120*sample_rate:
+        message = "Packet %d" % rng.randint(1000)
+        mod.modulate_bits(4, np.unpackbits(np.fromstring(p.pack_message(message), dtype=np.uint8)))
+    mod.modulate_symbol([0]*8)
+    signal = mod.emit_all() + 0.05*rng.randn(len(mod.emit_all()))
+    duration = len(signal)/float(sample_rate)
+    chunk_size = 4096
+
+    # Sequential: DSP and packet handling back to back, on one thread.
+    sequential_packets = []
+    packet_extract = DePacketizer.DePacketizer(callback = sequential_packets.append)
+    def parse_symbols(symbols):
+        bits = tones_to_bits(symbols["symbol"], 16).reshape(len(symbols), -1)
+        for i in range(len(symbols)):
+            packet_extract.process_data(bits[i])
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate = sample_rate, block_callback = parse_symbols)
+    start = time.time()
+    for i in range(0, len(signal), chunk_size):
+        demod.consume(signal[i:i+chunk_size])
+    sequential_time = time.time() - start
+
+    # Threaded.
+    threaded_packets = []
+    decoder = ThreadedDecoder(callback = lambda packet: threaded_packets.append(packet["payload"]), sample_rate = sample_rate, block_size = chunk_size)
+    start = time.time()
+    for i in range(0, len(signal), chunk_size):
+        decoder.feed(signal[i:i+chunk_size])
+    decoder.close()
+    threaded_time = time.time() - start
+
+    assert threaded_packets == sequential_packets
+    print "%.0f s of audio, %d packets, %d CPU(s)." % (duration, len(threaded_packets), multiprocessing.cpu_count())
+    print "Sequential: %.2f s (%.1fx realtime)" % (sequential_time, duration/sequential_time)
+    print "Threaded:   %.2f s (%.1fx realtime)" % (threaded_time, duration/threaded_time)
+    print "Speed-up:   %.2fx" % (sequential_time/threaded_time)
+    # With at least two free cores, the threaded decoder is limited by the busier of its two threads.
+    print "DSP thread busy %.2f s, packet thread busy %.2f s: at most %.2fx with 2 or more cores." % (decoder.dsp_busy,
+        decoder.packet_busy, (decoder.dsp_busy + decoder.packet_busy)/max(decoder.dsp_busy, decoder.packet_busy))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# batch_decode.py - Decode MFSK packets from many recordings, with JSON-lines output.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage: python batch_decode.py [options] <file, directory or glob> [...]
+#
+# Each packet is written to stdout as one JSON object per line:
+#   {"type": "packet", "file": ..., "sample": ..., "time": ..., "s2n": ..., "crc": "0x1234", "crc_ok": true, "payload": ...}
+# followed, once each file is complete, by:
+#   {"type": "file", "file": ..., "duration": ..., "elapsed": ..., "realtime_factor": ..., "packets": ..., "failed": ...}
+# Payloads are decoded as latin-1, so arbitrary bytes survive the round trip.
+
+import numpy as np
+import argparse, glob, json, logging, multiprocessing, os, sys, time
+from SegmentedDecoder import SegmentedDecoder
+from FileSource import FileSource
+
+
+def find_files(paths, pattern):
+    """ Expand a list of files, directories (searched for pattern) and globs into a sorted list of files. """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.extend(glob.glob(path))
+    return sorted(set(files))
+
+def packet_line(filename, sample_rate, packet):
+    return json.dumps({"type": "packet", "file": filename, "sample": packet["sample"], "time": round(packet["sample"]/float(sample_rate), 3),
+        "s2n": round(packet["s2n"], 1), "crc": "0x%04X" % packet["crc"], "crc_ok": packet["crc_ok"], "payload": packet["payload"].decode('latin-1')})
+
+def file_line(filename, duration, elapsed, packets, failed):
+    """ Summary of a file. packets is the number of packets which passed their CRC check, failed the number which didn't. """
+    return json.dumps({"type": "file", "file": filename, "duration": round(duration, 3), "elapsed": round(elapsed, 3),
+        "realtime_factor": round(duration/elapsed, 1) if elapsed > 0 else None, "packets": packets, "failed": failed})
+
+def decode_file(job):
+    """
+    Decode a whole file in this process. Used by the file-level worker pool, so returns all the output lines at once.
+    """
+    (filename, decoder_kwargs) = job
+    start = time.time()
+    try:
+        decoder = SegmentedDecoder(num_workers = 1, **decoder_kwargs)
+        source = FileSource(filename, **decoder.source_kwargs)
+        packets = list(decoder.decode(filename))
+        lines = [packet_line(filename, source.sample_rate, x) for x in packets]
+    except Exception as e:
+        return [json.dumps({"type": "error", "file": filename, "error": str(e)})]
+
+    good = sum([x["crc_ok"] for x in packets])
+    return lines + [file_line(filename, source.duration, time.time() - start, good, len(packets) - good)]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Decode MFSK packets from recordings, writing JSON lines to stdout.")
+    parser.add_argument("paths", nargs = "+", help = "Files, directories or globs to decode.")
+    parser.add_argument("--pattern", default = "*.wav", help = "Files to decode within a directory (default: %(default)s)")
+    parser.add_argument("--workers", type = int, default = multiprocessing.cpu_count(), help = "Worker processes (default: %(default)s)")
+    parser.add_argument("--segment-length", type = float, default = 300.0, help = "Segment length (seconds) when a single file is split across workers (default: %(default)s)")
+    parser.add_argument("--base-freq", type = float, default = 1500, help = "Frequency of the lowest tone (Hz) (default: %(default)s)")
+    parser.add_argument("--symbol-rate", type = float, default = 15.625, help = "Symbol rate (baud) (default: %(default)s)")
+    parser.add_argument("--num-tones", type = int, default = 16, help = "Number of tones (default: %(default)s)")
+    parser.add_argument("--afc", action = "store_true", help = "Search for and track the signal frequency.")
+    parser.add_argument("--afc-range", type = float, default = 50.0, help = "AFC search range (Hz) (default: %(default)s)")
+    parser.add_argument("--decimate", action = "store_true", help = "Decimate high sample rate input before demodulating.")
+    parser.add_argument("--tracking", action = "store_true", help = "Use the acquisition/tracking timing mode.")
+    parser.add_argument("--float32", action = "store_true", help = "Process in single precision.")
+    parser.add_argument("--channel", type = int, default = 0, help = "Channel to decode from multi-channel files (default: %(default)s)")
+    parser.add_argument("--raw-format", default = None, help = "Read headerless PCM with this NumPy dtype (e.g. int16, '<i4', float32).")
+    parser.add_argument("--raw-channels", type = int, default = 1, help = "Interleaved channels in raw PCM files (default: %(default)s)")
+    parser.add_argument("--sample-rate", type = float, default = 8000, help = "Sample rate of raw PCM files (Hz) (default: %(default)s)")
+    parser.add_argument("--checkpoint-dir", default = None, help = "Save decoder state here after each segment, and resume interrupted files from it. Each file is then decoded in a single process.")
+    parser.add_argument("--include-failed", action = "store_true", help = "Also output packets which fail their CRC check.")
+    parser.add_argument("--verbose", action = "store_true", help = "Log debug information to stderr.")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(stream = sys.stderr, level = logging.DEBUG)
+
+    files = find_files(args.paths, args.pattern)
+    if len(files) == 0:
+        parser.error("No files found.")
+
+    decoder_kwargs = {"segment_length": args.segment_length, "include_failed": args.include_failed, "checkpoint_dir": args.checkpoint_dir, "channel": args.channel,
+        "dtype": np.float32 if args.float32 else np.float64, "raw_format": args.raw_format, "sample_rate": args.sample_rate,
+        "num_channels": args.raw_channels, "base_freq": args.base_freq, "symbol_rate": args.symbol_rate, "num_tones": args.num_tones,
+        "afc": args.afc, "afc_range": args.afc_range, "decimate": args.decimate, "tracking": args.tracking}
+
+    if len(files) == 1 or args.workers <= 1:
+        # One file at a time. A single file is split into segments, which are decoded in parallel.
+        for filename in files:
+            start = time.time()
+            decoder = SegmentedDecoder(num_workers = args.workers, **decoder_kwargs)
+            source = FileSource(filename, **decoder.source_kwargs)
+            good = 0
+            failed = 0
+            for packet in decoder.decode(filename):
+                print packet_line(filename, source.sample_rate, packet)
+                sys.stdout.flush()
+                if packet["crc_ok"]:
+                    good += 1
+                else:
+                    failed += 1
+            print file_line(filename, source.duration, time.time() - start, good, failed)
+            sys.stdout.flush()
+    else:
+        # Many files: decode whole files in parallel, and output each one as it completes.
+        pool = multiprocessing.Pool(min(args.workers, len(files)))
+        try:
+            for lines in pool.imap_unordered(decode_file, [(x, decoder_kwargs) for x in files]):
+                for line in lines:
+                    print line
+                sys.stdout.flush()
+        finally:
+            pool.terminate()
+
+
+if __name__ == "__main__":
+    main()
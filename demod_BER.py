@@ -17,7 +17,6 @@
 # along with this library.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
-from pylab import *
 import MFSKDemodulator, DePacketizer, MFSKSymbolDecoder, time, MFSKModulator, sys, logging
 from scipy.io import wavfile
 
@@ -25,6 +24,10 @@ base_freq = 1500
 sample_rate = 8000
 amplitude = 0.5
 
+# Floating point type used for the signal, noise, and all demodulator processing.
+# np.float32 runs the modulator and demodulator in single precision.
+dtype = np.float64
+
 cheat_symbol_detect = True
 
 # 16-FSK, 15.625 baud.
@@ -50,7 +53,7 @@ ebno_range = np.arange(-10,30,1)
 #ebno_range = np.array([5])
 
 
-symbol_length = sample_rate / symbol_rate
+symbol_length = int(sample_rate / symbol_rate)
 
 # We need to declare these here so parse_symbol can access them.
 n = 0
@@ -108,8 +111,8 @@ output = []
 
 for ebno in ebno_range:
     # Re-instantiate the modulator and demodulator objects
-    mod = MFSKModulator.MFSKModulator(symbol_rate= symbol_rate, tone_spacing = symbol_rate, start_silence=0, base_freq=base_freq, sample_rate=sample_rate, amplitude=amplitude)
-    demod = MFSKDemodulator.MFSKDemodulator(sample_rate=sample_rate, base_freq=base_freq, symbol_rate=symbol_rate, num_tones = num_tones, callback=parse_symbol, cheating = cheat_symbol_detect)
+    mod = MFSKModulator.MFSKModulator(symbol_rate= symbol_rate, tone_spacing = symbol_rate, start_silence=0, base_freq=base_freq, sample_rate=sample_rate, amplitude=amplitude, dtype=dtype)
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate=sample_rate, base_freq=base_freq, symbol_rate=symbol_rate, num_tones = num_tones, callback=parse_symbol, cheating = cheat_symbol_detect, dtype=dtype)
 
     signal_log = np.array([])
     noise_log = np.array([])
@@ -130,7 +133,7 @@ for ebno in ebno_range:
         symbol = mod.baseband[-1*symbol_length:]
 
         # Generate the noise.
-        noise = np.sqrt(variance) * np.random.randn(len(symbol))
+        noise = (np.sqrt(variance) * np.random.randn(len(symbol))).astype(dtype)
 
         signal_log = np.append(signal_log,symbol)
         noise_log = np.append(noise_log,noise)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# demod_BER_dtype.py - Check that single precision processing gives the same BER as double precision.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import MFSKDemodulator, MFSKModulator, MFSKSymbolDecoder, time, sys
+
+base_freq = 1500
+sample_rate = 8000
+amplitude = 0.5
+
+# 16-FSK, 15.625 baud.
+symbol_rate = 15.625
+num_tones = 16
+tone_bits = int(np.log2(num_tones))
+
+num_symbols = 1000
+ebno_range = np.arange(0,12,2)
+chunk_size = 1024
+
+symbol_length = int(sample_rate / symbol_rate)
+symb_dec = MFSKSymbolDecoder.MFSKSymbolDecoder(num_tones=num_tones, gray_coded=True)
+# Bits for each tone, for counting bit errors.
+tone_table = np.array([symb_dec.tone_to_bits(x) for x in range(num_tones)])
+
+def run(dtype, symbols, noise):
+    """ Modulate, add noise and demodulate in (dtype). Returns the detected symbols, indexed by transmitted symbol. """
+    mod = MFSKModulator.MFSKModulator(symbol_rate= symbol_rate, tone_spacing = symbol_rate, start_silence=0, base_freq=base_freq, sample_rate=sample_rate, amplitude=amplitude, dtype=dtype)
+    mod.modulate_symbol(symbols)
+    data = mod.baseband + noise.astype(dtype)
+
+    output = []
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate=sample_rate, base_freq=base_freq, symbol_rate=symbol_rate, num_tones = num_tones, block_callback=output.append, dtype=dtype)
+    start = time.time()
+    for i in range(0, len(data), chunk_size):
+        demod.consume(data[i:i+chunk_size])
+    elapsed = time.time() - start
+
+    # Symbols are reported just after the end of the symbol period.
+    records = np.concatenate(output)
+    index = np.round(records["sample"]/float(symbol_length)).astype(int) - 1
+    valid = (index >= 0) & (index < len(symbols))
+    detected = np.zeros(len(symbols), dtype=int) - 1
+    detected[index[valid]] = records["symbol"][valid]
+
+    buffer_bytes = demod.sample_buffer.nbytes + demod.fft_energy_buffer.nbytes + demod.max_fft_energy_buffer.nbytes
+    return detected, elapsed, buffer_bytes
+
+rng = np.random.RandomState(1234)
+failed = False
+
+print "Eb/No   BER float64   BER float32   Decisions differing"
+for ebno in ebno_range:
+    symbols = rng.randint(0, num_tones, num_symbols)
+    variance = (amplitude**2 / 2) * sample_rate / (symbol_rate * 10**(float(ebno)/10) * np.log2(num_tones))
+    # The same noise is used for both runs.
+    noise = np.sqrt(variance) * rng.randn(num_symbols*symbol_length)
+
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        results[dtype] = run(dtype, symbols, noise)
+
+    # Skip the first few symbols, while the symbol timing settles.
+    ber = {}
+    for dtype in results:
+        detected = results[dtype][0][20:]
+        sent = symbols[20:]
+        bit_errors = np.sum(tone_table[np.clip(detected, 0, None)] != tone_table[sent], axis=1)
+        bit_errors[detected < 0] = tone_bits
+        ber[dtype] = np.sum(bit_errors)/float(len(sent)*tone_bits)
+
+    differing = np.sum(results[np.float64][0] != results[np.float32][0])
+    print "%3d dB  %11.5f   %11.5f   %d/%d" % (ebno, ber[np.float64], ber[np.float32], differing, num_symbols)
+
+    # Decisions can only differ on near-ties, so the error rates should match to within a few symbols.
+    if abs(ber[np.float64] - ber[np.float32]) > max(0.01, 0.1*ber[np.float64]):
+        failed = True
+
+print ""
+for dtype in [np.float64, np.float32]:
+    print "%s: %.2f s per run, %d bytes of demodulator buffers." % (np.dtype(dtype).name, results[dtype][1], results[dtype][2])
+
+if failed:
+    print "FAIL: float32 BER differs from float64 BER."
+    sys.exit(1)
+else:
+    print "PASS: float32 BER matches float64 BER."
@@ -26,6 +26,9 @@ num_tones = 16
 sample_rate = 8000
 amplitude = 0.5
 
+# Floating point type used for the signal, noise, and all demodulator processing.
+dtype = np.float64
+
 # How many symbols to pass through the demodulator?
 num_tests = 500
 max_errors = 100
@@ -34,7 +37,7 @@ ebno_range = np.arange(-10,20,1)
 ebno_range = np.array([10])
 
 
-symbol_length = sample_rate / symbol_rate
+symbol_length = int(sample_rate / symbol_rate)
 
 # We need to declare these here so parse_symbol can access them.
 n = 0
@@ -68,8 +71,8 @@ output = []
 
 for ebno in ebno_range:
     # Re-instantiate the modulator and demodulator objects
-    mod = MFSKModulator.MFSKModulator(symbol_rate= symbol_rate, tone_spacing = symbol_rate, start_silence=0, base_freq=base_freq, sample_rate=sample_rate, amplitude=amplitude)
-    demod = MFSKDemodulator.MFSKDemodulator(sample_rate=sample_rate, base_freq=base_freq, symbol_rate=symbol_rate, num_tones = num_tones, callback=parse_symbol)
+    mod = MFSKModulator.MFSKModulator(symbol_rate= symbol_rate, tone_spacing = symbol_rate, start_silence=0, base_freq=base_freq, sample_rate=sample_rate, amplitude=amplitude, dtype=dtype)
+    demod = MFSKDemodulator.MFSKDemodulator(sample_rate=sample_rate, base_freq=base_freq, symbol_rate=symbol_rate, num_tones = num_tones, callback=parse_symbol, dtype=dtype)
 
     # Calculate the required noise power
     noise_power = (1/(10**(float(ebno)/10))) * (amplitude**2 * (1/symbol_rate) * (num_tones * symbol_rate))/(2*np.log2(num_tones))
@@ -82,7 +85,7 @@ for ebno in ebno_range:
         mod.modulate_symbol([ (n*3)%num_tones ])
         symbol = mod.baseband[-1*symbol_length:]
 
-        noise = np.sqrt( (noise_power/( 2*num_tones * symbol_rate))) * np.random.randn(len(symbol))
+        noise = (np.sqrt( (noise_power/( 2*num_tones * symbol_rate))) * np.random.randn(len(symbol))).astype(dtype)
 
         data = symbol + noise
         demod.consume(data)
@@ -18,7 +18,10 @@
 
 import numpy as np
 import MFSKDemodulator, DePacketizer, MFSKSymbolDecoder, time, logging, sys
-from scipy.io import wavfile
+from FileSource import FileSource
+
+# Floating point type used for processing. np.float32 halves the memory used by the sample buffers.
+dtype = np.float32
 
 # Callback for when a complete packet is recovered.
 def print_payload(payload):
@@ -36,7 +39,7 @@ def parse_symbol(tone):
     tone_bits = symb_dec.tone_to_bits(tone['symbol'])
     packet_extract.process_data(tone_bits)
 
-demod = MFSKDemodulator.MFSKDemodulator(callback=parse_symbol)
+demod = MFSKDemodulator.MFSKDemodulator(callback=parse_symbol, dtype=dtype)
 
 # Set up logging so that we see all debug information from the demod.
 root = logging.getLogger()
@@ -45,14 +48,9 @@ ch.setLevel(logging.DEBUG)
 root.addHandler(ch)
 root.setLevel(logging.DEBUG)
 
-# Read in a wave file containing MFSK packets. This can be generated using 'gen_test_packets.py'
-fs, data = wavfile.read('generated_MFSK16_packets.wav')
-
-# Convert to float
-if(data.dtype == np.int16):
-    data = data.astype(np.float)/2**16
-elif(data.dtype == np.int32):
-    data = data.astype(np.float)/2**32
+# Stream in a wave file containing MFSK packets. This can be generated using 'gen_test_packets.py'
+# The file is memory-mapped, and fed to the demod one chunk at a time.
+source = FileSource('generated_MFSK16_packets.wav', chunk_size=4096, dtype=dtype)
 
-# Feed the demod the entire file.
-demod.consume(data)
+for chunk in source:
+    demod.consume(chunk)
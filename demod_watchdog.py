@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# demod_watchdog.py - Demonstrate the MFSK Demodulator's realtime watchdog.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The test file is played through the demodulator several times. For the middle part of the run, every FFT is
+# slowed down (as if the machine was busy with something else), which pushes the demodulator behind realtime.
+# The watchdog should step up through its degradation levels, then back down once the slowdown stops.
+
+import numpy as np
+import MFSKDemodulator, DePacketizer, FFTBackend, logging, sys, time
+from ModemUtils import *
+from FileSource import FileSource
+
+logging.basicConfig(stream = sys.stdout, level = logging.INFO, format = "%(message)s")
+
+chunk_size = 800
+source = FileSource('generated_MFSK16_packets.wav')
+data = np.concatenate([source.read(source.num_samples)]*6)
+
+payloads = []
+packet_extract = DePacketizer.DePacketizer(callback = payloads.append)
+
+def parse_symbols(symbols):
+    packet_extract.process_data(tones_to_bits(symbols["symbol"], 16))
+
+# Slow down every FFT while (delay) is set.
+fft = FFTBackend.fft
+slowdown = {"delay": 0.0}
+def slow_fft(*args, **kwargs):
+    if slowdown["delay"] > 0:
+        time.sleep(slowdown["delay"])
+    return fft(*args, **kwargs)
+FFTBackend.fft = slow_fft
+
+demod = MFSKDemodulator.MFSKDemodulator(sample_rate = source.sample_rate, block_callback = parse_symbols, soft_bits = True, watchdog = True)
+
+for start in range(0, len(data), chunk_size):
+    slowdown["delay"] = 0.0025 if len(data)/4 < start < len(data)/2 else 0.0
+    demod.consume(data[start:start + chunk_size])
+
+    if start % (2*source.sample_rate) == 0:
+        metrics = demod.watchdog_metrics()
+        print "%5.1f s: level %d, load %.2f, %.2f s behind, block length %d, %d packets" % (start/float(source.sample_rate),
+            metrics["level"], metrics["load"], metrics["backlog"], metrics["block_length"], len(payloads))
+
+print "%d level changes, %d/%d packets decoded." % (demod.level_changes, len(payloads), 3*6)
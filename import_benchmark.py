@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# import_benchmark.py - Cold start import times of the modem modules.
+#
+# Copyright 2014 Mark Jessop <mark.jessop@adelaide.edu.au>
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage: python import_benchmark.py [--budget seconds] [--runs n] [module ...]
+#
+# Each module is imported in a fresh interpreter (so nothing is already loaded), and the best of several runs is
+# reported. Importing a module must not load plotting code or the optional SciPy/pyFFTW pieces, which are only
+# imported when they are first used. Exits with status 1 if any module is over budget, or loads one of those.
+
+import argparse, os, subprocess, sys
+
+MODULES = ["ModemUtils", "FFTBackend", "Decimator", "MFSKModulator", "MFSKDemodulator", "MFSKMultiDemodulator", "MFSKChannelizer",
+    "MFSKScanner", "MFSKBurstReceiver", "MFSKSymbolDecoder", "Packetizer", "DePacketizer", "FileSource", "SymbolCapture",
+    "SegmentedDecoder", "Pipeline", "ThreadedDecoder", "SharedRingBuffer", "NetworkSource", "Selcall", "SelcallDecoder", "DiversityCombiner"]
+
+# Modules which should never be loaded just by importing the modem.
+HEAVY_MODULES = ["matplotlib", "pylab", "scipy", "pyfftw"]
+
+# Run in the fresh interpreter. Prints the import time, then any heavy modules which were loaded.
+TIMER = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print elapsed
+print " ".join(sorted(set([x.split('.')[0] for x in sys.modules if x.split('.')[0] in %r])))
+"""
+
+def time_import(module, runs):
+    """ Best import time (s) of a module over (runs) fresh interpreters, and the heavy modules it loaded. """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", TIMER % (module, HEAVY_MODULES)], cwd = directory).splitlines()
+        elapsed = float(output[0])
+        heavy = output[1].split() if len(output) > 1 else []
+        best = elapsed if best == None else min(best, elapsed)
+    return (best, heavy)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure cold start import times of the modem modules.")
+    parser.add_argument("modules", nargs = "*", default = MODULES, help = "Modules to import (default: all of them)")
+    parser.add_argument("--budget", type = float, default = 0.25, help = "Maximum import time of any module (s) (default: %(default)s)")
+    parser.add_argument("--runs", type = int, default = 5, help = "Fresh interpreters per module; the best time is used (default: %(default)s)")
+    args = parser.parse_args()
+
+    (baseline, heavy) = time_import("numpy", args.runs)
+    print "%-22s %6.1f ms" % ("numpy (baseline)", baseline*1e3)
+
+    failed = False
+    for module in args.modules:
+        (elapsed, heavy) = time_import(module, args.runs)
+        problems = []
+        if elapsed > args.budget:
+            problems.append("over budget")
+        if len(heavy) > 0:
+            problems.append("loaded " + ", ".join(heavy))
+        failed = failed or len(problems) > 0
+        print "%-22s %6.1f ms%s" % (module, elapsed*1e3, "  <- " + "; ".join(problems) if problems else "")
+
+    print "%s (budget %.0f ms)" % ("FAILED" if failed else "OK", args.budget*1e3)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()